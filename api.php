@@ -46,6 +46,33 @@ try {
         status TEXT,
         created_at TEXT
     )');
+    // Stage timestamps (epoch seconds) of the last batch per IMEI, from the X-Trace-* headers of tcp_server_v8
+    $db->exec('CREATE TABLE IF NOT EXISTS ingest_freshness (
+        imei TEXT PRIMARY KEY,
+        trace_id TEXT,
+        records INTEGER,
+        newest_record REAL,
+        received_at REAL,
+        decoded_at REAL,
+        sent_at REAL,
+        api_received_at REAL,
+        stored_at REAL
+    )');
+    // Devices resend records whose ACK was lost; a resent record is ignored instead of stored again.
+    // io_digest matches dedup.io_digest() in the Python API; older rows keep it NULL and never conflict
+    if (!$db->querySingle("SELECT 1 FROM pragma_table_info('gps_data') WHERE name = 'io_digest'")) {
+        $db->exec('ALTER TABLE gps_data ADD COLUMN io_digest INTEGER');
+    }
+    $db->exec('CREATE UNIQUE INDEX IF NOT EXISTS idx_gps_data_record
+        ON gps_data (imei, timestamp, priority, latitude, longitude, io_digest)');
+    // Signed, scaled IO value from the ingest server's IO schema (io_schema.py); io_value stays the raw reading
+    if (!$db->querySingle("SELECT 1 FROM pragma_table_info('io_data') WHERE name = 'value'")) {
+        $db->exec('ALTER TABLE io_data ADD COLUMN value NUMERIC');
+    }
+    // Failed sends of a pending command; tcp_server_v8 marks it 'failed' after FMB_COMMAND_ATTEMPTS of them
+    if (!$db->querySingle("SELECT 1 FROM pragma_table_info('command_queue') WHERE name = 'attempts'")) {
+        $db->exec('ALTER TABLE command_queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0');
+    }
 } catch (Exception $e) {
     file_put_contents($logFile, date('Y-m-d H:i:s') . ': Database init failed: ' . $e->getMessage() . "\n", FILE_APPEND);
     http_response_code(500);
@@ -59,8 +86,14 @@ function logMessage($message) {
     file_put_contents($logFile, gmdate('Y-m-d H:i:s') . ': ' . $message . "\n", FILE_APPEND);
 }
 
+// Epoch seconds from an X-Trace-* header, or null when absent
+function traceStamp($name) {
+    return isset($_SERVER[$name]) && is_numeric($_SERVER[$name]) ? (float)$_SERVER[$name] : null;
+}
+
 // POST /syncing_data
 if ($_SERVER['REQUEST_METHOD'] === 'POST' && $_SERVER['REQUEST_URI'] === '/syncing_data') {
+    $apiReceived = microtime(true);
     $input = json_decode(file_get_contents('php://input'), true);
     if (!$input || !isset($input['imei'], $input['records'])) {
         logMessage('Invalid syncing_data input');
@@ -73,8 +106,14 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST' && $_SERVER['REQUEST_URI'] === '/synci
     $records = $input['records'];
 
     try {
+        $newestRecord = null;
+        $stored = 0;
         foreach ($records as $record) {
             $timestamp = $record['timestamp'];
+            $recordTime = strtotime($timestamp . ' UTC');
+            if ($recordTime !== false && ($newestRecord === null || $recordTime > $newestRecord)) {
+                $newestRecord = $recordTime;
+            }
             $latitude = $record['latitude'];
             $longitude = $record['longitude'];
             $altitude = $record['altitude'];
@@ -82,8 +121,11 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST' && $_SERVER['REQUEST_URI'] === '/synci
             $angle = $record['angle'];
             $satellites = $record['satellites'];
             $priority = $record['priority'];
+            $ioPairs = array_map(function ($io) { return $io['io_id'] . ':' . $io['io_value']; }, $record['io_data'] ?? []);
+            // io_filter trims io_data before forwarding and sends the untrimmed elements' digest along
+            $ioDigest = $record['io_digest'] ?? crc32(implode(',', $ioPairs));
 
-            $stmt = $db->prepare('INSERT INTO gps_data (imei, timestamp, latitude, longitude, altitude, speed, angle, satellites, priority) VALUES (:imei, :timestamp, :latitude, :longitude, :altitude, :speed, :angle, :satellites, :priority)');
+            $stmt = $db->prepare('INSERT OR IGNORE INTO gps_data (imei, timestamp, latitude, longitude, altitude, speed, angle, satellites, priority, io_digest) VALUES (:imei, :timestamp, :latitude, :longitude, :altitude, :speed, :angle, :satellites, :priority, :io_digest)');
             $stmt->bindValue(':imei', $imei, SQLITE3_TEXT);
             $stmt->bindValue(':timestamp', $timestamp, SQLITE3_TEXT);
             $stmt->bindValue(':latitude', $latitude, SQLITE3_FLOAT);
@@ -93,21 +135,45 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST' && $_SERVER['REQUEST_URI'] === '/synci
             $stmt->bindValue(':angle', $angle, SQLITE3_INTEGER);
             $stmt->bindValue(':satellites', $satellites, SQLITE3_INTEGER);
             $stmt->bindValue(':priority', $priority, SQLITE3_INTEGER);
+            $stmt->bindValue(':io_digest', $ioDigest, SQLITE3_INTEGER);
             $stmt->execute();
+            if ($db->changes() === 0) {
+                continue;  // Already stored: a resend, so its IO values are too
+            }
+            $stored++;
 
             if (isset($record['io_data'])) {
                 foreach ($record['io_data'] as $io) {
-                    $stmt = $db->prepare('INSERT INTO io_data (imei, timestamp, io_id, io_value) VALUES (:imei, :timestamp, :io_id, :io_value)');
+                    $stmt = $db->prepare('INSERT INTO io_data (imei, timestamp, io_id, io_value, value) VALUES (:imei, :timestamp, :io_id, :io_value, :value)');
                     $stmt->bindValue(':imei', $imei, SQLITE3_TEXT);
                     $stmt->bindValue(':timestamp', $timestamp, SQLITE3_TEXT);
                     $stmt->bindValue(':io_id', $io['io_id'], SQLITE3_INTEGER);
                     $stmt->bindValue(':io_value', $io['io_value'], SQLITE3_INTEGER);
+                    $stmt->bindValue(':value', $io['value'] ?? null, isset($io['value']) ? SQLITE3_FLOAT : SQLITE3_NULL);
                     $stmt->execute();
                 }
             }
         }
-        logMessage("Synced data for IMEI $imei");
-        echo json_encode(['status' => 'Data synced']);
+        if ($newestRecord !== null) {
+            $stmt = $db->prepare('INSERT INTO ingest_freshness (imei, trace_id, records, newest_record, received_at, decoded_at, sent_at, api_received_at, stored_at)
+                VALUES (:imei, :trace_id, :records, :newest_record, :received_at, :decoded_at, :sent_at, :api_received_at, :stored_at)
+                ON CONFLICT(imei) DO UPDATE SET trace_id = excluded.trace_id, records = excluded.records,
+                    newest_record = excluded.newest_record, received_at = excluded.received_at, decoded_at = excluded.decoded_at,
+                    sent_at = excluded.sent_at, api_received_at = excluded.api_received_at, stored_at = excluded.stored_at
+                WHERE excluded.newest_record >= ingest_freshness.newest_record');
+            $stmt->bindValue(':imei', $imei, SQLITE3_TEXT);
+            $stmt->bindValue(':trace_id', $_SERVER['HTTP_X_TRACE_ID'] ?? null, SQLITE3_TEXT);
+            $stmt->bindValue(':records', count($records), SQLITE3_INTEGER);
+            $stmt->bindValue(':newest_record', $newestRecord, SQLITE3_FLOAT);
+            $stmt->bindValue(':received_at', traceStamp('HTTP_X_TRACE_RECEIVED'), SQLITE3_FLOAT);
+            $stmt->bindValue(':decoded_at', traceStamp('HTTP_X_TRACE_DECODED'), SQLITE3_FLOAT);
+            $stmt->bindValue(':sent_at', traceStamp('HTTP_X_TRACE_SENT'), SQLITE3_FLOAT);
+            $stmt->bindValue(':api_received_at', $apiReceived, SQLITE3_FLOAT);
+            $stmt->bindValue(':stored_at', microtime(true), SQLITE3_FLOAT);
+            $stmt->execute();
+        }
+        logMessage("Synced $stored of " . count($records) . " records for IMEI $imei");
+        echo json_encode(['status' => 'Data synced', 'stored' => $stored, 'duplicates' => count($records) - $stored]);
     } catch (Exception $e) {
         logMessage("Syncing data failed: " . $e->getMessage());
         http_response_code(500);
@@ -199,17 +265,40 @@ if ($_SERVER['REQUEST_METHOD'] === 'GET' && preg_match('#^/power_status/(.+)$#',
     exit;
 }
 
+// GET /freshness/<imei>
+if ($_SERVER['REQUEST_METHOD'] === 'GET' && preg_match('#^/freshness/(.+)$#', $_SERVER['REQUEST_URI'], $matches)) {
+    $imei = $matches[1];
+    try {
+        $stmt = $db->prepare('SELECT * FROM ingest_freshness WHERE imei = :imei');
+        $stmt->bindValue(':imei', $imei, SQLITE3_TEXT);
+        $row = $stmt->execute()->fetchArray(SQLITE3_ASSOC);
+        if ($row) {
+            $row['age_s'] = round(microtime(true) - $row['newest_record'], 1);
+            echo json_encode($row);
+        } else {
+            http_response_code(404);
+            echo json_encode(['error' => 'No data for IMEI']);
+        }
+    } catch (Exception $e) {
+        logMessage("Error in freshness for IMEI $imei: " . $e->getMessage());
+        http_response_code(500);
+        echo json_encode(['error' => 'Server error']);
+    }
+    $db->close();
+    exit;
+}
+
 // GET /command_queue/<imei>
 if ($_SERVER['REQUEST_METHOD'] === 'GET' && preg_match('#^/command_queue/(.+)$#', $_SERVER['REQUEST_URI'], $matches)) {
     $imei = $matches[1];
     try {
-        $stmt = $db->prepare('SELECT id, command FROM command_queue WHERE imei = :imei AND status = :status');
+        $stmt = $db->prepare('SELECT id, command, attempts FROM command_queue WHERE imei = :imei AND status = :status');
         $stmt->bindValue(':imei', $imei, SQLITE3_TEXT);
         $stmt->bindValue(':status', 'pending', SQLITE3_TEXT);
         $result = $stmt->execute();
         $commands = [];
         while ($row = $result->fetchArray(SQLITE3_ASSOC)) {
-            $commands[] = ['id' => $row['id'], 'command' => $row['command']];
+            $commands[] = ['id' => $row['id'], 'command' => $row['command'], 'attempts' => $row['attempts']];
         }
         logMessage("Retrieved " . count($commands) . " pending commands for IMEI $imei");
         echo json_encode(['commands' => $commands]);
@@ -236,8 +325,9 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST' && preg_match('#^/command_queue/update
 
     $status = $input['status'];
     try {
-        $stmt = $db->prepare('UPDATE command_queue SET status = :status WHERE id = :id');
+        $stmt = $db->prepare('UPDATE command_queue SET status = :status, attempts = COALESCE(:attempts, attempts) WHERE id = :id');
         $stmt->bindValue(':status', $status, SQLITE3_TEXT);
+        $stmt->bindValue(':attempts', $input['attempts'] ?? null, isset($input['attempts']) ? SQLITE3_INTEGER : SQLITE3_NULL);
         $stmt->bindValue(':id', $command_id, SQLITE3_INTEGER);
         $stmt->execute();
         logMessage("Updated command $command_id to status '$status'");
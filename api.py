@@ -1,15 +1,85 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
 import os,sys
+import csv
+import hmac
+import io
+import json
 import logging
+import math
+import threading
+import time
 from datetime import datetime
+import dedup
+import geo
+import io_schema
+import metrics
+import profiler
+import ratelimit
+import tracing
+import wire_format
+
+try:
+    import gevent
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    gevent = None
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for Quasar frontend
+# Reverse proxies in front of gunicorn (Render's router is one). request.remote_addr is then the address
+# the first of them saw, so per-client limits and the localhost check apply to the real client
+PROXY_HOPS = int(os.environ.get('FMB_PROXY_HOPS', 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS, x_host=PROXY_HOPS)
 
 DB_NAME = 'grok_fmb_data_v6.db'
 LOG_FILE = 'api_server.log'
+DB_TIMEOUT = 10  # Seconds a connection waits on a locked database before failing
+EXPORT_CHUNK_SIZE = 500  # Rows fetched per fetchmany() call while streaming exports
+EXPORT_COLUMNS = {
+    'gps_data': ['id', 'imei', 'timestamp', 'latitude', 'longitude', 'altitude', 'speed', 'angle', 'satellites', 'priority'],
+    'io_data': ['id', 'imei', 'timestamp', 'io_id', 'io_value', 'value'],
+}
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+MAX_BULK_COMMANDS = 500
+MAX_COMMAND_WAIT = 60  # Upper bound (seconds) for GET /commands/<id>?wait=
+COMMAND_POLL_INTERVAL = 1.0  # Re-check the DB this often while long-polling (updates may land in another worker)
+COMMAND_FINAL_STATUSES = ('completed', 'failed', 'superseded')
+COMPRESS_MIN_SIZE = 500  # Responses smaller than this are not worth compressing
+POSITION_HISTORY_LIMIT = 5000  # Default/maximum fixes returned by /positions/history
+POSITION_HISTORY_MAX_LIMIT = 50000
+POWER_IO_ID = 66  # External voltage (mV)
+POWER_ON_THRESHOLD = 10000  # Above this the fridge has mains power, as in api.php
+STALE_AFTER = int(os.environ.get('FMB_STALE_AFTER', 900))  # Seconds without new records before /freshness flags an IMEI
+FRESHNESS_COLUMNS = ('imei', 'trace_id', 'records', 'newest_record', 'received_at', 'decoded_at', 'sent_at',
+                     'api_received_at', 'stored_at')
+ADMIN_TOKEN = os.environ.get('FMB_ADMIN_TOKEN')  # Required in X-Admin-Token for /admin/*; unset = localhost only
+# Endpoints the ingest server calls for every batch and connection; they are not limited per client
+INGEST_ENDPOINTS = ('syncing_data', 'command_queue', 'command_queue_update', 'metrics_endpoint')
+# Largest /syncing_data body, before and after decompression; a full 255-record frame is well under 1 MB of JSON
+MAX_BATCH_BYTES = int(os.environ.get('FMB_MAX_BATCH_BYTES', 8 * 1024 * 1024))
+
+# Per-worker metrics; each gunicorn worker serves its own /metrics
+STORE_SECONDS = metrics.Histogram('fmb_api_store_seconds', 'Database write of one /syncing_data batch')
+STORED_RECORDS = metrics.Counter('fmb_api_stored_records_total', 'Records written by /syncing_data')
+DUPLICATE_RECORDS = metrics.Counter('fmb_api_duplicate_records_total', 'Records /syncing_data skipped as already stored')
+STAGE_SECONDS = metrics.Histogram('fmb_api_ingest_stage_seconds', 'Latency of each ingest stage for traced batches',
+                                  ('stage',), buckets=tracing.LAG_BUCKETS)
+FRESHNESS_SECONDS = metrics.Histogram('fmb_api_freshness_seconds', 'Newest record timestamp to commit, per IMEI',
+                                      ('imei',), buckets=tracing.LAG_BUCKETS)
+LAST_RECORD_TIMESTAMP = metrics.Gauge('fmb_api_last_record_timestamp_seconds',
+                                      'Newest stored record timestamp per IMEI (alert on time() - this)', ('imei',))
+
+# Woken by /command_queue/update so long-polls in this worker return immediately
+command_updates = threading.Condition()
+
+# Requests per client address and command enqueues per IMEI (FMB_CLIENT_*/FMB_COMMAND_*, see ratelimit)
+client_limits = ratelimit.client_limiter()
+command_limits = ratelimit.command_limiter()
+THROTTLED = metrics.Counter('fmb_api_throttled_total', 'Requests answered 429 by limit', ('limit',))
 
 # Configure logging
 try:
@@ -26,10 +96,70 @@ except Exception as e:
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
     logging.error(f"Failed to initialize API logging: {e}")
 
+# Same FMB_IO_SCHEMA as the ingest server, served by /io_schema so clients need not hard-code IO ids
+io_schemas = io_schema.load()
+logging.info(io_schema.describe(io_schemas))
+
+def connect_db():
+    # Connections may be used from the gevent thread pool, i.e. not the thread that created them
+    return sqlite3.connect(DB_NAME, timeout=DB_TIMEOUT, check_same_thread=False)
+
+def offload(fn, *args):
+    """Run a blocking call in the gevent hub's thread pool when serving under a gevent worker.
+
+    sqlite3 is not cooperative, so without this a single slow query or locked
+    database would stall every greenlet (and every idle long-poll) in the worker.
+    """
+    if gevent is not None and gevent_monkey.is_module_patched('socket'):
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+def _run_in_connection(fn, args):
+    conn = connect_db()
+    try:
+        result = fn(conn.cursor(), *args)
+        conn.commit()
+        return result
+    finally:
+        conn.close()
+
+def run_db(fn, *args):
+    """Call fn(cursor, *args) in a fresh connection, commit, and return its result."""
+    return offload(_run_in_connection, fn, args)
+
+def notify_command_waiters():
+    with command_updates:
+        command_updates.notify_all()
+
+def ensure_columns(c, table, columns):
+    """Add columns missing from a table created by an older version of this API."""
+    c.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in c.fetchall()}
+    for name, column_type in columns.items():
+        if name not in existing:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+            logging.info(f"Added column {name} to {table}")
+
+def has_fix(latitude, longitude):
+    # FMB920 reports 0/0 until it gets a GPS fix; those rows are kept but not indexed
+    return latitude is not None and longitude is not None and not (latitude == 0 and longitude == 0)
+
+def backfill_spatial_index(c):
+    c.execute('INSERT INTO gps_rtree SELECT id, latitude, latitude, longitude, longitude FROM gps_data '
+              'WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND NOT (latitude = 0 AND longitude = 0)')
+    logging.info(f"Backfilled spatial index with {c.rowcount} fixes")
+    c.execute('''INSERT OR REPLACE INTO latest_position (imei, gps_id, timestamp, latitude, longitude, speed, angle)
+        SELECT g.imei, g.id, g.timestamp, g.latitude, g.longitude, g.speed, g.angle
+        FROM gps_data g JOIN gps_rtree r ON r.id = g.id
+        WHERE g.id = (SELECT g2.id FROM gps_data g2 JOIN gps_rtree r2 ON r2.id = g2.id
+                      WHERE g2.imei = g.imei ORDER BY g2.timestamp DESC, g2.id DESC LIMIT 1)''')
+
 def initialize_database():
     try:
         conn = sqlite3.connect(DB_NAME)
         c = conn.cursor()
+        # WAL lets dashboard reads proceed while the ingest side is writing
+        c.execute('PRAGMA journal_mode=WAL')
         c.execute('''CREATE TABLE IF NOT EXISTS gps_data (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             imei TEXT,
@@ -62,6 +192,54 @@ def initialize_database():
             status TEXT,
             created_at TEXT
         )''')
+        ensure_columns(c, 'command_queue', {
+            'idempotency_key': 'TEXT',
+            'response': 'TEXT',
+            'completed_at': 'TEXT',
+            'attempts': 'INTEGER NOT NULL DEFAULT 0',  # Failed sends; tcp_server_v8 gives up at FMB_COMMAND_ATTEMPTS
+        })
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_command_queue_idempotency_key '
+                  'ON command_queue (idempotency_key) WHERE idempotency_key IS NOT NULL')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_command_queue_imei_status ON command_queue (imei, status)')
+        # Spatial index over gps_data fixes (id = gps_data.id) and the last known fix per device
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'gps_rtree'")
+        rtree_missing = c.fetchone() is None
+        c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS gps_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+        c.execute('''CREATE TABLE IF NOT EXISTS latest_position (
+            imei TEXT PRIMARY KEY,
+            gps_id INTEGER,
+            timestamp TEXT,
+            latitude REAL,
+            longitude REAL,
+            speed INTEGER,
+            angle INTEGER
+        )''')
+        if rtree_missing:
+            backfill_spatial_index(c)
+        # Devices resend records whose ACK was lost; a resent record is ignored instead of stored again.
+        # Rows from before io_digest existed have it NULL, so they never conflict (see dedup.py)
+        ensure_columns(c, 'gps_data', {'io_digest': 'INTEGER'})
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_gps_data_record '
+                  'ON gps_data (imei, timestamp, priority, latitude, longitude, io_digest)')
+        # Stage timestamps of the last batch per IMEI (see tracing.py); bounded to one row per device
+        c.execute('''CREATE TABLE IF NOT EXISTS ingest_freshness (
+            imei TEXT PRIMARY KEY,
+            trace_id TEXT,
+            records INTEGER,
+            newest_record REAL,
+            received_at REAL,
+            decoded_at REAL,
+            sent_at REAL,
+            api_received_at REAL,
+            stored_at REAL
+        )''')
+        # Exports page through one IMEI in id order
+        c.execute('CREATE INDEX IF NOT EXISTS idx_gps_data_imei ON gps_data (imei)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_io_data_imei ON io_data (imei)')
+        # Signed, scaled value from the ingest server's IO schema (see io_schema.py); io_value stays the raw reading
+        ensure_columns(c, 'io_data', {'value': 'NUMERIC'})
+        # /power_status reads the newest value of one IO per IMEI on every dashboard poll
+        c.execute('CREATE INDEX IF NOT EXISTS idx_io_data_imei_io_timestamp ON io_data (imei, io_id, timestamp)')
         conn.commit()
         conn.close()
         logging.info("Database initialized")
@@ -69,11 +247,86 @@ def initialize_database():
         logging.error(f"Failed to initialize database: {e}")
         raise
 
-# Initialize database if missing
-if not os.path.exists(DB_NAME):
-    initialize_database()
+# Initialize database (tables and indexes are created only if missing)
+db_missing = not os.path.exists(DB_NAME)
+initialize_database()
+if db_missing:
     logging.info("Database recreated due to ephemeral storage")
 
+def too_many_requests(limit, retry_after, **details):
+    THROTTLED.labels(limit).inc()
+    response = jsonify({'error': 'Too many requests', 'retry_after': math.ceil(retry_after), **details})
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response, 429
+
+@app.before_request
+def limit_client():
+    if request.endpoint in INGEST_ENDPOINTS:
+        return None
+    retry_after = client_limits.acquire(request.remote_addr)
+    if retry_after:
+        logging.warning(f"Client {request.remote_addr} over its request rate on {request.path}")
+        return too_many_requests('client', retry_after)
+    return None
+
+def limit_commands(imeis):
+    """None if every IMEI may queue another command, else a 429 naming those that may not.
+
+    Tokens are only spent when the whole request is accepted, so a bulk
+    request refused for one IMEI costs the others nothing.
+    """
+    waits = command_limits.acquire_all(sorted(set(imeis)))
+    if not waits:
+        return None
+    throttled = sorted(waits)
+    logging.warning(f"Command rate exceeded for IMEI(s) {throttled}")
+    return too_many_requests('command', max(waits.values()), imeis=throttled)
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli-encode buffered responses when the client accepts it."""
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code >= 300 or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = wire_format.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(wire_format.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def admin_allowed():
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+    # Without FMB_PROXY_HOPS a local reverse proxy would make every forwarded request look local
+    return request.remote_addr in ('127.0.0.1', '::1') and (PROXY_HOPS or 'X-Forwarded-For' not in request.headers)
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    """GET: the profile running in this worker, if any. POST ?seconds=&mode=sample|cprofile: start one.
+
+    Under gunicorn the request lands on one worker, which profiles itself.
+    """
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    if request.method == 'GET':
+        return jsonify({'running': profiler.status()})
+    try:
+        seconds = int(request.args.get('seconds', profiler.DEFAULT_SECONDS))
+        started = profiler.start('api', seconds, request.args.get('mode', 'sample'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(started), 202
+
 @app.route('/debug', methods=['GET'])
 def debug():
     try:
@@ -82,11 +335,7 @@ def debug():
             f.write('Test file created')
         os.chmod(test_file, 0o666)
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [row[0] for row in c.fetchall()]
-        conn.close()
+        tables = run_db(lambda c: [row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type='table'")])
 
         response = {
             'status': 'Debug successful',
@@ -101,14 +350,179 @@ def debug():
         logging.error(f"Debug endpoint failed: {e}")
         return jsonify({'error': str(e)}), 500
 
+def store_records(c, imei, records):
+    """Insert a record batch, keeping gps_rtree and latest_position in step with gps_data.
+
+    This is the only writer of those two tables: api.php keeps its own
+    database and does not maintain them, so the /positions/* endpoints only
+    see devices whose ingest server forwards to this API's /syncing_data.
+
+    Records already stored (same imei, timestamp, priority, position and IO
+    elements) are skipped along with their IO values. Returns the number of records stored.
+    """
+    latest_id, latest = None, None
+    stored = []
+    for r in records:
+        c.execute('INSERT OR IGNORE INTO gps_data (imei, timestamp, latitude, longitude, altitude, speed, angle, '
+                  'satellites, priority, io_digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                  (imei, r['timestamp'], r['latitude'], r['longitude'], r['altitude'], r['speed'],
+                   r['angle'], r['satellites'], r['priority'], dedup.record_io_digest(r)))
+        if not c.rowcount:
+            continue
+        stored.append(r)
+        if has_fix(r['latitude'], r['longitude']):
+            c.execute('INSERT INTO gps_rtree VALUES (?, ?, ?, ?, ?)',
+                      (c.lastrowid, r['latitude'], r['latitude'], r['longitude'], r['longitude']))
+            if latest is None or r['timestamp'] >= latest['timestamp']:
+                latest_id, latest = c.lastrowid, r
+    if latest is not None:
+        c.execute('''INSERT INTO latest_position (imei, gps_id, timestamp, latitude, longitude, speed, angle)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(imei) DO UPDATE SET gps_id = excluded.gps_id, timestamp = excluded.timestamp,
+                latitude = excluded.latitude, longitude = excluded.longitude,
+                speed = excluded.speed, angle = excluded.angle
+            WHERE excluded.timestamp >= latest_position.timestamp''',
+                  (imei, latest_id, latest['timestamp'], latest['latitude'], latest['longitude'],
+                   latest['speed'], latest['angle']))
+    c.executemany('INSERT INTO io_data (imei, timestamp, io_id, io_value, value) VALUES (?, ?, ?, ?, ?)',
+                  [(imei, r['timestamp'], io['io_id'], io['io_value'], io.get('value'))
+                   for r in stored for io in r.get('io_data', ())])
+    return len(stored)
+
+def store_freshness(c, imei, trace, records, newest_record):
+    """Record the batch's stage timestamps; runs in the store transaction, so stored is stamped here."""
+    trace['stored'] = time.time()
+    if newest_record is None:
+        return
+    c.execute('''INSERT INTO ingest_freshness (imei, trace_id, records, newest_record, received_at, decoded_at,
+            sent_at, api_received_at, stored_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(imei) DO UPDATE SET trace_id = excluded.trace_id, records = excluded.records,
+            newest_record = excluded.newest_record, received_at = excluded.received_at,
+            decoded_at = excluded.decoded_at, sent_at = excluded.sent_at,
+            api_received_at = excluded.api_received_at, stored_at = excluded.stored_at
+        WHERE excluded.newest_record >= ingest_freshness.newest_record''',
+              (imei, trace.get('id'), records, newest_record, trace.get('received'), trace.get('decoded'),
+               trace.get('sent'), trace.get('api_received'), trace['stored']))
+
+def observe_trace(imei, trace, newest_record):
+    for stage, seconds in tracing.stage_latencies(trace, newest_record).items():
+        if stage == 'freshness':
+            FRESHNESS_SECONDS.labels(imei).observe(max(0.0, seconds))
+        else:
+            STAGE_SECONDS.labels(stage).observe(max(0.0, seconds))
+    if newest_record is not None:
+        LAST_RECORD_TIMESTAMP.labels(imei).set(max(newest_record, LAST_RECORD_TIMESTAMP.labels(imei).value))
+
+@app.route('/syncing_data', methods=['POST'])
+def syncing_data():
+    """Store a record batch forwarded by the ingest server.
+
+    Accepts any wire_format encoding (JSON, columnar JSON, MessagePack),
+    optionally gzip/brotli compressed via Content-Encoding; bodies over
+    FMB_MAX_BATCH_BYTES, compressed or not, get a 413. X-Trace-* headers
+    from the ingest server are recorded for /freshness and the stage metrics.
+    """
+    api_received = time.time()
+    if request.content_length is not None and request.content_length > MAX_BATCH_BYTES:
+        logging.warning(f"Rejected syncing_data body of {request.content_length} bytes")
+        return jsonify({'error': 'Payload too large'}), 413
+    try:
+        body = request.stream.read(MAX_BATCH_BYTES + 1)  # Bounded even for a chunked body without Content-Length
+        if len(body) > MAX_BATCH_BYTES:
+            raise wire_format.BodyTooLarge(f"Body is over {MAX_BATCH_BYTES} bytes")
+        body = wire_format.decompress(body, request.headers.get('Content-Encoding'), MAX_BATCH_BYTES)
+        payload = wire_format.decode_batch(body, request.content_type)
+        imei = payload['imei']
+        records = payload['records']
+    except wire_format.BodyTooLarge as e:
+        logging.warning(f"Rejected syncing_data body: {e}")
+        return jsonify({'error': 'Payload too large'}), 413
+    except Exception as e:
+        logging.warning(f"Invalid syncing_data input: {e}")
+        return jsonify({'error': 'Invalid input'}), 400
+    try:
+        trace = tracing.from_headers(request.headers) or {}
+        trace['api_received'] = api_received
+        newest_record = tracing.newest_record_epoch(records)
+
+        def store(c):
+            stored = store_records(c, imei, records)
+            store_freshness(c, imei, trace, len(records), newest_record)
+            return stored
+
+        with profiler.span('store'), STORE_SECONDS.time():
+            stored = run_db(store)
+        STORED_RECORDS.inc(stored)
+        if stored < len(records):
+            DUPLICATE_RECORDS.inc(len(records) - stored)
+        observe_trace(imei, trace, newest_record)
+        logging.info(f"Synced {stored} of {len(records)} records for IMEI {imei}")
+        return jsonify({'status': 'Data synced', 'stored': stored, 'duplicates': len(records) - stored})
+    except Exception as e:
+        logging.error(f"Syncing data failed for IMEI {imei}: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+def freshness_entry(row, now):
+    entry = dict(zip(FRESHNESS_COLUMNS, row))
+    trace = {'received': entry['received_at'], 'decoded': entry['decoded_at'], 'sent': entry['sent_at'],
+             'api_received': entry['api_received_at'], 'stored': entry['stored_at']}
+    entry['stages_s'] = {stage: round(seconds, 3)
+                         for stage, seconds in tracing.stage_latencies(trace, entry['newest_record']).items()}
+    entry['age_s'] = round(now - entry['newest_record'], 1)
+    entry['stale'] = entry['age_s'] > STALE_AFTER
+    return entry
+
+@app.route('/freshness', methods=['GET'])
+def freshness():
+    """Data age and last-batch stage latencies for every IMEI; ?stale=1 lists only stale ones."""
+    try:
+        rows = run_db(lambda c: c.execute(f"SELECT {', '.join(FRESHNESS_COLUMNS)} FROM ingest_freshness "
+                                          "ORDER BY newest_record").fetchall())
+        now = time.time()
+        entries = [freshness_entry(row, now) for row in rows]
+        if request.args.get('stale') in ('1', 'true'):
+            entries = [entry for entry in entries if entry['stale']]
+        return jsonify({'stale_after_s': STALE_AFTER, 'devices': entries})
+    except Exception as e:
+        logging.error(f"Freshness query failed: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/freshness/<imei>', methods=['GET'])
+def freshness_for_imei(imei):
+    try:
+        row = run_db(lambda c: c.execute(f"SELECT {', '.join(FRESHNESS_COLUMNS)} FROM ingest_freshness WHERE imei = ?",
+                                         (imei,)).fetchone())
+        if not row:
+            return jsonify({'error': 'No data for IMEI'}), 404
+        return jsonify(freshness_entry(row, time.time()))
+    except Exception as e:
+        logging.error(f"Freshness query failed for IMEI {imei}: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/io_schema/<imei>', methods=['GET'])
+def io_schema_for_imei(imei):
+    """Name, signedness, scale and unit of each IO id the IMEI's device model reports."""
+    if io_schemas is None:
+        return jsonify({'error': 'IO schema disabled'}), 404
+    schema = io_schemas.for_imei(imei)
+    return jsonify({'model': schema.model, 'filter': schema.skip_unknown,
+                    'elements': {str(io_id): entry for io_id, entry in sorted(schema.entries.items())}})
+
+@app.route('/power_status/<imei>', methods=['GET'])
+def power_status(imei):
+    try:
+        row = run_db(lambda c: c.execute('SELECT io_value FROM io_data WHERE imei = ? AND io_id = ? '
+                                         'ORDER BY timestamp DESC LIMIT 1', (imei, POWER_IO_ID)).fetchone())
+        return jsonify({'power_status': bool(row and row[0] > POWER_ON_THRESHOLD)})
+    except Exception as e:
+        logging.error(f"Error in power_status for IMEI {imei}: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
 @app.route('/dout1_status/<imei>', methods=['GET'])
 def dout1_status(imei):
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT dout1_active, deactivate_time FROM dout1_state WHERE imei = ?', (imei,))
-        row = c.fetchone()
-        conn.close()
+        row = run_db(lambda c: c.execute('SELECT dout1_active, deactivate_time FROM dout1_state WHERE imei = ?',
+                                         (imei,)).fetchone())
 
         if row:
             response = {
@@ -133,29 +547,400 @@ def dout1_control(imei):
             logging.warning(f"Invalid input for dout1_control, IMEI {imei}")
             return jsonify({'error': 'Invalid input'}), 400
 
+        throttled = limit_commands([imei])
+        if throttled:
+            return throttled
         activate = data['activate']
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT dout1_active FROM dout1_state WHERE imei = ?', (imei,))
-        row = c.fetchone()
+        command = 'setdigout 1' if activate else 'setdigout 0'
+        result = run_db(queue_dout1_command, imei, command, request.headers.get('Idempotency-Key'))
 
-        if row:
-            command = 'setdigout 1' if activate else 'setdigout 0'
-            created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            c.execute('INSERT INTO command_queue (imei, command, status, created_at) VALUES (?, ?, ?, ?)',
-                      (imei, command, 'pending', created_at))
-            conn.commit()
-            conn.close()
-            logging.info(f"Command queued for IMEI {imei}: {command}")
-            return jsonify({'command': command, 'status': 'queued'})
+        if result:
+            if result['superseded']:
+                notify_command_waiters()
+            logging.info(f"Command queued for IMEI {imei}: {command} (id {result['id']}, deduplicated={result['deduplicated']})")
+            return jsonify({'id': result['id'], 'command': command, 'status': 'queued'})
         else:
-            conn.close()
             logging.warning(f"IMEI {imei} not found in dout1_control")
             return jsonify({'error': 'IMEI not found'}), 404
     except Exception as e:
         logging.error(f"Error in dout1_control for IMEI {imei}: {e}")
         return jsonify({'error': 'Server error'}), 500
 
+def queue_dout1_command(c, imei, command, idempotency_key):
+    c.execute('SELECT dout1_active FROM dout1_state WHERE imei = ?', (imei,))
+    if not c.fetchone():
+        return None
+    return enqueue_command(c, imei, command, idempotency_key)
+
+def command_output(command):
+    """Return the output a command drives, so a newer command can supersede an older one."""
+    parts = command.split()
+    if parts and parts[0] == 'setdigout':
+        return 'setdigout'
+    return None
+
+def enqueue_command(c, imei, command, idempotency_key=None):
+    """Queue a command unless an equivalent one is already waiting.
+
+    A repeated idempotency key returns the original command. An identical
+    pending command for the same IMEI is reused, and pending commands that
+    drive the same output are marked 'superseded' by the new one; callers
+    should wake long-polls (notify_command_waiters) when that list is non-empty.
+    """
+    if idempotency_key:
+        c.execute('SELECT id, status FROM command_queue WHERE idempotency_key = ?', (idempotency_key,))
+        row = c.fetchone()
+        if row:
+            return {'id': row[0], 'status': row[1], 'deduplicated': True, 'superseded': []}
+
+    c.execute("SELECT id, command FROM command_queue WHERE imei = ? AND status = 'pending' ORDER BY id", (imei,))
+    pending = c.fetchall()
+    for command_id, pending_command in pending:
+        if pending_command == command:
+            return {'id': command_id, 'status': 'pending', 'deduplicated': True, 'superseded': []}
+
+    output = command_output(command)
+    superseded = [command_id for command_id, pending_command in pending
+                  if output is not None and command_output(pending_command) == output]
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    try:
+        c.execute('INSERT INTO command_queue (imei, command, status, created_at, idempotency_key) VALUES (?, ?, ?, ?, ?)',
+                  (imei, command, 'pending', now, idempotency_key))
+    except sqlite3.IntegrityError:
+        # Another worker inserted the same idempotency key since the check above; its row is the original
+        c.execute('SELECT id, status FROM command_queue WHERE idempotency_key = ?', (idempotency_key,))
+        row = c.fetchone()
+        if not row:
+            raise
+        return {'id': row[0], 'status': row[1], 'deduplicated': True, 'superseded': []}
+    command_id = c.lastrowid
+    for superseded_id in superseded:
+        c.execute("UPDATE command_queue SET status = 'superseded', completed_at = ? WHERE id = ?", (now, superseded_id))
+    if superseded:
+        logging.info(f"Command {command_id} for IMEI {imei} superseded pending commands {superseded}")
+    return {'id': command_id, 'status': 'pending', 'deduplicated': False, 'superseded': superseded}
+
+def enqueue_commands(c, entries):
+    results = []
+    for entry in entries:
+        result = enqueue_command(c, str(entry['imei']), entry['command'], entry.get('idempotency_key'))
+        results.append({'imei': str(entry['imei']), 'command': entry['command'], **result})
+    return results
+
+def fetch_command(c, command_id):
+    c.execute('SELECT id, imei, command, status, response, created_at, completed_at FROM command_queue WHERE id = ?',
+              (command_id,))
+    row = c.fetchone()
+    if not row:
+        return None
+    return dict(zip(('id', 'imei', 'command', 'status', 'response', 'created_at', 'completed_at'), row))
+
+@app.route('/commands', methods=['POST'])
+def create_commands():
+    """Queue many IMEI/command pairs in one request.
+
+    Body: {"commands": [{"imei": ..., "command": ..., "idempotency_key": ...}, ...]}
+    """
+    data = request.get_json(silent=True)
+    entries = data.get('commands') if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries or len(entries) > MAX_BULK_COMMANDS:
+        logging.warning("Invalid input for bulk commands")
+        return jsonify({'error': 'Invalid input'}), 400
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('imei') or not entry.get('command'):
+            logging.warning(f"Invalid bulk command entry: {entry}")
+            return jsonify({'error': 'Invalid input'}), 400
+    throttled = limit_commands({str(entry['imei']) for entry in entries})
+    if throttled:
+        return throttled
+
+    try:
+        results = run_db(enqueue_commands, entries)
+        if any(result['superseded'] for result in results):
+            notify_command_waiters()
+        logging.info(f"Bulk queued {len(results)} commands "
+                     f"({sum(1 for r in results if r['deduplicated'])} deduplicated)")
+        return jsonify({'commands': results})
+    except Exception as e:
+        logging.error(f"Error in bulk command enqueue: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/commands/<int:command_id>', methods=['GET'])
+def command_status(command_id):
+    """Return a command; with ?wait=N, block up to N seconds for it to leave 'pending'."""
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), MAX_COMMAND_WAIT)
+    except ValueError:
+        return jsonify({'error': 'Invalid input'}), 400
+    try:
+        command = run_db(fetch_command, command_id)
+        deadline = time.monotonic() + wait
+        while command and command['status'] not in COMMAND_FINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with command_updates:
+                command_updates.wait(min(remaining, COMMAND_POLL_INTERVAL))
+            command = run_db(fetch_command, command_id)
+        if not command:
+            return jsonify({'error': 'Command not found'}), 404
+        return jsonify(command)
+    except Exception as e:
+        logging.error(f"Error in command_status for command {command_id}: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/command_queue/<imei>', methods=['GET'])
+def command_queue(imei):
+    try:
+        rows = run_db(lambda c: c.execute("SELECT id, command, attempts FROM command_queue "
+                                          "WHERE imei = ? AND status = 'pending' ORDER BY id", (imei,)).fetchall())
+        commands = [{'id': row[0], 'command': row[1], 'attempts': row[2]} for row in rows]
+        logging.info(f"Retrieved {len(commands)} pending commands for IMEI {imei}")
+        return jsonify({'commands': commands})
+    except Exception as e:
+        logging.error(f"Error retrieving command queue for IMEI {imei}: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/command_queue/update/<int:command_id>', methods=['POST'])
+def command_queue_update(command_id):
+    """Called by the ingest server after each send of a command; wakes long-polls.
+
+    A send the device did not answer comes back as 'pending' with its
+    attempts count, or as 'failed' once tcp_server_v8 gives up on it.
+    """
+    data = request.get_json(silent=True)
+    if not data or 'status' not in data:
+        logging.warning(f"Invalid input for command_queue/update/{command_id}")
+        return jsonify({'error': 'Invalid input'}), 400
+    try:
+        completed_at = datetime.now().strftime(TIMESTAMP_FORMAT) if data['status'] in COMMAND_FINAL_STATUSES else None
+        run_db(lambda c: c.execute('UPDATE command_queue SET status = ?, response = ?, completed_at = ?, '
+                                   'attempts = COALESCE(?, attempts) WHERE id = ?',
+                                   (data['status'], data.get('response'), completed_at, data.get('attempts'),
+                                    command_id)))
+        notify_command_waiters()
+        logging.info(f"Updated command {command_id} to status '{data['status']}'")
+        return jsonify({'status': 'Updated'})
+    except Exception as e:
+        logging.error(f"Error updating command {command_id}: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+# /positions/* read gps_rtree and latest_position, which only store_records fills: point the ingest server's
+# SYNC_DATA_URL at this API, not api.php, or they stay empty
+def parse_area(args):
+    """Read the query area from request args.
+
+    Either bbox=min_lon,min_lat,max_lon,max_lat (the usual map-viewport order)
+    or lat=..&lon=..&radius=<metres>. Returns (bbox, center, radius_m); center
+    and radius_m are None for a plain bounding box. Raises ValueError.
+    """
+    if 'bbox' in args:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in args['bbox'].split(','))
+        bbox = (min_lat, max_lat, min_lon, max_lon)
+        center, radius_m = None, None
+    else:
+        center = (float(args['lat']), float(args['lon']))
+        radius_m = float(args['radius'])
+        if radius_m <= 0:
+            raise ValueError('radius must be positive')
+        bbox = geo.radius_bbox(center[0], center[1], radius_m)
+    if not geo.valid_bbox(*bbox):
+        raise ValueError('invalid bounding box')
+    return bbox, center, radius_m
+
+def filter_by_radius(rows, center, radius_m):
+    """Drop bbox hits outside the circle and attach distance_m (rows are dicts with latitude/longitude)."""
+    if center is None:
+        return rows
+    kept = []
+    for row in rows:
+        distance = geo.haversine_m(center[0], center[1], row['latitude'], row['longitude'])
+        if distance <= radius_m:
+            row['distance_m'] = round(distance, 1)
+            kept.append(row)
+    kept.sort(key=lambda row: row['distance_m'])
+    return kept
+
+LATEST_POSITION_COLUMNS = ('imei', 'timestamp', 'latitude', 'longitude', 'speed', 'angle')
+
+def query_latest_positions(c, bbox):
+    c.execute(f"SELECT {', '.join(LATEST_POSITION_COLUMNS)} FROM latest_position "
+              'WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?', bbox)
+    return [dict(zip(LATEST_POSITION_COLUMNS, row)) for row in c.fetchall()]
+
+HISTORY_COLUMNS = ('id', 'imei', 'timestamp', 'latitude', 'longitude', 'altitude', 'speed', 'angle', 'satellites')
+
+def query_position_history(c, bbox, imei, start, end, after_id, limit):
+    # The R*Tree stores float32 boxes rounded outwards, so a fix on the bbox edge may not be contained in it:
+    # select boxes that overlap the bbox, then filter exactly on the float64 coordinates in gps_data
+    query = (f"SELECT {', '.join('g.' + column for column in HISTORY_COLUMNS)} "
+             'FROM gps_rtree r JOIN gps_data g ON g.id = r.id '
+             'WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? AND r.id > ? '
+             'AND g.latitude BETWEEN ? AND ? AND g.longitude BETWEEN ? AND ?')
+    params = [bbox[0], bbox[1], bbox[2], bbox[3], after_id, bbox[0], bbox[1], bbox[2], bbox[3]]
+    if imei:
+        query += ' AND g.imei = ?'
+        params.append(imei)
+    if start:
+        query += ' AND g.timestamp >= ?'
+        params.append(start)
+    if end:
+        query += ' AND g.timestamp <= ?'
+        params.append(end)
+    query += ' ORDER BY r.id LIMIT ?'
+    params.append(limit)
+    c.execute(query, params)
+    return [dict(zip(HISTORY_COLUMNS, row)) for row in c.fetchall()]
+
+@app.route('/positions/latest', methods=['GET'])
+def latest_positions():
+    """Last known fix of every device inside a viewport (bbox) or radius."""
+    try:
+        bbox, center, radius_m = parse_area(request.args)
+    except (KeyError, ValueError) as e:
+        logging.warning(f"Invalid area for latest positions: {e}")
+        return jsonify({'error': 'Invalid input'}), 400
+    try:
+        positions = filter_by_radius(run_db(query_latest_positions, bbox), center, radius_m)
+        return jsonify({'positions': positions})
+    except Exception as e:
+        logging.error(f"Error in latest_positions: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/positions/nearest', methods=['GET'])
+def nearest_positions():
+    """The ``limit`` devices whose last fix is closest to lat/lon."""
+    try:
+        lat, lon = float(request.args['lat']), float(request.args['lon'])
+        limit = min(max(int(request.args.get('limit', 5)), 1), 100)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Invalid input'}), 400
+    try:
+        # latest_position holds one row per device, so a full scan is fleet-sized
+        positions = run_db(query_latest_positions, (-geo.MAX_LAT, geo.MAX_LAT, -geo.MAX_LON, geo.MAX_LON))
+        for position in positions:
+            position['distance_m'] = round(geo.haversine_m(lat, lon, position['latitude'], position['longitude']), 1)
+        positions.sort(key=lambda position: position['distance_m'])
+        return jsonify({'positions': positions[:limit]})
+    except Exception as e:
+        logging.error(f"Error in nearest_positions: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/positions/within', methods=['POST'])
+def positions_within():
+    """Devices whose last fix lies inside a polygon: {"polygon": [[lat, lon], ...]}."""
+    data = request.get_json(silent=True)
+    try:
+        polygon = [(float(point[0]), float(point[1])) for point in data['polygon']]
+        if len(polygon) < 3:
+            raise ValueError('polygon needs at least 3 points')
+    except (KeyError, TypeError, ValueError, IndexError) as e:
+        logging.warning(f"Invalid polygon for positions_within: {e}")
+        return jsonify({'error': 'Invalid input'}), 400
+    try:
+        candidates = run_db(query_latest_positions, geo.polygon_bbox(polygon))
+        positions = [p for p in candidates if geo.point_in_polygon(p['latitude'], p['longitude'], polygon)]
+        return jsonify({'positions': positions})
+    except Exception as e:
+        logging.error(f"Error in positions_within: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/positions/history', methods=['GET'])
+def position_history():
+    """Fixes inside a viewport or radius, optionally for one IMEI and time range.
+
+    Results are in id order and capped at ``limit``; pass the last id back as
+    ``after_id`` to fetch the next page.
+    """
+    try:
+        bbox, center, radius_m = parse_area(request.args)
+        after_id = int(request.args.get('after_id', 0))
+        limit = min(max(int(request.args.get('limit', POSITION_HISTORY_LIMIT)), 1), POSITION_HISTORY_MAX_LIMIT)
+        start = request.args.get('start')
+        end = request.args.get('end')
+        if start:
+            datetime.strptime(start, TIMESTAMP_FORMAT)
+        if end:
+            datetime.strptime(end, TIMESTAMP_FORMAT)
+    except (KeyError, ValueError) as e:
+        logging.warning(f"Invalid input for position history: {e}")
+        return jsonify({'error': 'Invalid input'}), 400
+    try:
+        rows = run_db(query_position_history, bbox, request.args.get('imei'), start, end, after_id, limit)
+        next_after_id = rows[-1]['id'] if len(rows) == limit else None
+        return jsonify({'positions': filter_by_radius(rows, center, radius_m), 'next_after_id': next_after_id})
+    except Exception as e:
+        logging.error(f"Error in position_history: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+def generate_export_rows(query, params, columns, export_format):
+    conn = connect_db()
+    try:
+        c = conn.cursor()
+        offload(c.execute, query, params)
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            yield buffer.getvalue()
+        while True:
+            rows = offload(c.fetchmany, EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            if export_format == 'csv':
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows(rows)
+                yield buffer.getvalue()
+            else:
+                yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+    finally:
+        conn.close()
+
+@app.route('/export/<table>/<imei>', methods=['GET'])
+def export_data(table, imei):
+    """Stream gps_data/io_data rows for an IMEI as NDJSON or CSV.
+
+    Rows are emitted in id order; a client resumes an interrupted export by
+    passing the last id it received as ``after_id``.
+    """
+    columns = EXPORT_COLUMNS.get(table)
+    if columns is None:
+        logging.warning(f"Invalid export table requested: {table}")
+        return jsonify({'error': 'Unknown table'}), 404
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Invalid format'}), 400
+    try:
+        after_id = int(request.args.get('after_id', 0))
+        start = request.args.get('start')
+        end = request.args.get('end')
+        if start:
+            datetime.strptime(start, TIMESTAMP_FORMAT)
+        if end:
+            datetime.strptime(end, TIMESTAMP_FORMAT)
+    except ValueError:
+        logging.warning(f"Invalid export parameters for IMEI {imei}: {dict(request.args)}")
+        return jsonify({'error': 'Invalid input'}), 400
+
+    query = f"SELECT {', '.join(columns)} FROM {table} WHERE imei = ? AND id > ?"
+    params = [imei, after_id]
+    if start:
+        query += ' AND timestamp >= ?'
+        params.append(start)
+    if end:
+        query += ' AND timestamp <= ?'
+        params.append(end)
+    query += ' ORDER BY id'
+
+    logging.info(f"Export of {table} started for IMEI {imei} (format={export_format}, after_id={after_id})")
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(generate_export_rows(query, params, columns, export_format)),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={table}_{imei}.{export_format}'
+    return response
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
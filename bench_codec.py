@@ -0,0 +1,209 @@
+"""Microbenchmarks for the codec hot paths in fmb_codec.
+
+Every benchmark runs over the capture corpus in corpus/ (real frames taken
+from the server logs, one hex frame per line) and reports throughput in its
+natural unit: records/s for AVL decoding, bytes/s for CRCs, calls/s otherwise.
+
+    python bench_codec.py                                  # run and print
+    python bench_codec.py --save bench_baseline.json       # record a new baseline
+    python bench_codec.py --compare bench_baseline.json    # exit 1 on regression or missing entry
+
+Each benchmark is timed interleaved with a fixed pure-Python reference loop
+that does not touch fmb_codec, and --compare checks throughput per reference
+loop rather than per second. A baseline therefore carries over to a faster
+or slower host; a different Python version or CPU architecture can still
+shift the ratios, so re-record the baseline there.
+"""
+import argparse
+import json
+import os
+import platform
+import struct
+import sys
+import timeit
+
+import fmb_codec
+import io_schema
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+REPEAT = 20  # Samples per benchmark, taken round robin; the fastest counts
+SAMPLE_SECONDS = 0.05  # Rough length of one sample
+REFERENCE_FIELDS = struct.Struct('>QBiiHHBH')  # A GPS element's shape, unpacked by the reference loop
+DEFAULT_TOLERANCE = 0.15  # Fail --compare when throughput drops by more than this fraction
+
+
+def load_corpus(name):
+    with open(os.path.join(CORPUS_DIR, name)) as f:
+        return [bytes.fromhex(line.strip()) for line in f if line.strip()]
+
+
+def reference_loop(data=bytes(range(256)) * 8):
+    """Fixed interpreter work (struct unpacking, dicts, a list) like the decoder's, without fmb_codec."""
+    rows = []
+    for offset in range(0, len(data) - REFERENCE_FIELDS.size, REFERENCE_FIELDS.size):
+        timestamp, priority, longitude, latitude, altitude, angle, satellites, speed = \
+            REFERENCE_FIELDS.unpack_from(data, offset)
+        rows.append({'timestamp': timestamp, 'priority': priority, 'latitude': latitude / 10000000,
+                     'longitude': longitude / 10000000, 'altitude': altitude, 'angle': angle,
+                     'satellites': satellites, 'speed': speed})
+    return rows
+
+
+def sample_loops(timer):
+    """Calls per sample, so one sample takes about SAMPLE_SECONDS."""
+    loops, elapsed = timer.autorange()
+    return max(1, int(loops * SAMPLE_SECONDS / elapsed))
+
+
+def build_benchmarks():
+    """Return {name: (callable, units_per_call, unit)}."""
+    avl_frames = load_corpus('codec8e.hex')
+    codec12_frames = load_corpus('codec12.hex')
+    records_per_pass = sum(frame[9] for frame in avl_frames)
+    data_fields = [frame[8:-4] for frame in avl_frames]
+    crcs = [struct.unpack('>I', frame[-4:])[0] for frame in avl_frames]
+    bytes_per_pass = sum(len(field) for field in data_fields)
+    first_frame = avl_frames[0]
+    layout_records = [fmb_codec.decode_avl_packet(frame, '350317177312182', keep_layout=True)[1]
+                      for frame in avl_frames]
+
+    # The corpus re-encoded as Codec 8 and 16, dropping what those codecs cannot carry
+    narrow_records = [[dict(record, event_io_id=record['event_io_id'] & 0xFF,
+                            io_data=[e for e in record['io_data'] if e['size'] != 'x' and e['io_id'] <= 0xFF])
+                       for record in records] for records in layout_records]
+    codec8_frames = [fmb_codec.encode_avl_packet(records, 0x08) for records in narrow_records]
+    codec16_frames = [fmb_codec.encode_avl_packet(records, 0x10) for records in narrow_records]
+
+    def decode_avl():
+        for frame in avl_frames:
+            fmb_codec.decode_avl_packet(frame, '350317177312182')
+
+    schema = io_schema.load(None).default  # Built-in FMB920 dictionary
+
+    def decode_avl_typed():
+        for frame in avl_frames:
+            fmb_codec.decode_avl_packet(frame, '350317177312182', schema=schema)
+
+    def decode_codec8():
+        for frame in codec8_frames:
+            fmb_codec.decode_avl_packet(frame, '350317177312182')
+
+    def decode_codec16():
+        for frame in codec16_frames:
+            fmb_codec.decode_avl_packet(frame, '350317177312182')
+
+    def encode_avl():
+        for records in layout_records:
+            fmb_codec.encode_avl_packet(records)
+
+    def parse_timestamps():
+        fmb_codec.parse_timestamp(first_frame, 10)
+
+    def build_codec12():
+        fmb_codec.build_codec12_packet('setdigout 1 4000')
+
+    def parse_codec12():
+        for frame in codec12_frames:
+            fmb_codec.parse_codec12_response(frame)
+
+    def crc16():
+        for field in data_fields:
+            fmb_codec.crc16(field)
+
+    def verify_crc():
+        for field, crc in zip(data_fields, crcs):
+            fmb_codec.verify_crc(field, crc)
+
+    return {
+        'decode_avl_packet': (decode_avl, records_per_pass, 'records'),
+        'decode_avl_typed': (decode_avl_typed, records_per_pass, 'records'),
+        'decode_codec8': (decode_codec8, records_per_pass, 'records'),
+        'decode_codec16': (decode_codec16, records_per_pass, 'records'),
+        'encode_avl_packet': (encode_avl, records_per_pass, 'records'),
+        'parse_timestamp': (parse_timestamps, 1, 'calls'),
+        'build_codec12_packet': (build_codec12, 1, 'calls'),
+        'parse_codec12_response': (parse_codec12, len(codec12_frames), 'calls'),
+        'crc16': (crc16, bytes_per_pass, 'bytes'),
+        'verify_crc': (verify_crc, bytes_per_pass, 'bytes'),
+    }
+
+
+def run(selected=None, repeat=REPEAT):
+    reference = timeit.Timer(reference_loop)
+    reference_loops = sample_loops(reference)
+    reference_best = float('inf')
+    timers = {}
+    for name, (fn, units, unit) in build_benchmarks().items():
+        if not selected or name in selected:
+            timer = timeit.Timer(fn)
+            timers[name] = (timer, sample_loops(timer), units, unit)
+    best = dict.fromkeys(timers, float('inf'))
+    # Round robin, with a reference sample after each: every benchmark's samples are spread over the whole
+    # run, so a few noisy seconds on the host cannot spoil all of one benchmark's samples
+    for _ in range(repeat):
+        for name, (timer, loops, _, _) in timers.items():
+            best[name] = min(best[name], timer.timeit(loops) / loops)
+            reference_best = min(reference_best, reference.timeit(reference_loops) / reference_loops)
+    results = {}
+    for name, (_, _, units, unit) in timers.items():
+        # The fastest reference sample of the run is the steadiest measure of the host's speed
+        results[name] = {'unit': unit, 'per_second': units / best[name], 'usec_per_call': best[name] * 1e6,
+                         'per_reference_loop': units * reference_best / best[name]}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print each result against the baseline; returns (regressed names, names the baseline lacks).
+
+    Throughput is compared per reference loop, so the host's own speed cancels out.
+    """
+    regressions, missing = [], []
+    for name, result in results.items():
+        reference = baseline['results'].get(name)
+        if not reference or 'per_reference_loop' not in reference:
+            missing.append(name)
+            print(f"{name:<24} {result['per_second']:>14,.0f} {result['unit']}/s  not in baseline")
+            continue
+        change = result['per_reference_loop'] / reference['per_reference_loop'] - 1
+        marker = ''
+        if change < -tolerance:
+            marker = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<24} {result['per_second']:>14,.0f} {result['unit']}/s  "
+              f"baseline {reference['per_second']:>14,.0f}  {change:+.1%} relative to the host{marker}")
+    return regressions, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Teltonika codec hot paths')
+    parser.add_argument('--save', metavar='FILE', help='Write results as a baseline JSON file')
+    parser.add_argument('--compare', metavar='FILE', help='Compare against a baseline and exit 1 on regression or a benchmark it lacks')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='Samples per benchmark')
+    parser.add_argument('benchmarks', nargs='*', help='Only run these benchmarks')
+    args = parser.parse_args()
+
+    results = run(args.benchmarks, args.repeat)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions, missing = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        if missing:
+            # A benchmark without a baseline is never checked; record one with --save
+            print(f"Missing from {args.compare}: {', '.join(missing)}")
+        if regressions or missing:
+            sys.exit(1)
+    else:
+        for name, result in results.items():
+            print(f"{name:<24} {result['per_second']:>14,.0f} {result['unit']}/s  "
+                  f"({result['usec_per_call']:.2f} us/call)")
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
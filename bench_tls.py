@@ -0,0 +1,144 @@
+"""Connection-churn benchmark for the device port: plain TCP vs TLS, full vs resumed handshakes.
+
+Each connection does what a unit does on connect: TCP (and TLS) handshake,
+send its IMEI, wait for the one-byte acknowledgment, close. The server is
+an in-process accept loop using tls.server_context(), so the numbers show
+the handshake cost the ingest server pays per connection:
+
+    python bench_tls.py                                   # throwaway self-signed cert (needs openssl)
+    python bench_tls.py --key-type rsa                    # RSA-2048, where resumption saves the most
+    python bench_tls.py --cert server.pem --key server.key --connections 2000
+    python bench_tls.py --min-version 1.2 --ciphers ECDHE-RSA-AES128-GCM-SHA256
+
+'tls-resumed' offers the previous connection's session (a TLS 1.3 ticket
+or TLS 1.2 session id), as a unit reconnecting on its upload period does.
+"""
+import argparse
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+import tls
+from fmb_simulator import percentile
+
+IMEI = b'350317177312182'
+MODES = ('plain', 'tls-full', 'tls-resumed')
+
+
+KEY_TYPES = {
+    'ec': ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'],
+    'rsa': ['-newkey', 'rsa:2048'],
+}
+
+
+def self_signed_cert(directory, key_type):
+    cert, key = os.path.join(directory, 'bench.pem'), os.path.join(directory, 'bench.key')
+    subprocess.run(['openssl', 'req', '-x509', *KEY_TYPES[key_type],
+                    '-nodes', '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost'], check=True, capture_output=True)
+    return cert, key
+
+
+def recv_exact(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def serve(listener, context, stop):
+    while not stop.is_set():
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if context:
+                conn = tls.wrap(context, conn)
+                tls.handshake(conn)
+            length = struct.unpack('>H', recv_exact(conn, 2))[0]
+            recv_exact(conn, length)
+            conn.sendall(b'\x01')
+            conn.recv(1)  # Until the client closes
+        except (OSError, struct.error):
+            pass
+        finally:
+            conn.close()
+
+
+def churn(port, client_context, connections, resume):
+    latencies = []
+    session = None
+    resumed = 0
+    started = time.perf_counter()
+    for _ in range(connections):
+        began = time.perf_counter()
+        conn = socket.create_connection(('127.0.0.1', port))
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if client_context:
+            conn = client_context.wrap_socket(conn, server_hostname='localhost', session=session)
+        conn.sendall(struct.pack('>H', len(IMEI)) + IMEI)
+        if conn.recv(1) != b'\x01':
+            raise RuntimeError('no IMEI acknowledgment')
+        latencies.append(time.perf_counter() - began)
+        if client_context:
+            resumed += conn.session_reused
+            if resume:
+                session = conn.session  # TLS 1.3 tickets arrive after the handshake, so read it after the ACK
+        conn.close()
+    return connections / (time.perf_counter() - started), latencies, resumed
+
+
+def run(args, cert, key):
+    server_context = tls.server_context(cert, key, args.ciphers, args.min_version, args.tickets)
+    client_context = ssl.create_default_context(cafile=cert)
+    client_context.minimum_version = tls.VERSIONS[args.min_version]
+    results = {}
+    for mode in args.modes:
+        context = None if mode == 'plain' else server_context
+        listener = socket.create_server(('127.0.0.1', 0), backlog=128)
+        stop = threading.Event()
+        thread = threading.Thread(target=serve, args=(listener, context, stop), daemon=True)
+        thread.start()
+        try:
+            churn(listener.getsockname()[1], context and client_context, min(50, args.connections), mode == 'tls-resumed')
+            results[mode] = churn(listener.getsockname()[1], context and client_context, args.connections,
+                                  mode == 'tls-resumed')
+        finally:
+            stop.set()
+            listener.close()
+            thread.join(1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark device connection churn with and without TLS')
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--cert', help='Server certificate (default: a throwaway self-signed one)')
+    parser.add_argument('--key')
+    parser.add_argument('--key-type', choices=sorted(KEY_TYPES), default='ec', help='Key of the throwaway certificate')
+    parser.add_argument('--ciphers', default=tls.CIPHERS)
+    parser.add_argument('--min-version', choices=sorted(tls.VERSIONS), default=tls.MIN_VERSION)
+    parser.add_argument('--tickets', type=int, default=tls.TICKETS or 2)
+    parser.add_argument('modes', nargs='*', default=list(MODES), help=f"Any of {', '.join(MODES)}")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench-tls-') as directory:
+        cert, key = (args.cert, args.key) if args.cert else self_signed_cert(directory, args.key_type)
+        results = run(args, cert, key)
+    for mode, (rate, latencies, resumed) in results.items():
+        print(f"{mode:<12} {rate:>9,.0f} conn/s  p50 {percentile(latencies, 50) * 1000:6.2f} ms  "
+              f"p99 {percentile(latencies, 99) * 1000:6.2f} ms  resumed {resumed}/{len(latencies)}")
+
+
+if __name__ == '__main__':
+    main()
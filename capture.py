@@ -0,0 +1,165 @@
+"""Raw traffic capture for the ingest server.
+
+A capture file is a short header followed by one event per chunk of bytes
+that crossed a device socket:
+
+    MAGIC
+    repeated: EVENT_HEADER (time, session, kind, length) + payload
+
+time is the wall-clock time in seconds, session numbers the connections
+seen by one writer, and kind is one of EVENT_OPEN (payload: peer address),
+EVENT_IN (device -> server), EVENT_OUT (server -> device) or EVENT_CLOSE.
+Files ending in .gz are gzip-compressed. replay.py reads them back.
+
+The server enables capturing when FMB_CAPTURE_DIR is set; each process
+writes its own file there so cron-spawned servers never share one.
+"""
+import gzip
+import itertools
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'FMBCAP\x01\n'
+EVENT_HEADER = struct.Struct('>dIBI')
+EVENT_OPEN, EVENT_IN, EVENT_OUT, EVENT_CLOSE = 0, 1, 2, 3
+EVENT_NAMES = {EVENT_OPEN: 'open', EVENT_IN: 'in', EVENT_OUT: 'out', EVENT_CLOSE: 'close'}
+
+
+def _open(path, mode):
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+
+class CaptureWriter:
+    """Append capture events to path; safe to share between threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = _open(path, 'wb')
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._sessions = itertools.count(1)
+
+    @classmethod
+    def from_env(cls, prefix):
+        """A writer in $FMB_CAPTURE_DIR named after prefix, the start time and the pid, or None."""
+        capture_dir = os.environ.get('FMB_CAPTURE_DIR')
+        if not capture_dir:
+            return None
+        os.makedirs(capture_dir, exist_ok=True)
+        suffix = '.fmbcap.gz' if os.environ.get('FMB_CAPTURE_GZIP', '').lower() in ('1', 'true', 'yes') else '.fmbcap'
+        name = f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}{suffix}"
+        return cls(os.path.join(capture_dir, name))
+
+    def record(self, session, kind, payload=b''):
+        header = EVENT_HEADER.pack(time.time(), session, kind, len(payload))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(header + payload)
+
+    def open_session(self, addr):
+        session = next(self._sessions)
+        self.record(session, EVENT_OPEN, f'{addr[0]}:{addr[1]}'.encode() if isinstance(addr, tuple) else str(addr).encode())
+        return session
+
+    def close_session(self, session):
+        self.record(session, EVENT_CLOSE)
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def wrap(self, conn, addr):
+        """Return conn wrapped so every recv/send on it is recorded."""
+        return CapturingSocket(conn, self, self.open_session(addr))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CapturingSocket:
+    """Socket proxy that records recv'd and sent bytes; everything else is delegated."""
+
+    def __init__(self, conn, writer, session):
+        self._conn = conn
+        self._writer = writer
+        self.session = session
+        self._closed = False
+
+    def recv(self, bufsize, *flags):
+        data = self._conn.recv(bufsize, *flags)
+        if data:
+            self._writer.record(self.session, EVENT_IN, data)
+        return data
+
+    def sendall(self, data, *flags):
+        self._conn.sendall(data, *flags)
+        self._writer.record(self.session, EVENT_OUT, bytes(data))
+
+    def send(self, data, *flags):
+        sent = self._conn.send(data, *flags)
+        self._writer.record(self.session, EVENT_OUT, bytes(data[:sent]))
+        return sent
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._writer.close_session(self.session)
+        self._conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def read_capture(path):
+    """Yield (time, session, kind, payload) for every event in a capture file."""
+    with _open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: not a capture file")
+        while True:
+            header = f.read(EVENT_HEADER.size)
+            if len(header) < EVENT_HEADER.size:
+                return  # A writer killed mid-event leaves a truncated tail
+            timestamp, session, kind, length = EVENT_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield timestamp, session, kind, payload
+
+
+def load_sessions(path):
+    """Group a capture into {session: {'addr', 'events': [(time, kind, payload)]}} in file order."""
+    sessions = {}
+    for timestamp, session, kind, payload in read_capture(path):
+        entry = sessions.setdefault(session, {'addr': None, 'events': []})
+        if kind == EVENT_OPEN:
+            entry['addr'] = payload.decode(errors='replace')
+        entry['events'].append((timestamp, kind, payload))
+    return sessions
+
+
+def split_frames(stream):
+    """Split the device->server byte stream of one session into (imei, frames, trailing_bytes).
+
+    The stream starts with the IMEI handshake (2-byte length + IMEI); every
+    later frame is preamble + 4-byte length + data field + 4-byte CRC.
+    """
+    if len(stream) < 2:
+        return None, [], stream
+    imei_length = struct.unpack('>H', stream[:2])[0]
+    if len(stream) < 2 + imei_length:
+        return None, [], stream
+    imei = stream[2:2 + imei_length].decode('ascii', errors='ignore').strip('\0')
+    frames = []
+    offset = 2 + imei_length
+    while len(stream) - offset >= 8:
+        length = struct.unpack('>I', stream[offset + 4:offset + 8])[0]
+        end = offset + 8 + length + 4
+        if end > len(stream):
+            break
+        frames.append(stream[offset:end])
+        offset = end
+    return imei, frames, stream[offset:]
@@ -0,0 +1,84 @@
+"""Recent-window de-duplication of AVL records resent by devices.
+
+A unit that does not get a valid ACK keeps its records and sends them again
+with the next connection, so the same records can reach the ingest servers
+several times. RecentRecords remembers the keys of the last WINDOW records forwarded per
+IMEI and drops later copies of them; the device is still ACKed for the
+whole frame. Records are only remembered once the API took them, so two
+copies in flight at once (a UDP resend during a slow forward) are both
+forwarded and the API keeps one. The window only covers one
+process's lifetime, so the API's unique index on gps_data (imei, timestamp,
+priority, latitude, longitude, io_digest) is the persistent backstop.
+
+Timestamps are forwarded with one-second resolution and units log several
+event records within the same second (often without a fix), so the key
+also carries io_digest(), a CRC-32 of the record's IO elements. io_filter
+trims io_data before forwarding, so forwarded records carry the digest of
+the untrimmed elements as 'io_digest' and the API keys on that instead.
+"""
+import collections
+import os
+import threading
+import zlib
+
+WINDOW = int(os.environ.get('FMB_DEDUP_WINDOW', 2048))  # Record keys remembered per IMEI; 0 disables the window
+
+
+def io_digest(record):
+    """CRC-32 of "io_id:io_value" pairs joined by commas, in frame order; api.php computes the same."""
+    return zlib.crc32(','.join(f"{io['io_id']}:{io['io_value']}" for io in record.get('io_data', ())).encode('ascii'))
+
+
+def record_io_digest(record):
+    """The digest a forwarded record was sent with, else io_digest() of its IO elements (api.php does the same)."""
+    digest = record.get('io_digest')
+    return io_digest(record) if digest is None else digest
+
+
+def record_key(record):
+    """(timestamp, priority, position, IO digest) of a decoded record; position in 1e-7 degree units."""
+    return (record['timestamp'], record['priority'],
+            round(record['latitude'] * 10000000), round(record['longitude'] * 10000000), io_digest(record))
+
+
+class RecentRecords:
+    """Per-IMEI set of recently forwarded record keys, bounded to `window` keys each; thread-safe."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.seen = {}  # imei -> (set of keys, deque of the same keys in arrival order)
+
+    def unseen(self, imei, records):
+        """Return the records not forwarded before for this IMEI (first copy wins within a batch).
+
+        Nothing is remembered here: call remember() once the records are
+        forwarded, so a batch that fails for any reason is not dropped on resend.
+        """
+        if self.window <= 0:
+            return records
+        fresh = []
+        batch = set()
+        with self.lock:
+            keys = self.seen.get(imei, (set(),))[0]
+            for record in records:
+                key = record_key(record)
+                if key in keys or key in batch:
+                    continue
+                batch.add(key)
+                fresh.append(record)
+        return fresh
+
+    def remember(self, imei, records):
+        """Record forwarded records, so later copies of them are dropped by unseen()."""
+        if self.window <= 0:
+            return
+        with self.lock:
+            keys, order = self.seen.setdefault(imei, (set(), collections.deque()))
+            for record in records:
+                key = record_key(record)
+                if key not in keys:
+                    keys.add(key)
+                    order.append(key)
+            while len(order) > self.window:
+                keys.discard(order.popleft())
@@ -0,0 +1,486 @@
+"""Teltonika codec helpers shared by the ingest server, tools and benchmarks.
+
+Codec 8, 8E and 16 AVL decoding and encoding (one precompiled layout per
+codec, dispatched on the codec id), Codec 12/13/14 command framing, the UDP
+channel framing and the CRC-16/IBM used by all of them. tcp_server_v8
+imports these instead of carrying its own copies.
+"""
+import calendar
+import logging
+import struct
+from datetime import datetime, timezone
+import crcmod
+from log_setup import log_packet
+
+crc16 = crcmod.mkCrcFun(0x18005, initCrc=0x0000, rev=True)  # Updated to old script's CRC config
+
+def verify_crc(data, expected_crc):
+    calculated_crc = crc16(data)
+    return calculated_crc == expected_crc
+
+def parse_timestamp(data, offset, length=8):
+    try:
+        if len(data[offset:offset+length]) != length:
+            log_packet(logging.ERROR, "Insufficient data for timestamp at offset %d, length %d", data, offset, length)
+            return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        timestamp_ms = int.from_bytes(data[offset:offset+length], byteorder='big')
+        if not isinstance(timestamp_ms, int):
+            logging.error("timestamp_ms is not an integer: %s %s", type(timestamp_ms), timestamp_ms)
+            return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        timestamp_s = timestamp_ms / 1000.0
+        epoch_start = 0
+        epoch_end = 2147483647
+        if timestamp_s < epoch_start or timestamp_s > epoch_end:
+            log_packet(logging.ERROR, "Invalid timestamp_ms: %d (seconds: %s)", data, timestamp_ms, timestamp_s)
+            return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = datetime.fromtimestamp(timestamp_s, tz=timezone.utc)
+        formatted_timestamp = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        logging.debug("Parsed timestamp: %s from %dms", formatted_timestamp, timestamp_ms)
+        return formatted_timestamp
+    except Exception as e:
+        log_packet(logging.ERROR, "Failed to parse timestamp at offset %d: %s", data, offset, e)
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+# Command codecs: 12 (commands and responses), 13 (device -> server, timestamped), 14 (server -> device, IMEI-addressed)
+CODEC_12, CODEC_13, CODEC_14 = 0x0C, 0x0D, 0x0E
+COMMAND_CODECS = (CODEC_12, CODEC_13, CODEC_14)
+TYPE_COMMAND, TYPE_RESPONSE, TYPE_NACK = 0x05, 0x06, 0x11  # TYPE_NACK: Codec 14 IMEI mismatch
+COMMAND_HEADER = struct.Struct('>IIBBBI')  # preamble, data length, codec id, quantity 1, type, command size
+
+
+def build_command_packet(command, codec_id=CODEC_12, imei=None):
+    """Codec 12 command frame, or Codec 14 when imei is given (the device nACKs it unless the IMEI is its own)."""
+    payload = command.encode('ascii')
+    if codec_id == CODEC_14:
+        if not imei or not imei.isdigit() or len(imei) > 16:
+            raise ValueError(f"Codec 14 needs a numeric IMEI, got {imei!r}")
+        payload = bytes.fromhex(imei.zfill(16)) + payload  # 8 bytes, the IMEI's digits as hex nibbles
+    elif codec_id != CODEC_12:
+        raise ValueError(f"Commands are sent with Codec 12 or 14, not {codec_id:#04x}")
+    data_field = struct.pack('>BBBI', codec_id, 0x01, TYPE_COMMAND, len(payload)) + payload + struct.pack('>B', 0x01)
+    crc = crc16(data_field)
+    return struct.pack('>I', 0) + struct.pack('>I', len(data_field)) + data_field + struct.pack('>I', crc)
+
+
+def build_codec12_packet(command):
+    return build_command_packet(command)
+
+
+def decode_command_packet(data):
+    """Decode a Codec 12/13/14 frame into {'codec', 'type', 'text'}, plus 'timestamp' (13) or 'imei' (14).
+
+    Returns None, logging why, for a frame with a bad preamble or codec, a
+    length that disagrees with the bytes received, or a quantity mismatch.
+    """
+    if len(data) < COMMAND_HEADER.size + 5:
+        log_packet(logging.ERROR, "Command frame too short: %d bytes", data, len(data))
+        return None
+    preamble, data_length, codec_id, quantity, packet_type, size = COMMAND_HEADER.unpack_from(data)
+    if preamble != 0 or codec_id not in COMMAND_CODECS:
+        log_packet(logging.ERROR, "Not a command frame (preamble %d, codec %#04x)", data, preamble, codec_id)
+        return None
+    end = COMMAND_HEADER.size + size
+    if data_length != 8 + size or len(data) < end + 5:
+        log_packet(logging.ERROR, "Command frame length mismatch: data length %d, size %d, %d bytes received",
+                   data, data_length, size, len(data))
+        return None
+    if data[end] != quantity:
+        log_packet(logging.ERROR, "Command frame quantity mismatch: %d != %d", data, quantity, data[end])
+        return None
+    payload = data[COMMAND_HEADER.size:end]
+    packet = {'codec': codec_id, 'type': packet_type}
+    if codec_id == CODEC_13 and len(payload) >= 4:
+        packet['timestamp'] = struct.unpack_from('>I', payload)[0]
+        payload = payload[4:]
+    elif codec_id == CODEC_14 and len(payload) >= 8:
+        packet['imei'] = payload[:8].hex().lstrip('0')
+        payload = payload[8:]
+    packet['text'] = payload.decode('utf-8', errors='replace')
+    return packet
+
+
+def parse_codec12_response(data):
+    """Response text of a Codec 12, 13 or 14 frame from a device, or None."""
+    packet = decode_command_packet(data)
+    if packet is None:
+        return None
+    if packet['type'] == TYPE_NACK:
+        logging.error("Device rejected Codec 14 command for IMEI %s", packet.get('imei'))
+        return None
+    logging.info("Command response parsed: %s", packet['text'])
+    return packet['text']
+
+
+IO_VALUE_FORMATS = ((1, '>B'), (2, '>H'), (4, '>I'), (8, '>Q'))
+IO_SIZES = (1, 2, 4, 8)
+MAX_TIMESTAMP_MS = 2147483647 * 1000  # parse_timestamp's accepted range, in milliseconds
+
+# AVL codec registry: struct code of IO ids, struct code of IO counts (and of the total after the
+# event IO id), whether NX (variable length) elements exist, whether a generation type follows the event IO id
+AVL_LAYOUTS = {
+    0x08: ('B', 'B', False, False),  # Codec 8
+    0x8E: ('H', 'H', True, False),  # Codec 8 Extended
+    0x10: ('H', 'B', False, True),  # Codec 16
+}
+AVL_HEADER = struct.Struct('>IIBB')  # preamble, data length, codec id, N1
+AVL_RECORD = struct.Struct('>QBiiHHBH')  # timestamp ms, priority, longitude, latitude, altitude, angle, satellites, speed
+AVL_TRAILER = struct.Struct('>BI')  # N2, CRC
+_NX_HEADER = struct.Struct('>HH')
+
+
+class FrameError(ValueError):
+    """A frame that is truncated, inconsistent or otherwise cannot be decoded."""
+
+
+class _AvlCodec:
+    """One AVL codec's precompiled structs; built once per entry of AVL_LAYOUTS."""
+
+    def __init__(self, codec_id):
+        id_code, count_code, has_nx, has_generation = AVL_LAYOUTS[codec_id]
+        self.codec_id = codec_id
+        self.id_code = id_code
+        self.has_nx = has_nx
+        self.has_generation = has_generation
+        # Event IO id, [generation type,] total IO count
+        self.event = struct.Struct(f">{id_code}{'B' if has_generation else ''}{count_code}")
+        self.count = struct.Struct(f'>{count_code}')
+        self.elements = tuple((size, struct.Struct(f'>{id_code}{fmt[1]}')) for size, fmt in IO_VALUE_FORMATS)
+        self.element_structs = dict(self.elements)
+        self.max_id = (1 << (8 * struct.calcsize(id_code))) - 1
+        self.max_count = (1 << (8 * self.count.size)) - 1
+        # Smallest possible record: timestamp, priority, GPS element, event header and every IO count
+        self.min_record_size = AVL_RECORD.size + self.event.size + (5 if has_nx else 4) * self.count.size
+
+    def decode_records(self, data, offset, limit, number_of_data, keep_layout, schema=None):
+        """Records between offset and limit (where N2 starts); raises FrameError on overrun."""
+        unpack_record = AVL_RECORD.unpack_from
+        unpack_event = self.event.unpack_from
+        unpack_count = self.count.unpack_from
+        event_size = self.event.size
+        count_size = self.count.size
+        elements = self.elements
+        has_generation = self.has_generation
+        records = []
+        for index in range(number_of_data):
+            if offset + AVL_RECORD.size > limit:
+                raise FrameError(f"record {index + 1}: insufficient data for timestamp and GPS")
+            timestamp_ms, priority, longitude, latitude, altitude, angle, satellites, speed = unpack_record(data, offset)
+            if 0 <= timestamp_ms <= MAX_TIMESTAMP_MS:
+                timestamp = datetime.fromtimestamp(timestamp_ms / 1000.0, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            else:
+                timestamp = parse_timestamp(data, offset)  # Logs it and falls back to the current time
+            offset += AVL_RECORD.size
+            io_data = []
+            record = {
+                'timestamp': timestamp,
+                'latitude': latitude / 10000000.0,
+                'longitude': longitude / 10000000.0,
+                'altitude': altitude,
+                'speed': speed,
+                'angle': angle,
+                'satellites': satellites,
+                'priority': priority,
+                'io_data': io_data
+            }
+
+            if offset + event_size + count_size > limit:
+                raise FrameError(f"record {index + 1}: insufficient data for IO header")
+            event = unpack_event(data, offset)
+            offset += event_size
+            if keep_layout:
+                record['timestamp_ms'] = timestamp_ms
+                record['event_io_id'] = event[0]
+                if has_generation:
+                    record['generation_type'] = event[1]
+
+            for size, element_struct in elements:
+                if offset + count_size > limit:
+                    raise FrameError(f"record {index + 1}: insufficient data for {size}-byte IO count")
+                io_count = unpack_count(data, offset)[0]
+                offset += count_size
+                end = offset + io_count * element_struct.size
+                if end > limit:
+                    raise FrameError(f"record {index + 1}: insufficient data for {io_count} {size}-byte IO elements")
+                if schema is not None:
+                    _append_typed(io_data, element_struct.iter_unpack(data[offset:end]), schema, size,
+                                  {'size': size} if keep_layout else None)
+                elif keep_layout:
+                    io_data.extend({'io_id': io_id, 'io_value': io_value, 'size': size}
+                                   for io_id, io_value in element_struct.iter_unpack(data[offset:end]))
+                else:
+                    io_data.extend({'io_id': io_id, 'io_value': io_value}
+                                   for io_id, io_value in element_struct.iter_unpack(data[offset:end]))
+                offset = end
+
+            if self.has_nx:
+                offset = self._decode_nx(data, offset, limit, index, io_data, keep_layout, schema)
+            records.append(record)
+        return records
+
+    def _decode_nx(self, data, offset, limit, index, io_data, keep_layout, schema):
+        count_size = self.count.size
+        if offset + count_size > limit:
+            raise FrameError(f"record {index + 1}: insufficient data for X-byte IO count")
+        io_count_xb = self.count.unpack_from(data, offset)[0]
+        offset += count_size
+        for _ in range(io_count_xb):
+            if offset + _NX_HEADER.size > limit:
+                raise FrameError(f"record {index + 1}: insufficient data for X-byte IO")
+            io_id, io_length = _NX_HEADER.unpack_from(data, offset)
+            offset += _NX_HEADER.size
+            if offset + io_length > limit:
+                raise FrameError(f"record {index + 1}: insufficient data for X-byte IO value (length {io_length})")
+            io_value = int.from_bytes(data[offset:offset+io_length], byteorder='big')
+            offset += io_length
+            if schema is not None:
+                _append_typed(io_data, ((io_id, io_value),), schema, io_length,
+                              {'size': 'x', 'length': io_length} if keep_layout else None)
+            elif keep_layout:
+                io_data.append({'io_id': io_id, 'io_value': io_value, 'size': 'x', 'length': io_length})
+            else:
+                io_data.append({'io_id': io_id, 'io_value': io_value})
+        return offset
+
+
+def _append_typed(io_data, elements, schema, width, layout):
+    """Append (io_id, raw value) pairs of width bytes as elements typed by an io_schema.IoSchema.
+
+    Known ids gain 'name' and 'value' (sign-extended, then scaled); unknown
+    ids pass through raw, or are dropped when the schema filters them.
+    layout holds the keep_layout fields of every element, or is None.
+    """
+    table = schema.table
+    skip_unknown = schema.skip_unknown
+    wrap = 1 << (8 * width)
+    half = (wrap >> 1) or wrap  # A zero-length NX value is 0, never negative
+    for io_id, raw in elements:
+        spec = table[io_id]
+        if spec is None:
+            if skip_unknown:
+                continue
+            element = {'io_id': io_id, 'io_value': raw}
+        else:
+            name, signed, numerator, denominator = spec
+            value = raw - wrap if signed and raw >= half else raw
+            if denominator != 1:
+                value = value * numerator / denominator
+            elif numerator != 1:
+                value *= numerator
+            element = {'io_id': io_id, 'io_value': raw, 'name': name, 'value': value}
+        if layout:
+            element.update(layout)
+        io_data.append(element)
+
+
+AVL_CODECS = {codec_id: _AvlCodec(codec_id) for codec_id in AVL_LAYOUTS}
+# Smallest possible Codec 8E record, kept for callers sizing test frames
+MIN_RECORD_SIZE_8E = AVL_CODECS[0x8E].min_record_size
+
+
+def decode_avl_packet(data, imei, keep_layout=False, schema=None):
+    """Decode a Codec 8, 8E or 16 AVL frame into record dicts.
+
+    Returns (number_of_data, records). number_of_data is 0 (and nothing
+    should be ACKed or stored) when the frame is rejected: bad preamble,
+    a codec missing from AVL_CODECS, a length field that disagrees with the
+    bytes received, a record count that cannot fit, N1 != N2, or a record
+    running past the data field. Never raises for bytes input, and rejects
+    in time linear in len(data), so junk traffic cannot stall the ingest loop.
+
+    keep_layout=True also keeps what encode_avl_packet() needs to rebuild
+    the frame byte for byte: each record's timestamp_ms and event_io_id
+    (and generation_type for Codec 16), and each IO element's size (1, 2,
+    4, 8, or 'x' for NX elements).
+
+    schema, an io_schema.IoSchema (usually io_schema.load().for_imei(imei)),
+    adds each known element's 'name' and typed 'value' next to the raw
+    'io_value', and drops unknown ids when the schema filters them (a
+    filtered frame no longer re-encodes byte for byte).
+    """
+    try:
+        return _decode_avl_frame(data, imei, keep_layout, schema)
+    except FrameError as e:
+        log_packet(logging.WARNING, "Rejected AVL frame for IMEI %s: %s", data, imei, e, extra={'imei': imei})
+        return 0, []
+
+
+def _decode_avl_frame(data, imei, keep_layout, schema):
+    if len(data) < 15:
+        raise FrameError(f"frame too short ({len(data)} bytes)")
+    preamble, data_length, codec_id, number_of_data = AVL_HEADER.unpack_from(data)
+    if preamble != 0:
+        log_packet(logging.WARNING, "Invalid preamble: %s", data, data[:4].hex())
+        return 0, []
+    logging.debug("data_length:%d", data_length)
+    if data_length < 3 or len(data) < 8 + data_length + 4:
+        raise FrameError(f"data length {data_length} does not match {len(data)} bytes received")
+    codec = AVL_CODECS.get(codec_id)
+    if codec is None:
+        logging.warning("Unsupported codec ID: %d, codec ID_HEX: %#04x", codec_id, codec_id, extra={'imei': imei, 'codec': codec_id})
+        return 0, []
+    offset = AVL_HEADER.size
+    # Records end where the trailing N2 byte starts
+    limit = 8 + data_length - 1
+    number_of_data_end = data[limit]
+    if number_of_data != number_of_data_end:
+        raise FrameError(f"number of data mismatch: start={number_of_data}, end={number_of_data_end}")
+    if number_of_data * codec.min_record_size > limit - offset:
+        raise FrameError(f"{number_of_data} records cannot fit in {limit - offset} bytes")
+
+    logging.debug("Parsing %d records for IMEI: %s, codec: %d", number_of_data, imei, codec_id,
+                  extra={'imei': imei, 'codec': codec_id, 'records': number_of_data})
+
+    # Verify CRC
+    """ crc = struct.unpack('>I', data[-4:])[0]
+    if not verify_crc(data[4:-4], crc):
+        logging.error(f"CRC check failed, packet: {data.hex()}")
+        return 0, [] """
+    return number_of_data, codec.decode_records(data, offset, limit, number_of_data, keep_layout, schema)
+
+
+def _record_timestamp_ms(record):
+    if 'timestamp_ms' in record:
+        return record['timestamp_ms']
+    return calendar.timegm(datetime.strptime(record['timestamp'], '%Y-%m-%d %H:%M:%S').timetuple()) * 1000
+
+
+def _io_size(element, has_nx):
+    """Value size of an IO element: its recorded 'size', else the smallest that holds the value."""
+    size = element.get('size')
+    if size is not None:
+        return size
+    value = element['io_value']
+    for candidate in IO_SIZES:
+        if value < 1 << (8 * candidate):
+            return candidate
+    if not has_nx:
+        raise ValueError(f"IO {element['io_id']}: value does not fit in 8 bytes")
+    return 'x'
+
+
+def _group_io(record, codec):
+    groups = {1: [], 2: [], 4: [], 8: [], 'x': []}
+    for element in record.get('io_data', ()):
+        if element['io_id'] > codec.max_id:
+            raise ValueError(f"IO {element['io_id']}: id does not fit codec {codec.codec_id:#04x}'s IO ids")
+        size = _io_size(element, codec.has_nx)
+        if size == 'x' and not codec.has_nx:
+            raise ValueError(f"IO {element['io_id']}: NX elements need Codec 8E")
+        groups[size].append(element)
+    if sum(len(elements) for elements in groups.values()) > codec.max_count:
+        raise ValueError(f"More than {codec.max_count} IO elements in one codec {codec.codec_id:#04x} record")
+    return groups
+
+
+def encode_avl_packet(records, codec_id=0x8E):
+    """Build a Codec 8, 8E or 16 AVL frame from record dicts (the inverse of decode_avl_packet).
+
+    Records take the decoder's shape. With keep_layout-style fields
+    (timestamp_ms, event_io_id, generation_type, per-element size/length)
+    the original frame is reproduced exactly; without them the timestamp is
+    parsed from 'timestamp' and each IO value gets the smallest size that
+    holds it, so decoding the result lists IO elements grouped by that size.
+    Raises ValueError for records the codec cannot carry.
+    """
+    codec = AVL_CODECS.get(codec_id)
+    if codec is None:
+        raise ValueError(f"Unsupported codec for encoding: {codec_id:#04x}")
+    if len(records) > 255:
+        raise ValueError("At most 255 records fit in one frame")
+    count_struct, event_struct, element_structs = codec.count, codec.event, codec.element_structs
+    count_size = count_struct.size
+
+    grouped = [_group_io(record, codec) for record in records]
+    # One pass to size the frame, so the packing below writes into a single preallocated buffer
+    length = AVL_HEADER.size + AVL_TRAILER.size
+    for groups in grouped:
+        length += AVL_RECORD.size + event_struct.size + 4 * count_size
+        length += sum(len(groups[size]) * element_structs[size].size for size in IO_SIZES)
+        if codec.has_nx:
+            length += count_size + sum(_NX_HEADER.size + element.get('length', _nx_length(element))
+                              for element in groups['x'])
+    buffer = bytearray(length)
+
+    offset = AVL_HEADER.size
+    try:
+        for record, groups in zip(records, grouped):
+            AVL_RECORD.pack_into(buffer, offset, _record_timestamp_ms(record), record.get('priority', 0),
+                                 round(record['longitude'] * 10000000), round(record['latitude'] * 10000000),
+                                 record.get('altitude', 0), record.get('angle', 0), record.get('satellites', 0),
+                                 record.get('speed', 0))
+            offset += AVL_RECORD.size
+            total = sum(len(elements) for elements in groups.values())
+            if codec.has_generation:
+                # Generation type 7 is "periodical", for records that were not triggered by an event
+                event_struct.pack_into(buffer, offset, record.get('event_io_id', 0), record.get('generation_type', 7), total)
+            else:
+                event_struct.pack_into(buffer, offset, record.get('event_io_id', 0), total)
+            offset += event_struct.size
+            for size in IO_SIZES:
+                elements = groups[size]
+                count_struct.pack_into(buffer, offset, len(elements))
+                offset += count_size
+                element_struct = element_structs[size]
+                for element in elements:
+                    element_struct.pack_into(buffer, offset, element['io_id'], element['io_value'])
+                    offset += element_struct.size
+            if codec.has_nx:
+                count_struct.pack_into(buffer, offset, len(groups['x']))
+                offset += count_size
+                for element in groups['x']:
+                    value_length = element.get('length', _nx_length(element))
+                    _NX_HEADER.pack_into(buffer, offset, element['io_id'], value_length)
+                    offset += _NX_HEADER.size
+                    buffer[offset:offset+value_length] = element['io_value'].to_bytes(value_length, byteorder='big')
+                    offset += value_length
+    except (struct.error, OverflowError) as e:
+        raise ValueError(f"Record field out of range for codec {codec_id:#04x}: {e}") from e
+
+    AVL_HEADER.pack_into(buffer, 0, 0, length - 12, codec_id, len(records))
+    buffer[offset] = len(records)
+    struct.pack_into('>I', buffer, offset + 1, crc16(memoryview(buffer)[8:offset+1]))
+    return bytes(buffer)
+
+
+def _nx_length(element):
+    return max(1, (element['io_value'].bit_length() + 7) // 8)
+
+
+# UDP transport: no preamble or CRC; each datagram carries its own headers and gets one ACK
+UDP_HEADER = struct.Struct('>HHBBH')  # length, packet id, not usable byte (0x01), AVL packet id, IMEI length
+UDP_ACK = struct.Struct('>HHBBB')  # length (5), packet id, not usable byte, AVL packet id, accepted records
+
+
+def decode_udp_packet(datagram):
+    """Split a UDP AVL datagram into (packet_id, avl_packet_id, imei, frame).
+
+    frame is the datagram's AVL data (codec id through N2) wrapped as a TCP
+    frame, preamble, data length and CRC included, so decode_avl_packet()
+    serves both transports. Raises FrameError for a malformed header.
+    """
+    if len(datagram) < UDP_HEADER.size:
+        raise FrameError(f"datagram too short ({len(datagram)} bytes)")
+    length, packet_id, _, avl_packet_id, imei_length = UDP_HEADER.unpack_from(datagram)
+    if length != len(datagram) - 2:
+        raise FrameError(f"length field {length} does not match {len(datagram)} bytes received")
+    if imei_length < 1 or imei_length > 17:
+        raise FrameError(f"invalid IMEI length: {imei_length}")
+    offset = UDP_HEADER.size + imei_length
+    if len(datagram) < offset + 3:
+        raise FrameError("no AVL data after the IMEI")
+    imei = datagram[UDP_HEADER.size:offset].decode('ascii', errors='ignore').strip('\0')
+    avl_data = datagram[offset:]
+    frame = struct.pack('>II', 0, len(avl_data)) + avl_data + struct.pack('>I', crc16(avl_data))
+    return packet_id, avl_packet_id, imei, frame
+
+
+def encode_udp_packet(frame, imei, packet_id=0, avl_packet_id=0):
+    """Carry an AVL frame from encode_avl_packet() in a UDP datagram (the inverse of decode_udp_packet)."""
+    imei_bytes = imei.encode('ascii')
+    avl_data = frame[8:-4]
+    length = UDP_HEADER.size - 2 + len(imei_bytes) + len(avl_data)
+    return UDP_HEADER.pack(length, packet_id, 0x01, avl_packet_id, len(imei_bytes)) + imei_bytes + avl_data
+
+
+def build_udp_ack(packet_id, avl_packet_id, accepted):
+    return UDP_ACK.pack(UDP_ACK.size - 2, packet_id, 0x01, avl_packet_id, accepted)
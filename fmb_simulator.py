@@ -0,0 +1,324 @@
+"""FMB920 device simulator and load generator for the TCP ingest server.
+
+Spawns N virtual devices on one asyncio loop. Each device performs the IMEI
+handshake, uploads Codec 8E batches on an interval, waits for the record ACK
+and answers any Codec 12 command it receives in the meantime, like a real
+unit. Latencies are collected per stage and printed as percentiles. With
+--udp the devices send each batch as a UDP datagram to udp_server instead
+and wait for its ACK frame.
+
+    python fmb_simulator.py --devices 2000 --records 5 --interval 10 --duration 120
+    python fmb_simulator.py --devices 1 --batches 1 --io 66:2,179:1,239:1
+    python fmb_simulator.py --udp --devices 5000 --interval 5
+
+AVL frames come from fmb_codec.encode_avl_packet, the codec library the
+server decodes with, not from the server module itself.
+"""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+
+from fmb_codec import UDP_ACK, crc16, encode_avl_packet, encode_udp_packet
+
+DEFAULT_IO_SET = '239:1,240:1,21:1,69:1,179:1,66:2,67:2,68:2,24:2,16:4'
+IMEI_BASE = 350317170000000
+BASE_POSITION = (14.6928, -17.4467)  # Dakar depot
+COMMAND_REPLIES = {
+    'getver': 'Ver:03.28.07_04 GPS:AXN_5.10_3333 Hw:FMB920 Mod:14',
+    'getstatus': 'Data Link: 1 GPRS: 1 Phone: 0 SIM: 0 OpCode: 60802 Signal: 5 NewSMS: 0 Roaming: 0 SMSFull: 0',
+}
+
+
+def parse_io_set(spec):
+    """'66:2,179:1' -> [(66, 2), (179, 1)]"""
+    io_set = []
+    for item in spec.split(','):
+        io_id, size = item.split(':')
+        if int(size) not in (1, 2, 4, 8):
+            raise ValueError(f"IO {io_id}: size must be 1, 2, 4 or 8 bytes")
+        io_set.append((int(io_id), int(size)))
+    return io_set
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {'connect': [], 'handshake': [], 'ack': [], 'command': []}
+        self.errors = {}
+        self.records_acked = 0
+        self.batches_acked = 0
+        self.commands_answered = 0
+        self.started = time.perf_counter()
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        summary = {
+            'elapsed_s': round(elapsed, 3),
+            'batches_acked': self.batches_acked,
+            'records_acked': self.records_acked,
+            'records_per_s': round(self.records_acked / elapsed, 1) if elapsed else 0.0,
+            'commands_answered': self.commands_answered,
+            'errors': self.errors,
+            'latency_ms': {},
+        }
+        for name, values in self.latencies.items():
+            summary['latency_ms'][name] = {
+                'count': len(values),
+                'p50': round(percentile(values, 50) * 1000, 2),
+                'p90': round(percentile(values, 90) * 1000, 2),
+                'p99': round(percentile(values, 99) * 1000, 2),
+                'max': round(max(values) * 1000, 2) if values else 0.0,
+            }
+        return summary
+
+
+class UdpClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.datagrams = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.datagrams.put_nowait(data)
+
+
+class VirtualDevice:
+    def __init__(self, index, args, io_set, stats):
+        self.imei = str(args.imei_base + index)
+        self.args = args
+        self.io_set = io_set
+        self.stats = stats
+        self.rng = random.Random(index)
+        self.latitude = BASE_POSITION[0] + self.rng.uniform(-0.05, 0.05)
+        self.longitude = BASE_POSITION[1] + self.rng.uniform(-0.05, 0.05)
+        self.dout1 = 0
+        self.external_voltage = 13800
+        self.packet_id = self.rng.randrange(0x10000)
+
+    def io_value(self, io_id, size):
+        if io_id == 66:  # External voltage (mV); occasionally drop to simulate a power cut
+            if self.rng.random() < 0.02:
+                self.external_voltage = 0 if self.external_voltage else 13800
+            return self.external_voltage + (self.rng.randint(-150, 150) if self.external_voltage else 0)
+        if io_id == 179:
+            return self.dout1
+        if io_id in (239, 240, 69):
+            return 1
+        if io_id == 21:
+            return self.rng.randint(1, 5)
+        return self.rng.getrandbits(8 * size - 1)
+
+    def build_record(self, timestamp_ms):
+        self.latitude += self.rng.uniform(-0.0005, 0.0005)
+        self.longitude += self.rng.uniform(-0.0005, 0.0005)
+        return {
+            'timestamp_ms': timestamp_ms,
+            'priority': 0,
+            'latitude': round(self.latitude, 7),
+            'longitude': round(self.longitude, 7),
+            'altitude': self.rng.randint(0, 60),
+            'angle': self.rng.randint(0, 359),
+            'satellites': self.rng.randint(6, 14),
+            'speed': self.rng.randint(0, 90),
+            'io_data': [{'io_id': io_id, 'io_value': self.io_value(io_id, size), 'size': size}
+                        for io_id, size in self.io_set],
+        }
+
+    def build_avl_packet(self):
+        count = self.args.records
+        now_ms = int(time.time() * 1000)
+        return encode_avl_packet([self.build_record(now_ms - (count - i) * 1000) for i in range(count)])
+
+    def reply_to(self, command):
+        parts = command.split()
+        name = parts[0] if parts else ''
+        if name == 'setdigout':
+            wanted = 1 if len(parts) > 1 and parts[1].startswith('1') else 0
+            if wanted == self.dout1:
+                return f'DOUT1:Already set to {wanted}'
+            self.dout1 = wanted
+            return f'DOUT1:{wanted} Timeout:INFINITY'
+        return COMMAND_REPLIES.get(name, 'unknown command or invalid format')
+
+    @staticmethod
+    def build_codec12_response(text):
+        payload = text.encode('ascii')
+        data_field = struct.pack('>BBBI', 0x0C, 0x01, 0x06, len(payload)) + payload + struct.pack('>B', 0x01)
+        return struct.pack('>II', 0, len(data_field)) + data_field + struct.pack('>I', crc16(data_field))
+
+    async def answer_command(self, reader, writer):
+        """Read the rest of a Codec 12 frame whose zero preamble was already consumed, and reply."""
+        received = time.perf_counter()
+        length = struct.unpack('>I', await reader.readexactly(4))[0]
+        frame = await reader.readexactly(length + 4)
+        command = frame[7:7 + struct.unpack('>I', frame[3:7])[0]].decode('ascii', errors='ignore').strip()
+        writer.write(self.build_codec12_response(self.reply_to(command)))
+        await writer.drain()
+        self.stats.latencies['command'].append(time.perf_counter() - received)
+        self.stats.commands_answered += 1
+
+    async def connect(self):
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.args.host, self.args.port), self.args.timeout)
+        self.stats.latencies['connect'].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        imei = self.imei.encode('ascii')
+        writer.write(struct.pack('>H', len(imei)) + imei)
+        await writer.drain()
+        if await asyncio.wait_for(reader.readexactly(1), self.args.timeout) != b'\x01':
+            raise ConnectionError('IMEI rejected')
+        self.stats.latencies['handshake'].append(time.perf_counter() - started)
+        return reader, writer
+
+    async def idle(self, reader, writer, seconds):
+        """Stay connected without uploading for a while, answering any commands the server sends."""
+        deadline = time.perf_counter() + seconds
+        while (remaining := deadline - time.perf_counter()) > 0:
+            try:
+                head = await asyncio.wait_for(reader.readexactly(4), remaining)
+            except asyncio.TimeoutError:
+                return
+            if head != b'\x00\x00\x00\x00':
+                self.stats.error('unexpected_frame')
+                continue
+            await self.answer_command(reader, writer)
+
+    async def upload(self, reader, writer):
+        packet = self.build_avl_packet()
+        started = time.perf_counter()
+        writer.write(packet)
+        await writer.drain()
+        while True:
+            head = await asyncio.wait_for(reader.readexactly(4), self.args.timeout)
+            if head == b'\x00\x00\x00\x00':  # Codec 12 command interleaved before the ACK
+                await self.answer_command(reader, writer)
+                continue
+            accepted = struct.unpack('>I', head)[0]
+            self.stats.latencies['ack'].append(time.perf_counter() - started)
+            if accepted != self.args.records:
+                self.stats.error('ack_count_mismatch')
+            self.stats.records_acked += accepted
+            self.stats.batches_acked += 1
+            return
+
+    async def upload_udp(self, transport, client):
+        self.packet_id = (self.packet_id + 1) & 0xFFFF
+        avl_packet_id = self.packet_id & 0xFF
+        started = time.perf_counter()
+        transport.sendto(encode_udp_packet(self.build_avl_packet(), self.imei, self.packet_id, avl_packet_id))
+        while True:
+            data = await asyncio.wait_for(client.datagrams.get(), self.args.timeout)
+            if len(data) != UDP_ACK.size:
+                self.stats.error('unexpected_frame')
+                continue
+            _, packet_id, _, _, accepted = UDP_ACK.unpack(data)
+            if packet_id != self.packet_id:  # Late ACK for an earlier packet
+                continue
+            self.stats.latencies['ack'].append(time.perf_counter() - started)
+            if accepted != self.args.records:
+                self.stats.error('ack_count_mismatch')
+            self.stats.records_acked += accepted
+            self.stats.batches_acked += 1
+            return
+
+    async def run_udp(self, stop_at):
+        await asyncio.sleep(self.rng.uniform(0, self.args.ramp))
+        transport, client = await asyncio.get_running_loop().create_datagram_endpoint(
+            UdpClient, remote_addr=(self.args.host, self.args.port))
+        sent = 0
+        try:
+            while time.perf_counter() < stop_at and (not self.args.batches or sent < self.args.batches):
+                try:
+                    await self.upload_udp(transport, client)
+                except (asyncio.TimeoutError, OSError) as e:
+                    self.stats.error(type(e).__name__)
+                sent += 1
+                if not self.args.batches or sent < self.args.batches:
+                    await asyncio.sleep(self.args.interval * self.rng.uniform(0.9, 1.1))
+        finally:
+            transport.close()
+
+    async def run(self, stop_at):
+        await asyncio.sleep(self.rng.uniform(0, self.args.ramp))
+        sent = 0
+        reader = writer = None
+        while time.perf_counter() < stop_at and (not self.args.batches or sent < self.args.batches):
+            try:
+                if writer is None:
+                    reader, writer = await self.connect()
+                    if self.args.upload_delay:
+                        await self.idle(reader, writer, self.args.upload_delay)
+                await self.upload(reader, writer)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+                self.stats.error(type(e).__name__)
+                if writer is not None:
+                    writer.close()
+                writer = None
+            sent += 1
+            if not self.args.persistent and writer is not None:
+                writer.close()
+                writer = None
+            if not self.args.batches or sent < self.args.batches:
+                await asyncio.sleep(self.args.interval * self.rng.uniform(0.9, 1.1))
+        if writer is not None:
+            writer.close()
+
+
+async def run_simulation(args):
+    io_set = parse_io_set(args.io)
+    stats = Stats()
+    stop_at = time.perf_counter() + args.duration
+    devices = [VirtualDevice(i, args, io_set, stats) for i in range(args.devices)]
+    await asyncio.gather(*((device.run_udp if args.udp else device.run)(stop_at) for device in devices))
+    return stats.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate FMB920 devices against the TCP or UDP ingest server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50122)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--records', type=int, default=3, help='Records per AVL batch')
+    parser.add_argument('--io', default=DEFAULT_IO_SET, help='IO set as id:size pairs, e.g. 66:2,179:1')
+    parser.add_argument('--interval', type=float, default=10.0, help='Seconds between uploads per device')
+    parser.add_argument('--duration', type=float, default=60.0, help='Stop after this many seconds')
+    parser.add_argument('--batches', type=int, default=0, help='Stop each device after N batches (0 = no limit)')
+    parser.add_argument('--ramp', type=float, default=5.0, help='Spread device start-up over this many seconds')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--persistent', action='store_true',
+                        help='Keep the connection open between batches (default: reconnect per batch)')
+    parser.add_argument('--upload-delay', type=float, default=0.0,
+                        help='Seconds to wait after the handshake before uploading (commands are answered meanwhile)')
+    parser.add_argument('--udp', action='store_true', help='Send batches as UDP datagrams (udp_server)')
+    parser.add_argument('--imei-base', type=int, default=IMEI_BASE)
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args()
+
+    summary = asyncio.run(run_simulation(args))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{args.devices} devices, {summary['elapsed_s']}s: {summary['batches_acked']} batches / "
+          f"{summary['records_acked']} records acked ({summary['records_per_s']} records/s), "
+          f"{summary['commands_answered']} commands answered")
+    for name, latency in summary['latency_ms'].items():
+        print(f"  {name:<9} n={latency['count']:<7} p50={latency['p50']}ms p90={latency['p90']}ms "
+              f"p99={latency['p99']}ms max={latency['max']}ms")
+    if summary['errors']:
+        print(f"  errors: {summary['errors']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""Fuzz and property checks for the Codec 8E / Codec 12 parsers in fmb_codec.
+
+First checks that every frame in the capture corpus re-encodes to the same
+bytes (encode_avl_packet(decode_avl_packet(x, keep_layout=True)) == x).
+Then generates valid frames with an encoder independent of fmb_codec,
+checks that the decoder and fmb_codec's encoder round-trip them, then
+mutates them (bit flips, truncation, splices, tampered length and count
+fields) and feeds pure garbage, checking that the decoder:
+
+- never raises, with or without an IO schema (io_schema), and decodes the
+  same raw IO values either way,
+- either rejects a frame outright ((0, [])) or returns exactly N1 records,
+- spends time linear in the frame size (--max-us-per-byte), so junk traffic
+  cannot hold up the ingest loop. Decodes are timed with the garbage
+  collector paused, and one over budget is re-timed TIMING_REPEATS times so
+  a scheduler pause does not count as a failure.
+
+    python fuzz_codec.py                         # stdlib random mutation, 20000 cases
+    python fuzz_codec.py --engine corpus         # only the corpus round trip
+    python fuzz_codec.py --iterations 200000 --seed 7
+    python fuzz_codec.py --engine hypothesis     # needs hypothesis
+    python fuzz_codec.py --engine atheris -- -max_total_time=300   # needs atheris
+
+Failing inputs are written to --crash-dir as hex, one file per failure.
+"""
+import argparse
+import gc
+import logging
+import os
+import random
+import struct
+import sys
+import time
+from datetime import datetime, timezone
+
+import fmb_codec
+import io_schema
+
+IMEI = '350317170000000'
+SCHEMA = io_schema.load(None).default  # Built-in FMB920 dictionary
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'codec8e.hex')
+MAX_IO_PER_SIZE = 6
+DEFAULT_MAX_US_PER_BYTE = 20.0  # Generous: decoding runs at well under 1 us/byte
+TIME_FLOOR_US = 500.0  # Allowance for fixed per-call overhead and timer noise
+TIMING_REPEATS = 5  # A decode over budget is timed again this many times; the fastest run counts
+
+
+class PropertyFailure(AssertionError):
+    def __init__(self, message, data):
+        super().__init__(message)
+        self.data = data
+
+
+def random_record(rng):
+    io = {size: [(rng.randrange(1, 1000), rng.getrandbits(8 * size)) for _ in range(rng.randrange(MAX_IO_PER_SIZE))]
+          for size in (1, 2, 4, 8)}
+    nx = [(rng.randrange(1, 1000), bytes(rng.getrandbits(8) for _ in range(rng.randrange(1, 12))))
+          for _ in range(rng.randrange(3))]
+    return {
+        'timestamp_ms': rng.randrange(1_500_000_000_000, 2_000_000_000_000),
+        'priority': rng.randrange(3),
+        'longitude': rng.randrange(-1_800_000_000, 1_800_000_001),
+        'latitude': rng.randrange(-900_000_000, 900_000_001),
+        'altitude': rng.randrange(65536), 'angle': rng.randrange(360),
+        'satellites': rng.randrange(256), 'speed': rng.randrange(65536),
+        'event_io_id': rng.randrange(65536), 'io': io, 'nx': nx,
+    }
+
+
+def encode_record(record):
+    body = [struct.pack('>QBiiHHBH', record['timestamp_ms'], record['priority'], record['longitude'],
+                        record['latitude'], record['altitude'], record['angle'], record['satellites'],
+                        record['speed'])]
+    total = sum(len(elements) for elements in record['io'].values()) + len(record['nx'])
+    body.append(struct.pack('>HH', record['event_io_id'], total))
+    for size, fmt in ((1, '>HB'), (2, '>HH'), (4, '>HI'), (8, '>HQ')):
+        body.append(struct.pack('>H', len(record['io'][size])))
+        body.extend(struct.pack(fmt, io_id, value) for io_id, value in record['io'][size])
+    body.append(struct.pack('>H', len(record['nx'])))
+    body.extend(struct.pack('>HH', io_id, len(value)) + value for io_id, value in record['nx'])
+    return b''.join(body)
+
+
+def encode_frame(records):
+    data_field = bytes([0x8E, len(records)]) + b''.join(encode_record(r) for r in records) + bytes([len(records)])
+    return struct.pack('>II', 0, len(data_field)) + data_field + struct.pack('>I', fmb_codec.crc16(data_field))
+
+
+def expected_dict(record):
+    timestamp = datetime.fromtimestamp(record['timestamp_ms'] / 1000.0, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    io_data = [{'io_id': io_id, 'io_value': value} for size in (1, 2, 4, 8) for io_id, value in record['io'][size]]
+    io_data += [{'io_id': io_id, 'io_value': int.from_bytes(value, 'big')} for io_id, value in record['nx']]
+    return {
+        'timestamp': timestamp, 'latitude': record['latitude'] / 10000000.0,
+        'longitude': record['longitude'] / 10000000.0, 'altitude': record['altitude'], 'speed': record['speed'],
+        'angle': record['angle'], 'satellites': record['satellites'], 'priority': record['priority'],
+        'io_data': io_data,
+    }
+
+
+def encode_codec12_response(text):
+    payload = text.encode('ascii')
+    data_field = struct.pack('>BBBI', 0x0C, 0x01, 0x06, len(payload)) + payload + b'\x01'
+    return struct.pack('>II', 0, len(data_field)) + data_field + struct.pack('>I', fmb_codec.crc16(data_field))
+
+
+def mutate(rng, frame):
+    """One random corruption of a valid frame."""
+    data = bytearray(frame)
+    kind = rng.randrange(8)
+    if kind == 0:  # Bit flips
+        for _ in range(rng.randrange(1, 8)):
+            position = rng.randrange(len(data))
+            data[position] ^= 1 << rng.randrange(8)
+    elif kind == 1:  # Truncation
+        del data[rng.randrange(len(data)):]
+    elif kind == 2:  # Random bytes inserted
+        position = rng.randrange(len(data) + 1)
+        data[position:position] = bytes(rng.getrandbits(8) for _ in range(rng.randrange(1, 32)))
+    elif kind == 3:  # Chunk removed
+        position = rng.randrange(len(data))
+        del data[position:position + rng.randrange(1, 32)]
+    elif kind == 4 and len(data) >= 8:  # Data length field tampered
+        data[4:8] = struct.pack('>I', rng.choice((0, 1, 2, len(data), len(data) - 13, 0xFFFFFFFF, rng.getrandbits(32))))
+    elif kind == 5 and len(data) >= 10:  # N1 and/or N2 tampered
+        data[9] = rng.randrange(256)
+        if rng.random() < 0.5 and len(data) >= 5:
+            data[-5] = data[9]
+    elif kind == 6 and len(data) > 40:  # An IO count set large, keeping N1 == N2
+        position = rng.randrange(34, len(data) - 6)
+        data[position:position + 2] = struct.pack('>H', rng.choice((0xFFFF, 0x7FFF, rng.getrandbits(16))))
+    else:  # Two frames spliced
+        cut = rng.randrange(len(data))
+        data = data[:cut] + frame[rng.randrange(len(frame)):]
+    return bytes(data)
+
+
+def timed_decode(data):
+    """decode_avl_packet(data) and its wall time in microseconds, with the garbage collector paused."""
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        result = fmb_codec.decode_avl_packet(data, IMEI)
+        return result, (time.perf_counter() - started) * 1e6
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def check_decode(data, max_us_per_byte):
+    """The decoder contract for arbitrary bytes; returns the decode result."""
+    try:
+        (number_of_data, records), elapsed_us = timed_decode(data)
+    except Exception as e:
+        raise PropertyFailure(f"decode_avl_packet raised {type(e).__name__}: {e}", data) from e
+    if number_of_data and len(records) != number_of_data:
+        raise PropertyFailure(f"returned N1={number_of_data} with {len(records)} records", data)
+    if not number_of_data and records:
+        raise PropertyFailure(f"rejected frame but returned {len(records)} records", data)
+    budget_us = TIME_FLOOR_US + max_us_per_byte * len(data)
+    if elapsed_us > budget_us:
+        # One slow call is usually a scheduler pause; only a decode slow on every repeat is a real failure
+        elapsed_us = min(timed_decode(data)[1] for _ in range(TIMING_REPEATS))
+        if elapsed_us > budget_us:
+            raise PropertyFailure(f"took {elapsed_us:.0f} us for {len(data)} bytes "
+                                  f"(fastest of {TIMING_REPEATS} repeats)", data)
+    try:
+        typed = fmb_codec.decode_avl_packet(data, IMEI, schema=SCHEMA)
+    except Exception as e:
+        raise PropertyFailure(f"decode_avl_packet with an IO schema raised {type(e).__name__}: {e}", data) from e
+    raw_values = [[(io['io_id'], io['io_value']) for io in record['io_data']] for record in records]
+    if typed[0] != number_of_data or raw_values != [[(io['io_id'], io['io_value']) for io in record['io_data']]
+                                                    for record in typed[1]]:
+        raise PropertyFailure("decoding with an IO schema changed the raw IO values", data)
+    return number_of_data, records
+
+
+def check_round_trip(records, max_us_per_byte):
+    frame = encode_frame(records)
+    number_of_data, decoded = check_decode(frame, max_us_per_byte)
+    expected = [expected_dict(record) for record in records]
+    if number_of_data != len(records) or decoded != expected:
+        raise PropertyFailure(f"round trip mismatch for {len(records)} records", frame)
+    return frame
+
+
+def check_reencode(frame):
+    """fmb_codec's encoder must rebuild a valid frame byte for byte from its layout-preserving decode."""
+    _, records = fmb_codec.decode_avl_packet(frame, IMEI, keep_layout=True)
+    try:
+        encoded = fmb_codec.encode_avl_packet(records)
+    except Exception as e:
+        raise PropertyFailure(f"encode_avl_packet raised {type(e).__name__}: {e}", frame) from e
+    if encoded != frame:
+        raise PropertyFailure("re-encoded frame differs from the original", frame)
+
+
+def check_corpus():
+    with open(CORPUS_FILE) as f:
+        frames = [bytes.fromhex(line.strip()) for line in f if line.strip()]
+    for frame in frames:
+        check_reencode(frame)
+    return len(frames)
+
+
+def check_codec12(data, expected=None):
+    try:
+        response = fmb_codec.parse_codec12_response(data)
+    except Exception as e:
+        raise PropertyFailure(f"parse_codec12_response raised {type(e).__name__}: {e}", data) from e
+    if expected is not None and response != expected:
+        raise PropertyFailure(f"Codec 12 round trip returned {response!r}, expected {expected!r}", data)
+
+
+def random_text(rng):
+    return ''.join(chr(rng.randrange(32, 127)) for _ in range(rng.randrange(1, 80)))
+
+
+def run_random(args):
+    rng = random.Random(args.seed)
+    counts = {'round_trip': 0, 'mutated': 0, 'garbage': 0, 'codec12': 0, 'accepted_mutants': 0}
+    for _ in range(args.iterations):
+        records = [random_record(rng) for _ in range(rng.randrange(1, 6))]
+        frame = check_round_trip(records, args.max_us_per_byte)
+        check_reencode(frame)
+        counts['round_trip'] += 1
+        for _ in range(args.mutations):
+            number_of_data, _records = check_decode(mutate(rng, frame), args.max_us_per_byte)
+            counts['mutated'] += 1
+            counts['accepted_mutants'] += bool(number_of_data)
+        check_decode(bytes(rng.getrandbits(8) for _ in range(rng.randrange(64))), args.max_us_per_byte)
+        # Garbage behind a plausible header reaches the record parser
+        garbage = bytes(rng.getrandbits(8) for _ in range(rng.randrange(40, 400)))
+        codec_id = rng.choice(tuple(fmb_codec.AVL_CODECS))
+        check_decode(struct.pack('>IIBB', 0, len(garbage) + 3, codec_id, rng.randrange(1, 4)) + garbage,
+                     args.max_us_per_byte)
+        counts['garbage'] += 2
+        text = random_text(rng)
+        check_codec12(encode_codec12_response(text), text)
+        check_codec12(mutate(rng, encode_codec12_response(text)))
+        counts['codec12'] += 2
+    return counts
+
+
+def run_hypothesis(args):
+    try:
+        from hypothesis import given, settings, strategies as st
+    except ImportError:
+        sys.exit("hypothesis is not installed: pip install hypothesis")
+
+    @st.composite
+    def records_strategy(draw):
+        return [random_record(random.Random(draw(st.integers(0, 2**32)))) for _ in range(draw(st.integers(1, 5)))]
+
+    @settings(max_examples=args.iterations, deadline=None, database=None)
+    @given(records_strategy())
+    def round_trip(records):
+        check_reencode(check_round_trip(records, args.max_us_per_byte))
+
+    @settings(max_examples=args.iterations, deadline=None, database=None)
+    @given(records_strategy(), st.integers(0, 2**32))
+    def mutated(records, seed):
+        check_decode(mutate(random.Random(seed), encode_frame(records)), args.max_us_per_byte)
+
+    @settings(max_examples=args.iterations, deadline=None, database=None)
+    @given(st.binary(max_size=512))
+    def garbage(data):
+        check_decode(data, args.max_us_per_byte)
+        check_decode(struct.pack('>IIBB', 0, len(data) + 3, 0x8E, 1) + data, args.max_us_per_byte)
+        check_codec12(data)
+
+    @settings(max_examples=args.iterations, deadline=None, database=None)
+    @given(st.text(alphabet=st.characters(min_codepoint=32, max_codepoint=126), min_size=1, max_size=200))
+    def codec12(text):
+        check_codec12(encode_codec12_response(text), text)
+
+    for prop in (round_trip, mutated, garbage, codec12):
+        prop()
+    return {'properties': 4, 'examples_per_property': args.iterations}
+
+
+def run_atheris(args, extra):
+    try:
+        import atheris
+    except ImportError:
+        sys.exit("atheris is not installed: pip install atheris")
+
+    def test_one_input(data):
+        check_decode(data, args.max_us_per_byte)
+        check_codec12(data)
+
+    atheris.Setup([sys.argv[0]] + extra, test_one_input)
+    atheris.Fuzz()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fuzz the Teltonika codec parsers')
+    parser.add_argument('--engine', choices=('random', 'hypothesis', 'atheris', 'corpus'), default='random')
+    parser.add_argument('--iterations', type=int, default=20000, help='Valid frames generated (examples per property)')
+    parser.add_argument('--mutations', type=int, default=5, help='Mutants decoded per valid frame (random engine)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--max-us-per-byte', type=float, default=DEFAULT_MAX_US_PER_BYTE)
+    parser.add_argument('--crash-dir', default='fuzz_crashes')
+    args, extra = parser.parse_known_args()
+    if args.seed is None:
+        args.seed = random.randrange(2**32)
+
+    logging.disable(logging.CRITICAL)  # Rejections are expected; the decoder's warnings would drown the output
+    started = time.perf_counter()
+    try:
+        corpus_frames = check_corpus()
+        if args.engine == 'atheris':
+            run_atheris(args, [arg for arg in extra if arg != '--'])
+            return
+        counts = {'corpus': corpus_frames}
+        if args.engine == 'hypothesis':
+            counts.update(run_hypothesis(args))
+        elif args.engine == 'random':
+            counts.update(run_random(args))
+    except PropertyFailure as failure:
+        os.makedirs(args.crash_dir, exist_ok=True)
+        path = os.path.join(args.crash_dir, f'{args.engine}-{args.seed}-{int(time.time())}.hex')
+        with open(path, 'w') as f:
+            f.write(failure.data.hex() + '\n')
+        print(f"FAILED (seed {args.seed}): {failure}\n  input written to {path}")
+        sys.exit(1)
+    print(f"OK in {time.perf_counter() - started:.1f}s (seed {args.seed}): {counts}")
+
+
+if __name__ == '__main__':
+    main()
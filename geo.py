@@ -0,0 +1,58 @@
+"""Small geometry helpers for the position endpoints in api.py.
+
+Coordinates are WGS84 degrees as stored in gps_data. Bounding boxes are
+(min_lat, max_lat, min_lon, max_lon), matching the gps_rtree column order.
+"""
+import math
+
+EARTH_RADIUS_M = 6371008.8
+MAX_LAT = 90.0
+MAX_LON = 180.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius_m):
+    """Bounding box that contains every point within radius_m of (lat, lon)."""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    min_lat = max(lat - dlat, -MAX_LAT)
+    max_lat = min(lat + dlat, MAX_LAT)
+    if min_lat == -MAX_LAT or max_lat == MAX_LAT:
+        return min_lat, max_lat, -MAX_LON, MAX_LON
+    dlon = math.degrees(radius_m / (EARTH_RADIUS_M * math.cos(math.radians(lat))))
+    if dlon >= MAX_LON:
+        return min_lat, max_lat, -MAX_LON, MAX_LON
+    return min_lat, max_lat, max(lon - dlon, -MAX_LON), min(lon + dlon, MAX_LON)
+
+
+def polygon_bbox(polygon):
+    lats = [point[0] for point in polygon]
+    lons = [point[1] for point in polygon]
+    return min(lats), max(lats), min(lons), max(lons)
+
+
+def point_in_polygon(lat, lon, polygon):
+    """Ray-casting test; polygon is a list of (lat, lon) vertices, closed implicitly."""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing_lon = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if lon < crossing_lon:
+                inside = not inside
+        j = i
+    return inside
+
+
+def valid_bbox(min_lat, max_lat, min_lon, max_lon):
+    return (-MAX_LAT <= min_lat <= max_lat <= MAX_LAT) and (-MAX_LON <= min_lon <= max_lon <= MAX_LON)
@@ -0,0 +1,22 @@
+# Gunicorn settings for the Flask API (api.py).
+#
+# The default worker class is gevent: every request runs in a greenlet, so
+# export streams, /commands long-polls and slow clients hold a few KB of
+# memory instead of a whole worker. Blocking sqlite3 calls are pushed to the
+# hub's thread pool by api.offload(). Set GUNICORN_WORKER_CLASS=sync to get
+# the previous behaviour back.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 2000))  # Concurrent greenlets per worker
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 90))  # Must exceed api.MAX_COMMAND_WAIT
+keepalive = 5
+DB_THREADS = int(os.environ.get('API_DB_THREADS', 8))  # Size of each worker's database thread pool
+
+
+def post_worker_init(worker):
+    if worker_class == 'gevent':
+        import gevent
+        gevent.get_hub().threadpool.maxsize = DB_THREADS
@@ -0,0 +1,67 @@
+"""Graceful shutdown and in-place restart for the ingest servers.
+
+    kill -TERM <pid>   stop accepting, finish the connection in hand, flush, exit
+    kill -HUP <pid>    the same, then re-exec the server on the same listening socket
+
+On SIGHUP the listening socket is left open across execve() and its file
+descriptor handed to the new image in FMB_LISTEN_FD, so the port is never
+closed: devices connecting during the restart wait in the kernel's accept
+backlog instead of being refused, and the PID (which service_runner.sh
+watches) stays the same. Either signal also caps every session deadline at
+FMB_DRAIN_TIMEOUT seconds (see sessions.SessionReaper.drain), so a silent
+device cannot hold up the restart.
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+
+import log_setup
+
+LISTEN_FD_ENV = 'FMB_LISTEN_FD'
+DRAIN_TIMEOUT = float(os.environ.get('FMB_DRAIN_TIMEOUT', 30))
+ACCEPT_POLL = 1.0  # accept() timeout, i.e. how soon the accept loop notices a signal
+
+
+def listening_socket(host, port):
+    """The socket inherited from a SIGHUP restart, else a new one bound to (host, port)."""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd:
+        sock = socket.socket(fileno=int(fd))
+        sock.set_inheritable(False)
+        logging.info("Took over listening socket %s from the previous process", sock.getsockname())
+        return sock
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen()
+    return sock
+
+
+class Lifecycle:
+    """Records SIGTERM/SIGHUP for the accept loop; requested is None, 'stop' or 'restart'."""
+
+    def __init__(self, reaper=None):
+        self.reaper = reaper
+        self.requested = None
+
+    def install(self):
+        signal.signal(signal.SIGTERM, self._handle)
+        signal.signal(signal.SIGHUP, self._handle)
+        return self
+
+    def _handle(self, signum, frame):
+        # Runs between bytecodes of the main thread: only set flags here, no locks or I/O
+        self.requested = 'restart' if signum == signal.SIGHUP else 'stop'
+        if self.reaper is not None:
+            self.reaper.drain(DRAIN_TIMEOUT)
+
+
+def reexec(sock):
+    """Replace this process with a fresh copy of itself that keeps serving on sock; does not return."""
+    sock.set_inheritable(True)
+    env = dict(os.environ, **{LISTEN_FD_ENV: str(sock.fileno())})
+    logging.info("Restarting %s in place on listening socket %s", sys.argv[0], sock.getsockname())
+    log_setup.stop_logging()  # execve() skips atexit handlers
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
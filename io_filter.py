@@ -0,0 +1,137 @@
+"""IO element filtering before records are forwarded and stored.
+
+An FMB920 record carries ~30 IO elements and most of them repeat the
+previous record's values. With FMB_IO_FILTER=1 (off by default), IoFilter
+trims each record's io_data per IMEI and IO id:
+
+- allow-list: only ids in FMB_IO_ALLOW are kept; unset or empty keeps
+  every id. For the fridge dashboard, FRIDGE_IO_IDS (external voltage,
+  DOUT1, temperature and humidity sensors) is enough;
+- change-only: a value is kept when it differs from the last one
+  forwarded for that IMEI and id by at least its deadband (FMB_IO_DEADBAND,
+  "io_id:deadband" pairs; by default 0.5 V, 0.5 degC and 2 %RH for the
+  voltage, temperature and humidity ids); ids without one keep every
+  change, so digital transitions are never lost;
+- heartbeat: an unchanged value is still kept once FMB_IO_HEARTBEAT
+  seconds of record time have passed since it was last forwarded, so the
+  newest stored row of an id never gets older than that (0: no heartbeat).
+
+    FMB_IO_FILTER=1 FMB_IO_ALLOW=66,179,25,26,27,28,86,72,73,74 python tcp_server_v8.py
+
+Deadbands are in the units of io_schema's typed 'value' (volts, degrees),
+so they only apply to elements the schema decoded; an element without a
+typed value (FMB_IO_SCHEMA=none, or an id the schema lacks) is kept on
+any change of its raw io_value. Records themselves are never dropped,
+only their IO elements. The last forwarded values only advance when
+commit() is called after a successful forward, so a batch the API did not
+take is compared again in full when the device resends it.
+"""
+import os
+import threading
+
+import dedup
+import metrics
+import tracing
+
+ENABLED = os.environ.get('FMB_IO_FILTER', '0') == '1'
+# External voltage (power_status), DOUT1, BLE temperatures 1-4 and humidity 1, Dallas temperatures 1-3
+FRIDGE_IO_IDS = (66, 179, 25, 26, 27, 28, 86, 72, 73, 74)
+HEARTBEAT = float(os.environ.get('FMB_IO_HEARTBEAT', 900))  # As the API's FMB_STALE_AFTER default
+
+
+def _parse_allow(text):
+    """Set of allowed IO ids, or None for every id ('', 'all' or '*')."""
+    if text.strip().lower() in ('', 'all', '*'):
+        return None
+    return {int(io_id) for io_id in text.split(',') if io_id.strip()}
+
+
+def _parse_deadbands(text):
+    """{io_id: deadband} from "id:deadband" pairs separated by commas."""
+    deadbands = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        io_id, _, deadband = item.partition(':')
+        if not deadband:
+            raise ValueError(f"FMB_IO_DEADBAND entry {item!r} is not io_id:deadband")
+        deadbands[int(io_id)] = float(deadband)
+    return deadbands
+
+
+ALLOW = _parse_allow(os.environ.get('FMB_IO_ALLOW', ''))
+DEFAULT_DEADBANDS = '66:0.5,25:0.5,26:0.5,27:0.5,28:0.5,72:0.5,73:0.5,74:0.5,86:2'
+DEADBANDS = _parse_deadbands(os.environ.get('FMB_IO_DEADBAND', DEFAULT_DEADBANDS))
+
+IO_ELEMENTS = metrics.Counter('fmb_io_elements_total', 'Decoded IO elements by filter result', ('result',))
+IO_FORWARDED, IO_SUPPRESSED, IO_NOT_ALLOWED = (IO_ELEMENTS.labels('forwarded'), IO_ELEMENTS.labels('suppressed'),
+                                               IO_ELEMENTS.labels('not_allowed'))
+
+
+class IoFilter:
+    """Per-IMEI last forwarded value and record time of each IO id; thread-safe."""
+
+    def __init__(self, allow=ALLOW, deadbands=None, heartbeat=HEARTBEAT):
+        self.allow = allow
+        self.deadbands = DEADBANDS if deadbands is None else deadbands
+        self.heartbeat = heartbeat
+        self.lock = threading.Lock()
+        self.last = {}  # imei -> {io_id: (value, record epoch)}
+
+    def filter(self, imei, records):
+        """Copies of records with io_data trimmed, and the updates to pass to commit() once they are forwarded.
+
+        Each copy keeps the untrimmed record's dedup.io_digest() as
+        'io_digest', so the API recognises a resend however it was trimmed.
+        The records passed in are not modified.
+        """
+        allow, deadbands, heartbeat = self.allow, self.deadbands, self.heartbeat
+        with self.lock:
+            last = dict(self.last.get(imei, ()))
+        updates = {}
+        kept = suppressed = not_allowed = 0
+        filtered = [None] * len(records)
+        # Oldest first, so a change is measured against the value just before it; output keeps the batch order
+        for index in sorted(range(len(records)), key=lambda index: records[index]['timestamp']):
+            record = records[index]
+            epoch = tracing.record_epoch(record['timestamp']) or 0
+            io_data = []
+            for element in record.get('io_data', ()):
+                io_id = element['io_id']
+                if allow is not None and io_id not in allow:
+                    not_allowed += 1
+                    continue
+                value = element.get('value')
+                if value is None:  # Not decoded by the schema: raw units, where the deadbands mean nothing
+                    value, deadband = element['io_value'], 0
+                else:
+                    deadband = deadbands.get(io_id, 0)
+                previous = last.get(io_id)
+                if (previous is None or (heartbeat and epoch - previous[1] >= heartbeat)
+                        or (value != previous[0] and abs(value - previous[0]) >= deadband)):
+                    io_data.append(element)
+                    last[io_id] = updates[io_id] = (value, epoch)
+                else:
+                    suppressed += 1
+            kept += len(io_data)
+            filtered[index] = dict(record, io_data=io_data, io_digest=dedup.io_digest(record))
+        IO_FORWARDED.inc(kept)
+        IO_SUPPRESSED.inc(suppressed)
+        IO_NOT_ALLOWED.inc(not_allowed)
+        return filtered, updates
+
+    def describe(self):
+        """One line for the startup log."""
+        allowed = 'all ids' if self.allow is None else f"ids {','.join(map(str, sorted(self.allow)))}"
+        return (f"IO filter: {allowed}, deadbands {self.deadbands or 'none'}, "
+                f"heartbeat {f'{self.heartbeat:.0f}s' if self.heartbeat else 'off'}")
+
+    def commit(self, imei, updates):
+        """Record the values of a forwarded batch as the ones later records are compared against."""
+        if not updates:
+            return
+        with self.lock:
+            current = self.last.setdefault(imei, {})
+            for io_id, (value, epoch) in updates.items():
+                if io_id not in current or epoch >= current[io_id][1]:
+                    current[io_id] = (value, epoch)
@@ -0,0 +1,132 @@
+"""IO element dictionary: what each AVL IO id means and how to read its value.
+
+The codec only knows an IO element's id and its unsigned big-endian bytes.
+A schema entry adds a name, signedness, a scale and a unit, so a Dallas
+temperature of 0xFFEC decodes as -2.0 (degC) and an external voltage of
+13800 as 13.8 (V). Decoded elements keep the raw 'io_value' (dedup, storage
+and re-encoding all key on it) and gain 'name' and the typed 'value'.
+
+Schemas are per device model. FMB920 below is built in; FMB_IO_SCHEMA
+names a JSON file that adds or overrides models and maps IMEIs to them:
+
+    {
+        "default": "FMB920",
+        "filter": false,
+        "models": {
+            "FMB920": {"72": {"name": "dallas_temperature_1", "signed": true, "scale": 0.1, "unit": "degC"}},
+            "FMC130": {"66": {"name": "external_voltage", "scale": 0.001, "unit": "V"}}
+        },
+        "devices": {"350317177312182": "FMC130"}
+    }
+
+Entries of a file model are merged over the built-in model of the same
+name. "filter": true drops elements whose id has no entry instead of
+passing them through raw. FMB_IO_SCHEMA=none disables the schema (raw
+values only, as before). Each model is compiled once at startup into a
+dense table indexed by IO id, so the decoder does one tuple index per
+element and no dict lookups.
+"""
+import json
+import os
+from fractions import Fraction
+
+SCHEMA_FILE = os.environ.get('FMB_IO_SCHEMA') or None
+DEFAULT_MODEL = 'FMB920'
+MAX_IO_ID = 0xFFFF  # Codec 8E and 16 ids are two bytes; Codec 8's one-byte ids index the same table
+
+# Teltonika FMB920 AVL ids this fleet reports (see the FMB920 "Teltonika Data Sending Parameters ID" list)
+FMB920 = {
+    1: {'name': 'digital_input_1'},
+    9: {'name': 'analog_input_1', 'scale': 0.001, 'unit': 'V'},
+    16: {'name': 'total_odometer', 'unit': 'm'},
+    21: {'name': 'gsm_signal'},
+    24: {'name': 'speed', 'unit': 'km/h'},
+    25: {'name': 'ble_temperature_1', 'signed': True, 'scale': 0.01, 'unit': 'degC'},
+    26: {'name': 'ble_temperature_2', 'signed': True, 'scale': 0.01, 'unit': 'degC'},
+    27: {'name': 'ble_temperature_3', 'signed': True, 'scale': 0.01, 'unit': 'degC'},
+    28: {'name': 'ble_temperature_4', 'signed': True, 'scale': 0.01, 'unit': 'degC'},
+    66: {'name': 'external_voltage', 'scale': 0.001, 'unit': 'V'},
+    67: {'name': 'battery_voltage', 'scale': 0.001, 'unit': 'V'},
+    68: {'name': 'battery_current', 'scale': 0.001, 'unit': 'A'},
+    69: {'name': 'gnss_status'},
+    72: {'name': 'dallas_temperature_1', 'signed': True, 'scale': 0.1, 'unit': 'degC'},
+    73: {'name': 'dallas_temperature_2', 'signed': True, 'scale': 0.1, 'unit': 'degC'},
+    74: {'name': 'dallas_temperature_3', 'signed': True, 'scale': 0.1, 'unit': 'degC'},
+    86: {'name': 'ble_humidity_1', 'scale': 0.1, 'unit': '%RH'},
+    113: {'name': 'battery_level', 'unit': '%'},
+    179: {'name': 'digital_output_1'},
+    181: {'name': 'gnss_pdop', 'scale': 0.1},
+    182: {'name': 'gnss_hdop', 'scale': 0.1},
+    199: {'name': 'trip_odometer', 'unit': 'm'},
+    200: {'name': 'sleep_mode'},
+    205: {'name': 'gsm_cell_id'},
+    206: {'name': 'gsm_area_code'},
+    239: {'name': 'ignition'},
+    240: {'name': 'movement'},
+    241: {'name': 'active_gsm_operator'},
+}
+BUILTIN_MODELS = {'FMB920': FMB920}
+
+
+class IoSchema:
+    """One device model's IO dictionary, compiled into a dense table indexed by IO id.
+
+    table[io_id] is None for an unknown id, else (name, signed, numerator,
+    denominator): the scale as an exact fraction, so 0.1 scales by dividing
+    by 10 and 13800 mV comes out as 13.8 rather than 13.800000000000001.
+    """
+
+    def __init__(self, model, entries, skip_unknown=False):
+        self.model = model
+        self.skip_unknown = skip_unknown
+        self.entries = {int(io_id): entry for io_id, entry in entries.items()}  # As loaded, for /io_schema
+        table = [None] * (MAX_IO_ID + 1)
+        for io_id, entry in self.entries.items():
+            if not 0 <= io_id <= MAX_IO_ID:
+                raise ValueError(f"{model}: IO id {io_id} out of range")
+            scale = Fraction(str(entry.get('scale', 1)))
+            table[io_id] = (entry.get('name') or f'io_{io_id}', bool(entry.get('signed', False)),
+                            scale.numerator, scale.denominator)
+        self.table = tuple(table)
+
+
+class SchemaRegistry:
+    """Compiled schemas by model, and which model each IMEI is; for_imei() is one dict lookup per frame."""
+
+    def __init__(self, models, default=DEFAULT_MODEL, devices=None, skip_unknown=False):
+        self.schemas = {model: IoSchema(model, entries, skip_unknown) for model, entries in models.items()}
+        if default not in self.schemas:
+            raise ValueError(f"Default IO schema model {default!r} is not defined")
+        self.default = self.schemas[default]
+        self.devices = {}
+        for imei, model in (devices or {}).items():
+            if model not in self.schemas:
+                raise ValueError(f"IMEI {imei}: IO schema model {model!r} is not defined")
+            self.devices[imei] = self.schemas[model]
+
+    def for_imei(self, imei):
+        return self.devices.get(imei, self.default)
+
+
+def load(path=SCHEMA_FILE):
+    """The registry for FMB_IO_SCHEMA (built-in models only when unset), or None when it is 'none'."""
+    if path and path.lower() == 'none':
+        return None
+    config = {}
+    if path:
+        with open(path) as f:
+            config = json.load(f)
+    models = {model: dict(entries) for model, entries in BUILTIN_MODELS.items()}
+    for model, entries in config.get('models', {}).items():
+        models.setdefault(model, {}).update({int(io_id): entry for io_id, entry in entries.items()})
+    return SchemaRegistry(models, config.get('default', DEFAULT_MODEL), config.get('devices'),
+                          bool(config.get('filter', False)))
+
+
+def describe(registry):
+    """One line for the startup log."""
+    if registry is None:
+        return "IO schema disabled; IO values are passed through raw"
+    models = ', '.join(f'{schema.model} ({len(schema.entries)} ids)' for schema in registry.schemas.values())
+    return (f"IO schema from {SCHEMA_FILE or 'built-in models'}: {models}, default {registry.default.model}"
+            f"{', unknown ids dropped' if registry.default.skip_unknown else ''}")
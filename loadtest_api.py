@@ -0,0 +1,338 @@
+"""Load and soak test for the Flask API with dashboard-shaped traffic.
+
+Runs on one asyncio loop with a minimal keep-alive HTTP/1.1 client (no
+extra dependencies):
+
+- dashboards: N Quasar dashboards, each polling GET /power_status/<imei>
+  then GET /dout1_status/<imei> every --poll-interval seconds (10 s, as in
+  IndexPage.vue), occasionally toggling POST /dout1_control/<imei>;
+- ingest: D devices POSTing /syncing_data batches like tcp_server_v8, and
+  fetching and completing their queued commands.
+
+Latency percentiles and error rates are reported per route, and during a
+soak a line per --report-interval shows whether things degrade over time.
+
+    python loadtest_api.py --url http://127.0.0.1:5000 --db grok_fmb_data_v6.db --dashboards 500 --duration 120
+    python loadtest_api.py --spawn "gunicorn -c {repo}/gunicorn.conf.py -b 127.0.0.1:{port} api:app" --duration 600
+
+--spawn starts the given command (with {repo} and {port} filled in) in a
+fresh temporary directory, so each run gets its own empty SQLite database,
+and stops it afterwards. That makes worker-model, WAL or caching changes
+comparable run to run. --db (implied by --spawn) seeds dout1_state rows
+for the simulated fleet, which dout1_status/dout1_control need.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from fmb_simulator import BASE_POSITION, IMEI_BASE, percentile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_NAME = 'grok_fmb_data_v6.db'  # As in api.py
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class HttpClient:
+    """One keep-alive HTTP/1.1 connection; reconnects when the server closes it."""
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method, path, body=None):
+        for attempt in (0, 1):
+            reused = self.writer is not None
+            if not reused:
+                await self._connect()
+            try:
+                return await asyncio.wait_for(self._exchange(method, path, body), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused or attempt:
+                    raise  # Only a stale keep-alive connection is worth one silent retry
+            except BaseException:
+                self.close()
+                raise
+
+    async def _exchange(self, method, path, body):
+        payload = json.dumps(body).encode() if body is not None else b''
+        head = f'{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nConnection: keep-alive\r\n'
+        if body is not None:
+            head += f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+        self.writer.write(head.encode() + b'\r\n' + payload)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed before the response')
+        version, status = status_line.split()[:2]
+        headers = {}
+        while (line := await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            data = await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while (size := int((await self.reader.readline()).split(b';')[0], 16)):
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            await self.reader.readline()
+            data = b''.join(chunks)
+        else:
+            data = await self.reader.read()
+            self.close()
+        if version == b'HTTP/1.0' or headers.get('connection', '').lower() == 'close':
+            self.close()
+        return int(status), data
+
+
+class Results:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.routes = {}
+        self.window = []  # (route, latency, ok) since the last progress line
+
+    def add(self, route, latency, status):
+        entry = self.routes.setdefault(route, {'latencies': [], 'statuses': {}, 'errors': 0})
+        entry['latencies'].append(latency)
+        entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+        ok = isinstance(status, int) and status < 500
+        if not ok:
+            entry['errors'] += 1
+        self.window.append((latency, ok))
+
+    def progress_line(self, interval):
+        window, self.window = self.window, []
+        latencies = [latency for latency, _ in window]
+        errors = sum(1 for _, ok in window if not ok)
+        return (f"[{time.perf_counter() - self.started:7.1f}s] {len(window) / interval:8.1f} req/s  "
+                f"p50={percentile(latencies, 50) * 1000:7.1f}ms p99={percentile(latencies, 99) * 1000:7.1f}ms  "
+                f"errors={errors}")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        routes = {}
+        for route, entry in sorted(self.routes.items()):
+            values = entry['latencies']
+            routes[route] = {
+                'requests': len(values),
+                'rps': round(len(values) / elapsed, 2),
+                'error_rate': round(entry['errors'] / len(values), 4) if values else 0.0,
+                'statuses': entry['statuses'],
+                'latency_ms': {name: round(percentile(values, pct) * 1000, 2)
+                               for name, pct in (('p50', 50), ('p90', 90), ('p99', 99))},
+            }
+            routes[route]['latency_ms']['max'] = round(max(values) * 1000, 2) if values else 0.0
+        total = sum(route['requests'] for route in routes.values())
+        errors = sum(entry['errors'] for entry in self.routes.values())
+        return {'elapsed_s': round(elapsed, 2), 'requests': total, 'rps': round(total / elapsed, 2),
+                'error_rate': round(errors / total, 4) if total else 0.0, 'routes': routes}
+
+
+async def timed(results, client, route, method, path, body=None):
+    started = time.perf_counter()
+    try:
+        status, data = await client.request(method, path, body)
+    except asyncio.TimeoutError:
+        status, data = 'timeout', b''
+    except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError) as e:
+        status, data = type(e).__name__, b''
+    results.add(route, time.perf_counter() - started, status)
+    return status, data
+
+
+async def dashboard(index, imeis, args, results, stop_at):
+    rng = random.Random(index)
+    imei = imeis[index % len(imeis)]
+    client = HttpClient(args.host, args.port, args.timeout)
+    active = False
+    await asyncio.sleep(rng.uniform(0, min(args.poll_interval, args.ramp)))
+    try:
+        while time.perf_counter() < stop_at:
+            await timed(results, client, 'GET /power_status', 'GET', f'/power_status/{imei}')
+            status, data = await timed(results, client, 'GET /dout1_status', 'GET', f'/dout1_status/{imei}')
+            if status == 200:
+                active = json.loads(data).get('dout1_active', active)
+            if rng.random() < args.toggle_rate:
+                await timed(results, client, 'POST /dout1_control', 'POST', f'/dout1_control/{imei}',
+                            {'activate': not active})
+            await asyncio.sleep(args.poll_interval * rng.uniform(0.9, 1.1))
+    finally:
+        client.close()
+
+
+def telemetry_batch(rng, imei, count, position):
+    now = time.time()
+    records = []
+    for i in range(count):
+        position[0] += rng.uniform(-0.0005, 0.0005)
+        position[1] += rng.uniform(-0.0005, 0.0005)
+        timestamp = datetime.fromtimestamp(now - (count - i), tz=timezone.utc).strftime(TIMESTAMP_FORMAT)
+        records.append({
+            'timestamp': timestamp, 'latitude': round(position[0], 7), 'longitude': round(position[1], 7),
+            'altitude': rng.randint(0, 60), 'speed': rng.randint(0, 90), 'angle': rng.randint(0, 359),
+            'satellites': rng.randint(6, 14), 'priority': 0,
+            'io_data': [{'io_id': 66, 'io_value': rng.choice((0, 13800))}, {'io_id': 179, 'io_value': 0},
+                        {'io_id': 239, 'io_value': 1}, {'io_id': 21, 'io_value': rng.randint(1, 5)}],
+        })
+    return {'imei': imei, 'records': records}
+
+
+async def device(index, imeis, args, results, stop_at):
+    """Stands in for tcp_server_v8 handling one unit: command poll, upload, command completion."""
+    rng = random.Random(100000 + index)
+    imei = imeis[index % len(imeis)]
+    position = [BASE_POSITION[0] + rng.uniform(-0.05, 0.05), BASE_POSITION[1] + rng.uniform(-0.05, 0.05)]
+    client = HttpClient(args.host, args.port, args.timeout)
+    await asyncio.sleep(rng.uniform(0, min(args.upload_interval, args.ramp)))
+    try:
+        while time.perf_counter() < stop_at:
+            status, data = await timed(results, client, 'GET /command_queue', 'GET', f'/command_queue/{imei}')
+            commands = json.loads(data).get('commands', []) if status == 200 else []
+            await timed(results, client, 'POST /syncing_data', 'POST', '/syncing_data',
+                        telemetry_batch(rng, imei, args.records, position))
+            for command in commands:
+                await timed(results, client, 'POST /command_queue/update', 'POST',
+                            f"/command_queue/update/{command['id']}",
+                            {'status': 'completed', 'response': 'DOUT1:1 Timeout:INFINITY'})
+            await asyncio.sleep(args.upload_interval * rng.uniform(0.9, 1.1))
+    finally:
+        client.close()
+
+
+async def report(results, interval, stop_at):
+    while time.perf_counter() < stop_at:
+        await asyncio.sleep(interval)
+        print(results.progress_line(interval), flush=True)
+
+
+async def run_load(args, imeis):
+    results = Results()
+    stop_at = time.perf_counter() + args.duration
+    tasks = [dashboard(i, imeis, args, results, stop_at) for i in range(args.dashboards)]
+    tasks += [device(i, imeis, args, results, stop_at) for i in range(args.devices)]
+    if args.report_interval:
+        tasks.append(report(results, args.report_interval, stop_at))
+    await asyncio.gather(*tasks)
+    return results.summary()
+
+
+def seed_fleet(db_path, imeis):
+    """Give every simulated IMEI a dout1_state row (provisioned out of band in production)."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.executemany('INSERT OR IGNORE INTO dout1_state (imei, dout1_active, deactivate_time) VALUES (?, 0, NULL)',
+                         [(imei,) for imei in imeis])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def wait_until_serving(host, port, timeout):
+    """True once the API answers HTTP (a prefork master accepts connections before its workers are up)."""
+    async def probe():
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            client = HttpClient(host, port, 5)
+            try:
+                await client.request('GET', f'/power_status/{IMEI_BASE}')
+                return True
+            except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+                await asyncio.sleep(0.2)
+            finally:
+                client.close()
+        return False
+    return asyncio.run(probe())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load/soak test the Flask API with dashboard and ingest traffic')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--spawn', metavar='COMMAND',
+                        help='Start the API with this command ({repo}, {port} substituted) in a fresh temp dir')
+    parser.add_argument('--db', help='SQLite file to seed dout1_state in (implied by --spawn)')
+    parser.add_argument('--dashboards', type=int, default=100)
+    parser.add_argument('--devices', type=int, default=20, help='Simulated units uploading telemetry')
+    parser.add_argument('--fleet', type=int, default=0, help='Distinct IMEIs (default: max(dashboards, devices))')
+    parser.add_argument('--poll-interval', type=float, default=10.0)
+    parser.add_argument('--upload-interval', type=float, default=10.0)
+    parser.add_argument('--records', type=int, default=3, help='Records per /syncing_data batch')
+    parser.add_argument('--toggle-rate', type=float, default=0.01, help='Chance a dashboard poll also toggles DOUT1')
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--ramp', type=float, default=10.0, help='Spread client start-up over this many seconds')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--report-interval', type=float, default=10.0, help='Seconds between progress lines (0 = off)')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    args.host, args.port = url.hostname or '127.0.0.1', url.port or 80
+    fleet = args.fleet or max(args.dashboards, args.devices, 1)
+    imeis = [str(IMEI_BASE + i) for i in range(fleet)]
+
+    server = workdir = None
+    if args.spawn:
+        workdir = tempfile.TemporaryDirectory(prefix='loadtest-api-')
+        command = shlex.split(args.spawn.format(repo=REPO_DIR, port=args.port))
+        env = dict(os.environ, PORT=str(args.port),  # api.py's own app.run() listens on $PORT
+                   PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+        # Every simulated dashboard and device shares one address; measure the API, not its rate limits
+        env.setdefault('FMB_CLIENT_RATE', '0')
+        env.setdefault('FMB_COMMAND_RATE', '0')
+        server = subprocess.Popen(command, cwd=workdir.name, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not wait_until_serving(args.host, args.port, 30):
+            server.terminate()
+            sys.exit(f"API did not start listening on {args.host}:{args.port}")
+        args.db = args.db or os.path.join(workdir.name, DB_NAME)
+    try:
+        if args.db:
+            seed_fleet(args.db, imeis)
+        summary = asyncio.run(run_load(args, imeis))
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+            workdir.cleanup()
+
+    summary['config'] = {'dashboards': args.dashboards, 'devices': args.devices, 'fleet': fleet,
+                         'poll_interval': args.poll_interval, 'upload_interval': args.upload_interval,
+                         'spawn': args.spawn}
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{summary['requests']} requests in {summary['elapsed_s']}s ({summary['rps']} req/s), "
+          f"error rate {summary['error_rate']:.2%}")
+    for route, stats in summary['routes'].items():
+        latency = stats['latency_ms']
+        print(f"  {route:<28} n={stats['requests']:<7} p50={latency['p50']}ms p90={latency['p90']}ms "
+              f"p99={latency['p99']}ms max={latency['max']}ms errors={stats['error_rate']:.2%} {stats['statuses']}")
+
+
+if __name__ == '__main__':
+    main()
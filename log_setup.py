@@ -0,0 +1,113 @@
+"""Background, rotating, optionally structured logging for the ingest server.
+
+configure_logging() installs a QueueHandler on the root logger so the
+ingest thread only enqueues records; a QueueListener thread does the
+formatting-to-disk work through a size- or time-rotating file handler.
+Callers should log with %-style arguments (``logging.info("x %s", y)``) so
+nothing is formatted when the level is disabled, and pass structured fields
+as ``extra={'imei': ..., 'codec': ..., 'records': ...}``; the JSON formatter
+emits them as top-level keys.
+
+Raw packets go through log_packet(), which only hex-dumps one packet in
+PACKET_DUMP_SAMPLE (truncated to PACKET_DUMP_MAX_BYTES) and otherwise logs
+just the length.
+"""
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+TEXT_FORMAT = '%(asctime)s:%(levelname)s:%(message)s'
+STRUCTURED_FIELDS = ('imei', 'codec', 'records', 'addr', 'command_id')
+PACKET_DUMP_SAMPLE = int(os.environ.get('FMB_PACKET_DUMP_SAMPLE', 100))  # 1 = dump every packet, 0 = never
+PACKET_DUMP_MAX_BYTES = int(os.environ.get('FMB_PACKET_DUMP_MAX_BYTES', 512))
+
+_packet_counter = itertools.count()
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(filename, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5,
+                      rotate_when=None, json_format=False):
+    """Route root logging through a background writer; returns the QueueListener.
+
+    Rotation is by size (max_bytes) unless rotate_when is given, in which case
+    it is passed to TimedRotatingFileHandler (e.g. 'midnight', 'H').
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    log_dir = os.path.dirname(filename)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir, mode=0o755)
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(filename, when=rotate_when, backupCount=backup_count)
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def configure_from_env(default_filename):
+    """configure_logging() driven by FMB_LOG_* environment variables."""
+    return configure_logging(
+        os.environ.get('FMB_LOG_FILE', default_filename),
+        level=getattr(logging, os.environ.get('FMB_LOG_LEVEL', 'INFO').upper(), logging.INFO),
+        max_bytes=int(os.environ.get('FMB_LOG_MAX_BYTES', 10 * 1024 * 1024)),
+        backup_count=int(os.environ.get('FMB_LOG_BACKUPS', 5)),
+        rotate_when=os.environ.get('FMB_LOG_ROTATE_WHEN') or None,
+        json_format=os.environ.get('FMB_LOG_JSON', '').lower() in ('1', 'true', 'yes'),
+    )
+
+
+def stop_logging():
+    """Flush queued records to disk; safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_packet(level, msg, data, *args, **kwargs):
+    """Log msg for a packet, appending a sampled, truncated hex dump of data.
+
+    msg/args are %-style like logging.log(); extra= and other kwargs are passed through.
+    """
+    logger = logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+    if PACKET_DUMP_SAMPLE and next(_packet_counter) % PACKET_DUMP_SAMPLE == 0:
+        truncated = '...' if len(data) > PACKET_DUMP_MAX_BYTES else ''
+        logger.log(level, msg + ', packet (%d bytes): %s%s', *args, len(data),
+                   data[:PACKET_DUMP_MAX_BYTES].hex(), truncated, **kwargs)
+    else:
+        logger.log(level, msg + ', packet: %d bytes', *args, len(data), **kwargs)
@@ -0,0 +1,262 @@
+"""Profiling of a live ingest server or API worker, started at runtime.
+
+Two modes, both time-bounded and one at a time per process:
+
+- 'sample': a background OS thread snapshots every thread's stack each
+  SAMPLE_INTERVAL and writes them in collapsed-stack format
+  (``frame;frame;frame count`` per line), ready for flamegraph.pl or
+  speedscope. Works under gevent too: the sampler uses the unpatched thread
+  and sleep so it keeps running while the hub is busy.
+- 'cprofile': cProfile on the triggering thread, dumped as .pstats. Only
+  useful where one OS thread does the work: the ingest server's main loop
+  (stopped by SIGALRM) or a gevent worker (stopped by a greenlet timer).
+
+Code marks its stages with ``with profiler.span('decode'):``. While a
+profile runs, each span's wall time is aggregated per stage into a
+.spans.json summary, and sampled stacks are rooted under ``[decode]`` so
+the flamegraph splits by stage. With no profile running a span costs one
+global lookup.
+
+The ingest server triggers profiles with SIGUSR1 (sample) / SIGUSR2
+(cprofile); the API exposes POST /admin/profile. Output goes to
+FMB_PROFILE_DIR (default ./profiles).
+"""
+import _thread
+import atexit
+import cProfile
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    gevent_monkey = None
+
+PROFILE_DIR = os.environ.get('FMB_PROFILE_DIR', 'profiles')
+DEFAULT_SECONDS = int(os.environ.get('FMB_PROFILE_SECONDS', 30))
+MAX_SECONDS = 600
+SAMPLE_INTERVAL = 0.005
+MODES = ('sample', 'cprofile')
+
+# Under gevent the threading primitives are greenlet-aware; the sampler is a real
+# OS thread and sys._current_frames() is keyed by OS thread id, so use the originals.
+if gevent_monkey is not None:
+    _get_ident = gevent_monkey.get_original('_thread', 'get_ident')
+    _allocate_lock = gevent_monkey.get_original('_thread', 'allocate_lock')
+else:
+    _get_ident = _thread.get_ident
+    _allocate_lock = _thread.allocate_lock
+
+_lock = _allocate_lock()
+_session = None
+_active_spans = {}  # thread ident -> innermost open span stage, only while profiling
+
+
+def _original(module, name):
+    """The unpatched module attribute, whether or not gevent has monkey-patched it."""
+    if gevent_monkey is not None:
+        return gevent_monkey.get_original(module, name)
+    return getattr(sys.modules[module], name)
+
+
+def _under_gevent():
+    return gevent_monkey is not None and gevent_monkey.is_module_patched('socket')
+
+
+class _Session:
+    def __init__(self, prefix, seconds, mode):
+        self.mode = mode
+        self.seconds = seconds
+        self.started = time.time()
+        self.deadline = time.perf_counter() + seconds
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        self.base = os.path.join(PROFILE_DIR, f'{prefix}-{stamp}-{os.getpid()}-{mode}')
+        self.output = self.base + ('.collapsed' if mode == 'sample' else '.pstats')
+        self.stacks = {}
+        self.samples = 0
+        self.spans = {}  # stage -> [count, total_seconds, max_seconds]
+        self.profile = None
+
+    def add_span(self, stage, elapsed):
+        stats = self.spans.get(stage)
+        if stats is None:
+            self.spans[stage] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+    def status(self):
+        return {'mode': self.mode, 'seconds': self.seconds, 'output': self.output,
+                'remaining_s': round(max(0.0, self.deadline - time.perf_counter()), 1)}
+
+
+class _Span:
+    __slots__ = ('stage', 'session', 'started', 'outer')
+
+    def __init__(self, stage, session):
+        self.stage = stage
+        self.session = session
+
+    def __enter__(self):
+        ident = _get_ident()
+        self.outer = _active_spans.get(ident)
+        _active_spans[ident] = self.stage
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.session.add_span(self.stage, time.perf_counter() - self.started)
+        ident = _get_ident()
+        if self.outer is None:
+            _active_spans.pop(ident, None)
+        else:
+            _active_spans[ident] = self.outer
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(stage):
+    """Context manager timing a pipeline stage while a profile is running."""
+    session = _session
+    if session is None:
+        return _NO_SPAN
+    return _Span(stage, session)
+
+
+def status():
+    """The running profile as a dict, or None."""
+    session = _session
+    return session.status() if session else None
+
+
+def stop():
+    """Finish the running profile now, writing whatever was collected."""
+    session = _session
+    if session is not None:
+        if session.mode == 'cprofile' and not _under_gevent():
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        _finish(session)
+
+
+atexit.register(stop)
+
+
+def start(prefix, seconds=DEFAULT_SECONDS, mode='sample'):
+    """Start a profile that stops itself after seconds; returns status().
+
+    Raises ValueError for bad arguments and RuntimeError if a profile is
+    already running.
+    """
+    global _session
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError(f"seconds must be between 1 and {MAX_SECONDS}")
+    if mode == 'cprofile' and not (_under_gevent() or threading.current_thread() is threading.main_thread()):
+        raise ValueError("cprofile mode needs the main thread or a gevent worker; use sample mode")
+    with _lock:
+        if _session is not None:
+            raise RuntimeError(f"A profile is already running ({_session.output})")
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        session = _Session(prefix, seconds, mode)
+        _session = session
+    if mode == 'sample':
+        _original('_thread', 'start_new_thread')(_sample_loop, (session,))
+    else:
+        session.profile = cProfile.Profile()
+        session.profile.enable()
+        if _under_gevent():
+            import gevent
+            gevent.spawn_later(seconds, _finish, session)
+        else:
+            signal.signal(signal.SIGALRM, lambda signum, frame: _finish(session))
+            signal.setitimer(signal.ITIMER_REAL, seconds)
+    logging.info("Profiling (%s) for %ds into %s", mode, seconds, session.output)
+    return session.status()
+
+
+def _frame_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)})'
+
+
+def _sample_loop(session):
+    sleep = _original('time', 'sleep')
+    me = _get_ident()
+    names = {}
+    while _session is session and time.perf_counter() < session.deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if ident not in names:
+                names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            name = names.setdefault(ident, f'thread-{ident}')
+            root = [name]
+            stage = _active_spans.get(ident)
+            if stage:
+                root.append(f'[{stage}]')
+            key = ';'.join(root + stack[::-1])
+            session.stacks[key] = session.stacks.get(key, 0) + 1
+        session.samples += 1
+        sleep(SAMPLE_INTERVAL)
+    _finish(session)
+
+
+def _finish(session):
+    global _session
+    with _lock:
+        if _session is not session:
+            return
+        _session = None
+    _active_spans.clear()
+    try:
+        if session.profile is not None:
+            session.profile.disable()
+            session.profile.dump_stats(session.output)
+        else:
+            with open(session.output, 'w') as f:
+                for stack, count in sorted(list(session.stacks.items())):
+                    f.write(f'{stack} {count}\n')
+        spans = {stage: {'count': count, 'total_s': round(total, 6), 'mean_ms': round(total / count * 1000, 3),
+                         'max_ms': round(longest * 1000, 3)}
+                 for stage, (count, total, longest) in sorted(session.spans.items())}
+        with open(session.base + '.spans.json', 'w') as f:
+            json.dump({'mode': session.mode, 'started': session.started, 'seconds': session.seconds,
+                       'samples': session.samples, 'spans': spans}, f, indent=2)
+        logging.info("Profile written to %s", session.output)
+    except Exception as e:
+        logging.error("Failed to write profile %s: %s", session.output, e)
+
+
+def install_signal_handlers(prefix, seconds=DEFAULT_SECONDS):
+    """SIGUSR1 starts a sampled profile, SIGUSR2 a cProfile of the main thread."""
+    def handler(signum, frame):
+        mode = 'sample' if signum == signal.SIGUSR1 else 'cprofile'
+        try:
+            start(prefix, seconds, mode)
+        except (RuntimeError, ValueError) as e:
+            logging.warning("Profile request ignored: %s", e)
+    signal.signal(signal.SIGUSR1, handler)
+    signal.signal(signal.SIGUSR2, handler)
@@ -0,0 +1,96 @@
+"""Token-bucket rate limits keyed by IMEI or client address.
+
+Each key gets a bucket of `burst` tokens refilled at `rate` tokens per
+second; a request spends one token (or `cost`). Buckets are created on
+first use, refilled lazily when touched and dropped once full and unused,
+so an idle fleet costs nothing and the table stays bounded by the keys
+active within the last burst / rate seconds.
+
+The ingest servers limit AVL frames per IMEI, refusing a frame over the
+limit unACKed so the unit resends it later; the API limits command
+enqueues per IMEI and requests per client and answers 429 with
+Retry-After. Limits are per process: each gunicorn worker keeps its own
+buckets.
+"""
+import os
+import threading
+import time
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+class KeyedLimiter:
+    """Token buckets keyed by any hashable; thread-safe. rate <= 0 disables the limiter."""
+
+    PRUNE_EVERY = 1024  # Calls between sweeps for full buckets
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.lock = threading.Lock()
+        self.buckets = {}  # key -> [tokens, last refill (monotonic)]
+        self.calls = 0
+
+    def acquire(self, key, cost=1):
+        """Spend cost tokens if available. Returns 0.0 when allowed, else the seconds until it would be."""
+        if self.rate <= 0:
+            return 0.0
+        return self.acquire_all((key,), cost).get(key, 0.0)
+
+    def acquire_all(self, keys, cost=1):
+        """Spend cost tokens from every key's bucket, or from none of them.
+
+        Returns {} when all were spent, else {key: seconds until it would be
+        allowed} for the keys that are short, with no bucket touched.
+        """
+        if self.rate <= 0:
+            return {}
+        now = time.monotonic()
+        with self.lock:
+            self.calls += 1
+            if self.calls % self.PRUNE_EVERY == 0:
+                self._prune(now)
+            buckets = [self._refill(key, now) for key in keys]
+            waits = {key: (cost - bucket[0]) / self.rate for key, bucket in zip(keys, buckets) if bucket[0] < cost}
+            if not waits:
+                for bucket in buckets:
+                    bucket[0] -= cost
+            return waits
+
+    def _refill(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def _prune(self, now):
+        full_after = self.burst / self.rate
+        for key in [key for key, (_, last) in self.buckets.items() if now - last >= full_after]:
+            del self.buckets[key]
+
+
+# Ingest: AVL frames per IMEI. A unit on a sane config sends a frame every few minutes at most
+INGEST_RATE = _env_float('FMB_INGEST_RATE', 0.2)  # Frames per second per IMEI; 0 disables
+INGEST_BURST = _env_float('FMB_INGEST_BURST', 10)
+# API: command enqueues per IMEI, and requests per client address
+COMMAND_RATE = _env_float('FMB_COMMAND_RATE', 0.1)
+COMMAND_BURST = _env_float('FMB_COMMAND_BURST', 5)
+CLIENT_RATE = _env_float('FMB_CLIENT_RATE', 20)
+CLIENT_BURST = _env_float('FMB_CLIENT_BURST', 100)
+
+
+def ingest_limiter():
+    return KeyedLimiter(INGEST_RATE, INGEST_BURST)
+
+
+def command_limiter():
+    return KeyedLimiter(COMMAND_RATE, COMMAND_BURST)
+
+
+def client_limiter():
+    return KeyedLimiter(CLIENT_RATE, CLIENT_BURST)
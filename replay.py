@@ -0,0 +1,261 @@
+"""Replay raw captures recorded by the ingest server (see capture.py).
+
+    python replay.py info captures/*.fmbcap
+    python replay.py decode captures/*.fmbcap --speed 0 --loops 20   # decoder only, max speed
+    python replay.py decode captures/*.fmbcap --check                # decoded counts vs captured ACKs
+    python replay.py send captures/*.fmbcap --port 50122 --speed 4   # against a running server, 4x
+    python replay.py corpus captures/*.fmbcap --out corpus           # append frames to the bench corpus
+
+--speed 1 reproduces the captured inter-packet timing, N divides it by N and
+0 sends/decodes as fast as possible. In send mode each session also waits
+(up to --timeout) for as many server bytes as were captured before its next
+device packet, so replays stay in lockstep with the server at any speed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import sys
+import time
+
+import capture
+from fmb_codec import AVL_CODECS, COMMAND_CODECS, decode_avl_packet, parse_codec12_response
+
+CODEC_8E = 0x8E
+CODEC_12 = 0x0C
+
+
+def inbound_stream(events):
+    return b''.join(payload for _, kind, payload in events if kind == capture.EVENT_IN)
+
+
+def captured_acks(events):
+    """Record counts the server ACKed: 4-byte server packets after the handshake."""
+    return [struct.unpack('>I', payload)[0] for _, kind, payload in events
+            if kind == capture.EVENT_OUT and len(payload) == 4]
+
+
+def frame_arrivals(events, frames, handshake_length):
+    """Capture time of the device packet that completed each frame."""
+    ends = []
+    received = 0
+    for timestamp, kind, payload in events:
+        if kind == capture.EVENT_IN:
+            received += len(payload)
+            ends.append((received, timestamp))
+    arrivals = []
+    offset = handshake_length
+    index = 0
+    for frame in frames:
+        offset += len(frame)
+        while index < len(ends) - 1 and ends[index][0] < offset:
+            index += 1
+        arrivals.append(ends[index][1])
+    return arrivals
+
+
+def load_all(paths):
+    """[(path, session, entry)] across every capture, in file order."""
+    sessions = []
+    for path in paths:
+        for session, entry in capture.load_sessions(path).items():
+            sessions.append((path, session, entry))
+    return sessions
+
+
+def cmd_info(args):
+    for path, session, entry in load_all(args.captures):
+        events = entry['events']
+        imei, frames, trailing = capture.split_frames(inbound_stream(events))
+        codecs = {}
+        for frame in frames:
+            codecs[f'{frame[8]:#04x}'] = codecs.get(f'{frame[8]:#04x}', 0) + 1
+        bytes_in = sum(len(p) for _, kind, p in events if kind == capture.EVENT_IN)
+        bytes_out = sum(len(p) for _, kind, p in events if kind == capture.EVENT_OUT)
+        duration = events[-1][0] - events[0][0] if events else 0.0
+        print(f"{os.path.basename(path)}#{session} {entry['addr']} imei={imei} {duration:.3f}s "
+              f"in={bytes_in}B out={bytes_out}B frames={codecs} trailing={len(trailing)}B")
+
+
+def decode_frames(frames, imei):
+    """Decode one session's frames; returns (records, errors, decoded_counts)."""
+    records = errors = 0
+    counts = []
+    for frame in frames:
+        codec = frame[8]
+        try:
+            if codec in AVL_CODECS:
+                number_of_data, _ = decode_avl_packet(frame, imei)
+                counts.append(number_of_data)
+                records += number_of_data
+            elif codec in COMMAND_CODECS:
+                if parse_codec12_response(frame) is None:
+                    errors += 1
+        except Exception:
+            errors += 1
+            counts.append(0)
+    return records, errors, counts
+
+
+def cmd_decode(args):
+    sessions = []
+    for path, session, entry in load_all(args.captures):
+        imei, frames, _ = capture.split_frames(inbound_stream(entry['events']))
+        arrivals = frame_arrivals(entry['events'], frames, 2 + len(imei or ''))
+        sessions.append((f'{os.path.basename(path)}#{session}', imei, frames, arrivals, captured_acks(entry['events'])))
+
+    mismatches = []
+    total_records = total_frames = total_errors = 0
+    started = time.perf_counter()
+    for _ in range(args.loops):
+        for name, imei, frames, arrivals, acks in sessions:
+            records = errors = 0
+            counts = []
+            for index, frame in enumerate(frames):
+                if args.speed and index:
+                    time.sleep(max(0.0, arrivals[index] - arrivals[index - 1]) / args.speed)
+                frame_records, frame_errors, frame_counts = decode_frames([frame], imei)
+                records += frame_records
+                errors += frame_errors
+                counts.extend(frame_counts)
+            total_records += records
+            total_errors += errors
+            total_frames += len(frames)
+            if args.check and [c for c in counts if c] != acks:
+                mismatches.append((name, counts, acks))
+    elapsed = time.perf_counter() - started
+
+    summary = {
+        'sessions': len(sessions), 'loops': args.loops, 'frames': total_frames, 'records': total_records,
+        'errors': total_errors, 'elapsed_s': round(elapsed, 4),
+        'records_per_s': round(total_records / elapsed, 1) if elapsed else 0.0,
+        'frames_per_s': round(total_frames / elapsed, 1) if elapsed else 0.0,
+    }
+    if args.check:
+        summary['ack_mismatches'] = len(mismatches)
+    print(json.dumps(summary, indent=2) if args.json else
+          f"{summary['frames']} frames / {summary['records']} records in {summary['elapsed_s']}s "
+          f"({summary['records_per_s']} records/s, {summary['frames_per_s']} frames/s), {summary['errors']} errors")
+    for name, counts, acks in mismatches[:20]:
+        print(f"  ACK mismatch {name}: decoded {counts}, captured ACKs {acks}")
+    return 1 if mismatches or (args.check and total_errors) else 0
+
+
+async def replay_session(name, events, args, results):
+    """Send one session's device bytes to the server, keeping the captured timing and turn-taking."""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), args.timeout)
+    pending_out = 0
+    last_in = None
+    received = mismatched = 0
+    try:
+        for timestamp, kind, payload in events:
+            if kind == capture.EVENT_OUT:
+                pending_out += len(payload)
+            elif kind == capture.EVENT_IN:
+                if pending_out:
+                    try:
+                        got = await asyncio.wait_for(reader.readexactly(pending_out), args.timeout)
+                        received += len(got)
+                    except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                        mismatched += 1
+                    pending_out = 0
+                if args.speed and last_in is not None:
+                    await asyncio.sleep((timestamp - last_in) / args.speed)
+                last_in = timestamp
+                writer.write(payload)
+                await writer.drain()
+        if pending_out:
+            try:
+                received += len(await asyncio.wait_for(reader.readexactly(pending_out), args.timeout))
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                mismatched += 1
+    finally:
+        writer.close()
+    results[name] = {'received': received, 'response_mismatches': mismatched}
+
+
+async def run_send(args):
+    sessions = [(f'{os.path.basename(path)}#{session}', entry['events'])
+                for path, session, entry in load_all(args.captures)]
+    results = {}
+    errors = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(name, events):
+        async with semaphore:
+            try:
+                await replay_session(name, events, args, results)
+            except (asyncio.TimeoutError, ConnectionError, OSError) as e:
+                errors[name] = type(e).__name__
+
+    started = time.perf_counter()
+    for _ in range(args.loops):
+        await asyncio.gather(*(bounded(name, events) for name, events in sessions))
+    return results, errors, time.perf_counter() - started
+
+
+def cmd_send(args):
+    results, errors, elapsed = asyncio.run(run_send(args))
+    mismatched = sum(r['response_mismatches'] for r in results.values())
+    print(f"{len(results)} sessions replayed in {elapsed:.3f}s, {mismatched} response mismatches, "
+          f"{len(errors)} failed")
+    for name, error in list(errors.items())[:20]:
+        print(f"  {name}: {error}")
+    return 1 if errors else 0
+
+
+def cmd_corpus(args):
+    """Append captured frames, one hex line each, to the bench_codec corpus files."""
+    written = {CODEC_8E: 0, CODEC_12: 0}
+    files = {CODEC_8E: 'codec8e.hex', CODEC_12: 'codec12.hex'}
+    os.makedirs(args.out, exist_ok=True)
+    handles = {codec: open(os.path.join(args.out, name), 'a') for codec, name in files.items()}
+    try:
+        for _, _, entry in load_all(args.captures):
+            _, frames, _ = capture.split_frames(inbound_stream(entry['events']))
+            for frame in frames:
+                if frame[8] in handles:
+                    handles[frame[8]].write(frame.hex() + '\n')
+                    written[frame[8]] += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+    print(f"Appended {written[CODEC_8E]} Codec 8E and {written[CODEC_12]} Codec 12 frames to {args.out}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay ingest server captures')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    info = sub.add_parser('info', help='Summarise sessions in captures')
+    info.add_argument('captures', nargs='+')
+
+    decode = sub.add_parser('decode', help='Feed captured frames to the decoder')
+    decode.add_argument('captures', nargs='+')
+    decode.add_argument('--speed', type=float, default=0.0, help='1 = captured timing, N = N times faster, 0 = max')
+    decode.add_argument('--loops', type=int, default=1)
+    decode.add_argument('--check', action='store_true', help='Exit 1 if decoded record counts differ from captured ACKs')
+    decode.add_argument('--json', action='store_true')
+
+    send = sub.add_parser('send', help='Replay captured device traffic against a running server')
+    send.add_argument('captures', nargs='+')
+    send.add_argument('--host', default='127.0.0.1')
+    send.add_argument('--port', type=int, default=50122)
+    send.add_argument('--speed', type=float, default=1.0, help='1 = captured timing, N = N times faster, 0 = max')
+    send.add_argument('--loops', type=int, default=1)
+    send.add_argument('--concurrency', type=int, default=100, help='Sessions replayed at once')
+    send.add_argument('--timeout', type=float, default=10.0)
+
+    corpus = sub.add_parser('corpus', help='Append captured frames to a bench_codec corpus directory')
+    corpus.add_argument('captures', nargs='+')
+    corpus.add_argument('--out', default='corpus')
+
+    args = parser.parse_args()
+    handlers = {'info': cmd_info, 'decode': cmd_decode, 'send': cmd_send, 'corpus': cmd_corpus}
+    sys.exit(handlers[args.command](args) or 0)
+
+
+if __name__ == '__main__':
+    main()
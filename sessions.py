@@ -0,0 +1,177 @@
+"""Deadlines for device connections, kept in one hashed timer wheel.
+
+Every TCP session has exactly one live deadline, set for the phase it is
+in:
+
+    handshake  accept -> IMEI acknowledged          FMB_HANDSHAKE_TIMEOUT (30 s)
+    frame      waiting for an AVL frame's bytes      FMB_FRAME_TIMEOUT (120 s)
+    idle       connected, server busy or no traffic  FMB_IDLE_TIMEOUT (600 s)
+
+Entering a phase replaces the deadline in O(1); a single reaper thread
+advances the wheel once per TICK and shuts down the sockets of expired
+sessions, which makes the handler's blocked recv() return so it can clean
+up. Silent or half-open connections (common through ngrok and cellular
+NAT) therefore cannot hold a handler forever, and idle sockets cost a
+dict entry and a wheel slot entry each, not a timer or thread.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+import metrics
+
+TICK = 1.0  # Seconds per wheel slot; deadlines fire up to one tick late
+SLOTS = 512  # One revolution; longer deadlines wait out extra rounds in their slot
+PHASE_TIMEOUTS = {
+    'handshake': float(os.environ.get('FMB_HANDSHAKE_TIMEOUT', 30)),
+    'frame': float(os.environ.get('FMB_FRAME_TIMEOUT', 120)),
+    'idle': float(os.environ.get('FMB_IDLE_TIMEOUT', 600)),
+}
+
+REAPED = metrics.Counter('fmb_sessions_reaped_total', 'Device connections closed on an expired deadline', ('phase',))
+SESSIONS = metrics.Gauge('fmb_sessions_tracked', 'Device connections with a live deadline')
+
+
+class TimerWheel:
+    """Hashed timing wheel mapping keys to deadlines; not thread-safe (SessionReaper locks around it).
+
+    schedule() and cancel() are O(1). Cancelled and rescheduled entries are
+    left in their old slot and skipped when it comes round, so advance()
+    is O(1) amortised per scheduled deadline.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS, now=None):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.deadlines = {}  # key -> deadline; the only entry that counts for the key
+        self.current = int((time.monotonic() if now is None else now) / tick)  # Next tick to process
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        # Never behind the cursor, or the entry would wait a whole revolution
+        tick = max(int(deadline / self.tick), self.current)
+        self.slots[tick % len(self.slots)].append((deadline, key))
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def advance(self, now):
+        """Pop and return the keys whose deadline is at or before now."""
+        expired = []
+        last = int(now / self.tick)
+        slot_count = len(self.slots)
+        while self.current <= last:
+            index = self.current % slot_count
+            entries, self.slots[index] = self.slots[index], []
+            for deadline, key in entries:
+                if self.deadlines.get(key) != deadline:
+                    continue  # Cancelled or rescheduled since
+                if deadline <= now:
+                    del self.deadlines[key]
+                    expired.append(key)
+                else:
+                    self.slots[index].append((deadline, key))  # Later this tick, or a later round
+            if self.current == last:
+                break  # The current tick is revisited until the clock moves past it
+            self.current += 1
+        return expired
+
+
+class Session:
+    __slots__ = ('conn', 'addr', 'phase', 'imei')
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.phase = None
+        self.imei = None
+
+
+class SessionReaper:
+    """Tracks open device sessions and closes those that overstay their phase's deadline."""
+
+    def __init__(self, timeouts=None, tick=TICK):
+        self.timeouts = dict(PHASE_TIMEOUTS, **(timeouts or {}))
+        self.lock = threading.Lock()
+        self.wheel = TimerWheel(tick)
+        self.thread = None
+        self.stopped = threading.Event()
+        self.drain_at = None  # Set by drain(); caps every deadline from then on
+        self.drain_applied = False
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='session-reaper', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def drain(self, seconds):
+        """Cap every deadline, current and future, at seconds from now; for shutdown.
+
+        Only sets attributes, so it is safe to call from a signal handler; the
+        reaper thread reschedules the existing deadlines on its next tick.
+        """
+        self.drain_at = time.monotonic() + seconds
+
+    def open(self, conn, addr):
+        """Track a new connection, starting in the handshake phase."""
+        session = Session(conn, addr)
+        self.enter(session, 'handshake')
+        SESSIONS.set(len(self.wheel))
+        return session
+
+    def enter(self, session, phase):
+        """Move a session to phase and restart its deadline from now."""
+        session.phase = phase
+        deadline = time.monotonic() + self.timeouts[phase]
+        if self.drain_at is not None:
+            deadline = min(deadline, self.drain_at)
+        with self.lock:
+            self.wheel.schedule(session, deadline)
+
+    def close(self, session):
+        """Stop tracking a session the handler has finished with."""
+        with self.lock:
+            self.wheel.cancel(session)
+            SESSIONS.set(len(self.wheel))
+
+    def reap(self, now=None):
+        """Shut down every session whose deadline has passed; returns them."""
+        with self.lock:
+            if self.drain_at is not None and not self.drain_applied:
+                for session, deadline in list(self.wheel.deadlines.items()):
+                    if deadline > self.drain_at:
+                        self.wheel.schedule(session, self.drain_at)
+                self.drain_applied = True
+            expired = self.wheel.advance(time.monotonic() if now is None else now)
+            SESSIONS.set(len(self.wheel))
+        for session in expired:
+            REAPED.labels(session.phase).inc()
+            if self.drain_at is not None:
+                logging.warning("Closing %s connection from %s (IMEI %s) to finish draining",
+                                session.phase, session.addr, session.imei, extra={'addr': session.addr, 'imei': session.imei})
+            else:
+                logging.warning("Closing %s connection from %s (IMEI %s): no progress within %.0fs",
+                                session.phase, session.addr, session.imei, self.timeouts[session.phase],
+                                extra={'addr': session.addr, 'imei': session.imei})
+            try:
+                # shutdown, not close: the handler still owns the descriptor and closes it itself
+                session.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return expired
+
+    def _run(self):
+        while not self.stopped.wait(self.wheel.tick):
+            try:
+                self.reap()
+            except Exception as e:
+                logging.error("Session reaper failed: %s", e)
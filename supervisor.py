@@ -0,0 +1,268 @@
+"""Process supervisor for the ingest server and its ngrok tunnel.
+
+Replaces service_runner.sh's once-a-minute `ps -p` loop:
+
+- each child (tcp_server_v8.py, ngrok) is awaited directly, so an exit is
+  noticed immediately and the child restarted after an exponential backoff
+  (RESTART_BACKOFF doubling up to MAX_BACKOFF, reset once a child has run
+  for STABLE_AFTER seconds);
+- the tunnel's public address is read from ngrok's local agent API
+  (FMB_TUNNEL_API) every TUNNEL_POLL seconds instead of grepping ngrok.log;
+- when it changes, the FMB920 is sent `setparam 2004:<host>;2005:<port>`
+  and `cpureset` by SMS through one pooled HTTP session, re-authenticating
+  on 401 and retrying a bounded SMS_RETRIES times with backoff. A failed
+  reconfiguration is retried RECONFIGURE_ATTEMPTS times per address, with
+  RECONFIGURE_BACKOFF doubling between them, then not again until the
+  address changes: every attempt is paid SMS.
+
+The ingest server's stdout/stderr go to SERVER_OUTPUT; tcp_server_v8.log
+is written and rotated by the server itself.
+
+SIGTERM/SIGINT stop the children (the ingest server drains, see handoff)
+and exit; SIGHUP is passed to the ingest server for an in-place restart.
+
+    python supervisor.py
+    python supervisor.py --no-tunnel   # devices reach the server directly; no ngrok, no SMS
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import log_setup
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_FILE = 'supervisor.log'
+SERVER_OUTPUT = 'tcp_server_v8.out'  # Not tcp_server_v8.log, which the server's own handler rotates
+NGROK = os.environ.get('FMB_NGROK', '/snap/bin/ngrok')
+NGROK_LOG = 'ngrok.log'
+PORT = 50122  # As tcp_server_v8.PORT
+TUNNEL_API = os.environ.get('FMB_TUNNEL_API', 'http://127.0.0.1:4040/api/tunnels')
+TUNNEL_POLL = 2.0
+RESTART_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+STABLE_AFTER = 60.0  # A child that ran this long restarts without backoff
+STOP_TIMEOUT = 45.0  # Must exceed handoff.DRAIN_TIMEOUT so the ingest server can finish draining
+
+SMS_API = 'https://api.worldov.net/v1'
+ICCID = os.environ.get('FMB_ICCID', '8944538532057627725')
+AUTH_FILE = 'auth.conf'  # user=... / mdp=... lines
+TOKEN_FILE = 'auth_token.conf'
+SMS_PREFIX = ' 0224 '  # SMS login and password prefix the FMB920 expects, as in service_runner.sh
+SMS_RETRIES = 5
+SMS_TIMEOUT = 15
+CPURESET_DELAY = 8  # Seconds between setparam and cpureset, so the parameters are saved first
+RECONFIGURE_ATTEMPTS = 3  # Per tunnel address
+RECONFIGURE_BACKOFF = 60.0  # Seconds before the second attempt, doubling after that
+
+
+class Child:
+    """A supervised process: started, awaited and restarted with backoff until stop() is called."""
+
+    def __init__(self, name, argv, log_path):
+        self.name = name
+        self.argv = argv
+        self.log_path = log_path
+        self.process = None
+        self.restarts = 0
+
+    async def run(self, stopping):
+        failures = 0
+        while not stopping.is_set():
+            started = time.monotonic()
+            try:
+                with open(self.log_path, 'ab') as log:
+                    self.process = await asyncio.create_subprocess_exec(
+                        *self.argv, stdout=log, stderr=asyncio.subprocess.STDOUT)
+                logging.info("Started %s (PID %d)", self.name, self.process.pid)
+                returncode = await self.process.wait()
+            except OSError as e:
+                returncode = None
+                logging.error("Could not start %s: %s", self.name, e)
+            if stopping.is_set():
+                return
+            failures = 0 if time.monotonic() - started >= STABLE_AFTER else failures + 1
+            delay = min(MAX_BACKOFF, RESTART_BACKOFF * 2 ** max(failures - 1, 0))
+            self.restarts += 1
+            logging.error("%s exited with %s; restarting in %.1fs (restart %d)",
+                          self.name, returncode, delay, self.restarts)
+            try:
+                await asyncio.wait_for(stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def send_signal(self, signum):
+        if self.process is not None and self.process.returncode is None:
+            self.process.send_signal(signum)
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error("%s did not stop within %.0fs; killing it", self.name, STOP_TIMEOUT)
+            self.process.kill()
+            await self.process.wait()
+
+
+class DeviceConfigurator:
+    """Points the FMB920 at a new tunnel address by SMS, over one pooled HTTP session; blocking."""
+
+    def __init__(self, iccid=ICCID, auth_file=AUTH_FILE, token_file=TOKEN_FILE):
+        self.iccid = iccid
+        self.auth_file = auth_file
+        self.token_file = token_file
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.http.headers.update({'accept': 'application/json', 'content-type': 'application/*+json'})
+        self.token = self._read_token()
+
+    def _read_token(self):
+        try:
+            with open(self.token_file) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _credentials(self):
+        values = {}
+        with open(self.auth_file) as f:
+            for line in f:
+                key, _, value = line.strip().partition('=')
+                values[key] = value
+        return values.get('user'), values.get('mdp')
+
+    def login(self):
+        username, password = self._credentials()
+        response = self.http.post(f'{SMS_API}/auth/login', data=json.dumps({'username': username, 'password': password}),
+                                  timeout=SMS_TIMEOUT)
+        response.raise_for_status()
+        body = response.json()
+        self.token = body.get('token') or body.get('access_token') or body.get('accessToken')
+        if not self.token:
+            raise ValueError(f"No token in login response (keys: {sorted(body)})")
+        with open(self.token_file, 'w') as f:
+            f.write(self.token)
+        logging.info("Authenticated with the SMS API")
+
+    def send_sms(self, text):
+        """Send one SMS to the device; True once the API accepts it, False after SMS_RETRIES attempts."""
+        for attempt in range(1, SMS_RETRIES + 1):
+            try:
+                if not self.token:
+                    self.login()
+                response = self.http.post(f'{SMS_API}/sms/system/sim/{self.iccid}', data=json.dumps({'text': text}),
+                                          headers={'Authorization': f'Bearer {self.token}'}, timeout=SMS_TIMEOUT)
+                if response.status_code == 200:
+                    logging.info("SMS '%s' sent to ICCID %s", text, self.iccid)
+                    return True
+                if response.status_code == 401:
+                    self.token = None  # Log in again on the next attempt
+                logging.warning("SMS '%s' attempt %d failed with HTTP %d", text, attempt, response.status_code)
+            except (requests.RequestException, ValueError, OSError) as e:
+                logging.warning("SMS '%s' attempt %d failed: %s", text, attempt, e)
+            if attempt < SMS_RETRIES:
+                time.sleep(min(MAX_BACKOFF, RESTART_BACKOFF * 2 ** attempt))
+        logging.error("Giving up on SMS '%s' after %d attempts", text, SMS_RETRIES)
+        return False
+
+    def reconfigure(self, public_url):
+        """Send the device the tunnel's host and port, then restart it; True if both SMS went out."""
+        address = urlsplit(public_url)
+        if not address.hostname or not address.port:
+            logging.error("Cannot reconfigure the device for tunnel URL %s", public_url)
+            return False
+        if not self.send_sms(f'{SMS_PREFIX}setparam 2004:{address.hostname};2005:{address.port}'):
+            return False
+        time.sleep(CPURESET_DELAY)
+        return self.send_sms(f'{SMS_PREFIX}cpureset')
+
+
+def fetch_tunnel_url(http, port=PORT):
+    """public_url of the ngrok tunnel forwarding to port, or None if the agent has none (yet)."""
+    try:
+        response = http.get(TUNNEL_API, timeout=2)
+        response.raise_for_status()
+        for tunnel in response.json().get('tunnels', []):
+            addr = str(tunnel.get('config', {}).get('addr', ''))  # '50122' or 'localhost:50122'
+            if tunnel.get('proto') == 'tcp' and (addr == str(port) or addr.endswith(f':{port}')):
+                return tunnel.get('public_url')
+    except (requests.RequestException, ValueError) as e:
+        logging.debug("Tunnel API not available: %s", e)
+    return None
+
+
+async def watch_tunnel(configurator, stopping):
+    """Reconfigure the device whenever the tunnel's public address changes, a bounded number of times per address."""
+    loop = asyncio.get_running_loop()
+    local = requests.Session()
+    configured = None
+    pending, failures, retry_at = None, 0, 0.0  # Address not configured yet, failed attempts at it, next attempt
+    while not stopping.is_set():
+        url = await loop.run_in_executor(None, fetch_tunnel_url, local)
+        if url and url != configured:
+            if url != pending:
+                pending, failures, retry_at = url, 0, 0.0
+            if failures < RECONFIGURE_ATTEMPTS and time.monotonic() >= retry_at:
+                logging.info("Tunnel address is now %s (was %s)", url, configured)
+                if await loop.run_in_executor(None, configurator.reconfigure, url):
+                    configured, pending = url, None
+                else:
+                    failures += 1
+                    retry_at = time.monotonic() + RECONFIGURE_BACKOFF * 2 ** (failures - 1)
+                    if failures < RECONFIGURE_ATTEMPTS:
+                        logging.warning("Reconfiguring the device for %s failed; retrying in %.0fs",
+                                        url, retry_at - time.monotonic())
+                    else:
+                        logging.error("Giving up reconfiguring the device for %s after %d attempts; "
+                                      "will try again when the tunnel address changes", url, failures)
+        try:
+            await asyncio.wait_for(stopping.wait(), TUNNEL_POLL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def supervise(args):
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    server = Child('tcp_server_v8', [args.python, os.path.join(REPO_DIR, 'tcp_server_v8.py')], SERVER_OUTPUT)
+    children = [server]
+    tasks = []
+    if not args.no_tunnel:
+        children.append(Child('ngrok', [args.ngrok, 'tcp', str(PORT), '--log', NGROK_LOG], os.devnull))
+        tasks.append(asyncio.create_task(watch_tunnel(DeviceConfigurator(), stopping)))
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    loop.add_signal_handler(signal.SIGHUP, server.send_signal, signal.SIGHUP)
+    tasks += [asyncio.create_task(child.run(stopping)) for child in children]
+    logging.info("Supervising %s", ', '.join(child.name for child in children))
+    await stopping.wait()
+    logging.info("Stopping %s", ', '.join(child.name for child in children))
+    await asyncio.gather(*(child.stop() for child in children))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run and restart the ingest server and its tunnel')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter for tcp_server_v8.py')
+    parser.add_argument('--ngrok', default=NGROK)
+    parser.add_argument('--no-tunnel', action='store_true', help='Run without ngrok or SMS reconfiguration')
+    args = parser.parse_args()
+    log_setup.configure_from_env(LOG_FILE)
+    asyncio.run(supervise(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,379 +1,337 @@
 import logging
+import os
 import socket
 import struct
-from datetime import datetime, timezone
-import crcmod
+import time
 import requests
-
-# Configure logging
-logging.basicConfig(filename='tcp_server_v8.log', level=logging.INFO,
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+import capture
+import dedup
+import handoff
+import io_filter
+import io_schema
+import log_setup
+import metrics
+import profiler
+import ratelimit
+import sessions
+import tls
+import tracing
+import wire_format
+from fmb_codec import build_codec12_packet, decode_avl_packet, parse_codec12_response
 
 # Server configuration
 version = "8.0"
-HOST = '127.0.0.1'  # Localhost for cron
+HOST = os.environ.get('FMB_HOST', '127.0.0.1')  # Localhost behind ngrok; 0.0.0.0 to take devices directly (with TLS, see tls)
 PORT = 50122
 API_URL = 'https://iot.satgroupe.com'  # Adjust to your cPanel subdomain
-SYNC_DATA_URL = f'{API_URL}/syncing_data'
+SYNC_DATA_URL = f'{API_URL}/syncing_data'  # The Flask API's /positions/* only fill when this points at it
 COMMAND_QUEUE_URL = f'{API_URL}/command_queue'
+LOG_FILE = 'tcp_server_v8.log'  # Rotation, level and JSON output via FMB_LOG_* (see log_setup)
+# api.php only understands plain JSON; the Flask API also takes columnar/msgpack and gzip/br bodies
+FORWARD_FORMAT = os.environ.get('FMB_FORWARD_FORMAT', 'json')  # json | columnar | msgpack
+FORWARD_ENCODING = os.environ.get('FMB_FORWARD_ENCODING') or None  # gzip | br
+wire_format.check_forward_options(FORWARD_FORMAT, FORWARD_ENCODING)  # At startup rather than on every frame
 RESPONSE_TIMEOUT = 8
+# Connections a queued command is tried on before it is marked 'failed' (the Flask API tracks the count)
+COMMAND_ATTEMPTS = int(os.environ.get('FMB_COMMAND_ATTEMPTS', 3))
 DOUT1_IO_ID = 179  # Added for DOUT1 control (from old script)
 POWER_IO_ID = 66   # Power status (from prior context)
 TIMEOUT_12H = 12 * 3600
 ACTIVATION_DURATION = 4000
-crc16 = crcmod.mkCrcFun(0x18005, initCrc=0x0000, rev=True)  # Updated to old script's CRC config
+METRICS_PORT = int(os.environ.get('FMB_METRICS_PORT', 9108))  # Local /metrics endpoint; 0 disables it
+# Raw traffic capture for replay.py: set FMB_CAPTURE_DIR (and FMB_CAPTURE_GZIP=1 to compress)
+# kill -USR1 <pid> samples stacks, -USR2 runs cProfile, for FMB_PROFILE_SECONDS (see profiler)
 
-def verify_crc(data, expected_crc):
-    calculated_crc = crc16(data)
-    return calculated_crc == expected_crc
+# Metrics (children resolved once so the hot path only does the observation)
+CONNECTIONS = metrics.Counter('fmb_connections_total', 'Device connections accepted')
+ACTIVE_CONNECTIONS = metrics.Gauge('fmb_active_connections', 'Device connections currently open')
+HANDSHAKES = metrics.Counter('fmb_handshakes_total', 'IMEI handshakes by result', ('result',))
+HANDSHAKE_SECONDS = metrics.Histogram('fmb_handshake_seconds', 'Time from accept to IMEI acknowledgment')
+FRAMES = metrics.Counter('fmb_frames_total', 'AVL frames received by result', ('result',))
+RECORDS = metrics.Counter('fmb_records_total', 'AVL records decoded')
+DUPLICATE_RECORDS = metrics.Counter('fmb_duplicate_records_total', 'Resent AVL records ACKed but not forwarded')
+DECODE_SECONDS = metrics.Histogram('fmb_decode_seconds', 'AVL frame (Codec 8/8E/16) decode time')
+FORWARDS = metrics.Counter('fmb_forwards_total', 'Record batches forwarded to the API by result', ('result',))
+FORWARD_SECONDS = metrics.Histogram('fmb_forward_seconds', 'POST of a record batch to /syncing_data')
+COMMANDS = metrics.Counter('fmb_commands_total', 'Codec 12 commands sent by result', ('result',))
+COMMAND_SECONDS = metrics.Histogram('fmb_command_round_trip_seconds', 'Codec 12 command sent to response received')
+DEVICE_LAG_SECONDS = metrics.Histogram('fmb_device_lag_seconds', 'Newest record timestamp in a frame to frame receipt',
+                                       buckets=tracing.LAG_BUCKETS)
+HANDSHAKE_OK, HANDSHAKE_FAILED = HANDSHAKES.labels('ok'), HANDSHAKES.labels('failed')
+FRAMES_ACKED, FRAMES_REJECTED, FRAMES_THROTTLED = FRAMES.labels('acked'), FRAMES.labels('rejected'), FRAMES.labels('throttled')
+FORWARDS_OK, FORWARDS_FAILED = FORWARDS.labels('ok'), FORWARDS.labels('failed')
+COMMANDS_OK, COMMANDS_FAILED, COMMANDS_TIMEOUT = COMMANDS.labels('ok'), COMMANDS.labels('failed'), COMMANDS.labels('timeout')
 
-def parse_timestamp(data, offset, length=8):
-    try:
-        if len(data[offset:offset+length]) != length:
-            logging.error(f"Insufficient data for timestamp at offset {offset}, length {length}, packet: {data.hex()}")
-            return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-        timestamp_ms = int.from_bytes(data[offset:offset+length], byteorder='big')
-        if not isinstance(timestamp_ms, int):
-            logging.error(f"timestamp_ms is not an integer: {type(timestamp_ms)} {timestamp_ms}")
-            return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-        timestamp_s = timestamp_ms / 1000.0
-        epoch_start = 0
-        epoch_end = 2147483647
-        if timestamp_s < epoch_start or timestamp_s > epoch_end:
-            logging.error(f"Invalid timestamp_ms: {timestamp_ms} (seconds: {timestamp_s}), packet: {data.hex()}")
-            return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-        timestamp = datetime.fromtimestamp(timestamp_s, tz=timezone.utc)
-        formatted_timestamp = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        logging.debug(f"Parsed timestamp: {formatted_timestamp} from {timestamp_ms}ms")
-        return formatted_timestamp
-    except Exception as e:
-        logging.error(f"Failed to parse timestamp at offset {offset}: {e}, raw data: {data[offset:offset+length].hex()}, full packet: {data.hex()}")
-        return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+# Records forwarded recently per IMEI; resends of frames whose ACK was lost are dropped here
+recent_records = dedup.RecentRecords()
+# AVL frames per IMEI (FMB_INGEST_RATE/BURST, see ratelimit)
+ingest_limits = ratelimit.ingest_limiter()
+# Names, signedness and scale of IO elements per device model (FMB_IO_SCHEMA, see io_schema)
+io_schemas = io_schema.load()
+# Allow-list, deadband and heartbeat per IO id before forwarding (FMB_IO_*, see io_filter)
+io_filters = io_filter.IoFilter() if io_filter.ENABLED else None
 
-def build_codec12_packet(command):
-    command_bytes = command.encode('ascii')
-    command_length = len(command_bytes)
-    data_field = struct.pack('>BBBI', 0x0C, 0x01, 0x05, command_length) + command_bytes + struct.pack('>B', 0x01)
-    crc = crc16(data_field)
-    packet = struct.pack('>I', 0) + struct.pack('>I', len(data_field)) + data_field + struct.pack('>I', crc)
-    return packet
 
-def parse_codec12_response(data):
-    try:
-        response=data[15:-5].decode("utf-8")
-        logging.info(f"Command response parsed: {response}")
-        """ if len(data) < 14:
-            logging.error(f"Codec 12 response too short: {len(data)} bytes, packet: {data.hex()}")
-            return None
-        offset = 0
-        preamble = struct.unpack('>I', data[offset:offset+4])[0]
-        if preamble != 0:
-            logging.error(f"Invalid preamble: {preamble}, packet: {data.hex()}")
-            return None
-        offset += 4
-        data_length = struct.unpack('>I', data[offset:offset+4])[0]
-        offset += 4
-        codec_id = data[offset]
-        if codec_id != 0x0C:
-            logging.error(f"Invalid codec ID: {codec_id}, packet: {data.hex()}")
-            return None
-        offset += 1
-        quantity1 = data[offset]
-        offset += 1
-        response_type = data[offset]
-        if response_type != 0x06:
-            logging.error(f"Invalid response type: {response_type}, packet: {data.hex()}")
-            return None
-        offset += 1
-        response_length = struct.unpack('>I', data[offset:offset+4])[0]
-        offset += 4
-        response = data[offset:offset+response_length].decode('ascii', errors='ignore')
-        offset += response_length
-        quantity2 = data[offset]
-        if quantity1 != quantity2:
-            logging.error(f"Quantity mismatch: {quantity1} != {quantity2}, packet: {data.hex()}")
-            return None
-        crc = struct.unpack('>I', data[offset+1:offset+5])[0]
-        if not verify_crc(data[8:offset+1], crc):
-            logging.error(f"CRC check failed for Codec 12 response, packet: {data.hex()}")
-            return None
-        logging.info(f"Parsed Codec 12 response: type={response_type}, data='{response}'") """
-        return response
-    except Exception as e:
-        logging.error(f"Failed to parse Codec 12 response: {e}, packet: {data.hex()}")
-        return None
+def throttle_ingest(imei):
+    """False if imei is over its frame rate and the frame should be refused.
+
+    Connections are served one at a time by the accept loop, so waiting for
+    the bucket to refill here would hold up every other device. The frame is
+    left unread and the connection closed unACKed instead; the unit keeps
+    its records and resends them with a later upload.
+    """
+    wait = ingest_limits.acquire(imei)
+    if not wait:
+        return True
+    FRAMES_THROTTLED.inc()
+    logging.warning("IMEI %s is over its ingest rate (next frame in %.1fs); closing without reading", imei, wait,
+                    extra={'imei': imei})
+    return False
 
 def send_command_with_response(conn, command, imei):
     try:
         packet = build_codec12_packet(command)
-        conn.sendall(packet)
-        logging.info(f"Sent Codec 12 command to IMEI {imei}: {command}")
-        conn.settimeout(RESPONSE_TIMEOUT)
-        bad_format="unknown command or invalid format"
-        response_data = conn.recv(1024)
+        with profiler.span('command'):
+            sent = time.perf_counter()
+            conn.sendall(packet)
+            logging.info("Sent Codec 12 command to IMEI %s: %s", imei, command, extra={'imei': imei})
+            conn.settimeout(RESPONSE_TIMEOUT)
+            bad_format="unknown command or invalid format"
+            response_data = conn.recv(1024)
+            COMMAND_SECONDS.observe(time.perf_counter() - sent)
         response = parse_codec12_response(response_data)
         if response and bad_format != response:
-            logging.info(f"Command successful for IMEI {imei}: {response}")
-            return True
+            COMMANDS_OK.inc()
+            logging.info("Command successful for IMEI %s: %s", imei, response, extra={'imei': imei})
+            return response
         else:
-            logging.error(f"Command failed for IMEI {imei}: {response}")
-            return False
+            COMMANDS_FAILED.inc()
+            logging.error("Command failed for IMEI %s: %s", imei, response, extra={'imei': imei})
+            return None
     except socket.timeout:
-        logging.error(f"Timeout waiting for response from IMEI {imei} for command: {command}")
-        return False
+        COMMANDS_TIMEOUT.inc()
+        logging.error("Timeout waiting for response from IMEI %s for command: %s", imei, command, extra={'imei': imei})
+        return None
     except Exception as e:
-        logging.error(f"Error sending command to IMEI {imei}: {e}")
-        return False
+        COMMANDS_FAILED.inc()
+        logging.error("Error sending command to IMEI %s: %s", imei, e, extra={'imei': imei})
+        return None
     finally:
         conn.settimeout(None)
 
 def send_queued_commands(conn, imei):
     try:
-        response = requests.get(f"{COMMAND_QUEUE_URL}/{imei}", timeout=10)
+        queue_response = requests.get(f"{COMMAND_QUEUE_URL}/{imei}", timeout=10)
         
-        response.raise_for_status()
-        commands = response.json().get('commands', [])
-        logging.debug(f"Fetched {len(commands)} pending commands for IMEI {imei}")
+        queue_response.raise_for_status()
+        commands = queue_response.json().get('commands', [])
+        logging.debug("Fetched %d pending commands for IMEI %s", len(commands), imei)
         for command_entry in commands:
             command_id = command_entry['id']
             command = command_entry['command']
-            if send_command_with_response(conn, command, imei):
-                try:
-                    requests.post(f"{COMMAND_QUEUE_URL}/update/{command_id}", json={'status': 'completed'}, timeout=10)
-                    logging.info(f"Command {command_id} ('{command}') marked as completed for IMEI {imei}")
-                except requests.RequestException as e:
-                    logging.error(f"Failed to update command {command_id} status: {e}")
+            response = send_command_with_response(conn, command, imei)
+            if response:
+                update = {'status': 'completed', 'response': response}
             else:
-                logging.error(f"Command {command_id} ('{command}') failed for IMEI {imei}")
+                # Left pending for the next connection until the attempts run out, then failed so long-polls end
+                attempts = command_entry.get('attempts', 0) + 1
+                update = {'status': 'failed' if attempts >= COMMAND_ATTEMPTS else 'pending', 'attempts': attempts}
+            try:
+                # The response text lets API long-polls on /commands/<id> report what the device said
+                requests.post(f"{COMMAND_QUEUE_URL}/update/{command_id}", json=update, timeout=10)
+            except requests.RequestException as e:
+                logging.error("Failed to update command %s status: %s", command_id, e, extra={'command_id': command_id})
+                continue
+            if response:
+                logging.info("Command %s ('%s') marked as completed for IMEI %s", command_id, command, imei,
+                             extra={'imei': imei, 'command_id': command_id})
+            else:
+                logging.error("Command %s ('%s') failed for IMEI %s (attempt %d of %d), marked as %s", command_id,
+                              command, imei, update['attempts'], COMMAND_ATTEMPTS, update['status'],
+                              extra={'imei': imei, 'command_id': command_id})
     except requests.RequestException as e:
-        logging.error(f"Failed to fetch queued commands for IMEI {imei}: {e}")
+        logging.error("Failed to fetch queued commands for IMEI %s: %s", imei, e, extra={'imei': imei})
+
+def forward_payload(payload, trace=None):
+    body, content_type = wire_format.encode_batch(payload, FORWARD_FORMAT)
+    headers = {'Content-Type': content_type}
+    if FORWARD_ENCODING:
+        body = wire_format.compress(body, FORWARD_ENCODING)
+        headers['Content-Encoding'] = FORWARD_ENCODING
+    if trace is not None:
+        trace['sent'] = time.time()
+        headers.update(tracing.to_headers(trace))
+    return requests.post(SYNC_DATA_URL, data=body, headers=headers, timeout=10)
 
-def parse_avl_packet(data, imei, conn):
+def parse_avl_packet(data, imei, conn, received_at=None):
     try:
-        offset = 0
-        preamble = data[offset:offset+4]
-        if preamble != b'\x00\x00\x00\x00':
-            logging.warning(f"Invalid preamble: {preamble.hex()}, packet: {data.hex()}")
-            return 0
-        offset += 4
-        data_length = struct.unpack('>I', data[offset:offset+4])[0]
-        logging.info(f"data_length:{data_length}")
-        offset += 4
-        codec_id = data[offset]
-        offset += 1
-        if codec_id != 0x8E:
-            logging.warning(f"Unsupported codec ID: {codec_id}, codec ID_HEX: {codec_id.hex()}")
+        trace = tracing.new_trace(received_at)
+        with profiler.span('decode'), DECODE_SECONDS.time():
+            number_of_data, records = decode_avl_packet(data, imei,
+                                                        schema=io_schemas and io_schemas.for_imei(imei))
+        if not number_of_data:
             return 0
-        print(f"data: {data[offset]}")
-        number_of_data =data[offset]
-        
-        logging.info(f"Parsing {number_of_data} records for IMEI: {imei}, codec: {codec_id}")
-
-        # Verify CRC
-        """ crc = struct.unpack('>I', data[-4:])[0]
-        if not verify_crc(data[4:-4], crc):
-            logging.error(f"CRC check failed, packet: {data.hex()}")
-            return 0 """
-        offset += 1
-        records = []
-        for _ in range(number_of_data):
-            if offset + 8 > len(data) - 4:
-                logging.error(f"Insufficient data for timestamp in record {_+1}, packet: {data.hex()}")
-                break
-
-            timestamp = parse_timestamp(data, offset)
-            offset += 8
-            if not timestamp:
-                logging.error(f"Skipping record due to invalid timestamp, packet: {data.hex()}")
-                continue
-
-            if offset + 16 > len(data) - 4:
-                logging.error(f"Insufficient data for GPS in record {_+1}, packet: {data.hex()}")
-                break
-
-            priority = struct.unpack('>B', data[offset:offset+1])[0]
-            offset += 1
-            longitude = struct.unpack('>i', data[offset:offset+4])[0] / 10000000.0
-            offset += 4
-            latitude = struct.unpack('>i', data[offset:offset+4])[0] / 10000000.0
-            offset += 4
-            altitude = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            angle = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            satellites = struct.unpack('>B', data[offset:offset+1])[0]
-            offset += 1
-            speed = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-
-            record = {
-                'timestamp': timestamp,
-                'latitude': latitude,
-                'longitude': longitude,
-                'altitude': altitude,
-                'speed': speed,
-                'angle': angle,
-                'satellites': satellites,
-                'priority': priority,
-                'io_data': []
-            }
-
-            if offset + 4 > len(data) - 4:
-                logging.error(f"Insufficient data for IO in record {_+1}, packet: {data.hex()}")
-                break
-
-            event_io_id = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            total_io_count = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-
-            io_count_1b = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            for _ in range(io_count_1b):
-                if offset + 3 > len(data) - 4:
-                    logging.error(f"Insufficient data for 1-byte IO in record {_+1}, packet: {data.hex()}")
-                    break
-                io_id = struct.unpack('>H', data[offset:offset+2])[0]
-                offset += 2
-                io_value = struct.unpack('>B', data[offset:offset+1])[0]
-                offset += 1
-                record['io_data'].append({'io_id': io_id, 'io_value': io_value})
-
-            io_count_2b = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            for _ in range(io_count_2b):
-                if offset + 4 > len(data) - 4:
-                    logging.error(f"Insufficient data for 2-byte IO in record {_+1}, packet: {data.hex()}")
-                    break
-                io_id = struct.unpack('>H', data[offset:offset+2])[0]
-                offset += 2
-                io_value = struct.unpack('>H', data[offset:offset+2])[0]
-                offset += 2
-                record['io_data'].append({'io_id': io_id, 'io_value': io_value})
-
-            io_count_4b = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            for _ in range(io_count_4b):
-                if offset + 6 > len(data) - 4:
-                    logging.error(f"Insufficient data for 4-byte IO in record {_+1}, packet: {data.hex()}")
-                    break
-                io_id = struct.unpack('>H', data[offset:offset+2])[0]
-                offset += 2
-                io_value = struct.unpack('>I', data[offset:offset+4])[0]
-                offset += 4
-                record['io_data'].append({'io_id': io_id, 'io_value': io_value})
-
-            io_count_8b = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            for _ in range(io_count_8b):
-                if offset + 10 > len(data) - 4:
-                    logging.error(f"Insufficient data for 8-byte IO in record {_+1}, packet: {data.hex()}")
-                    break
-                io_id = struct.unpack('>H', data[offset:offset+2])[0]
-                offset += 2
-                io_value = struct.unpack('>Q', data[offset:offset+8])[0]
-                offset += 8
-                record['io_data'].append({'io_id': io_id, 'io_value': io_value})
-
-            io_count_xb = struct.unpack('>H', data[offset:offset+2])[0]
-            offset += 2
-            for _ in range(io_count_xb):
-                if offset + 4 > len(data) - 4:
-                    logging.error(f"Insufficient data for X-byte IO in record {_+1}, packet: {data.hex()}")
-                    break
-                io_id = struct.unpack('>H', data[offset:offset+2])[0]
-                offset += 2
-                io_length = struct.unpack('>H', data[offset:offset+2])[0]
-                offset += 2
-                if offset + io_length > len(data) - 4:
-                    logging.error(f"Insufficient data for X-byte IO value (length {io_length}), packet: {data.hex()}")
-                    break
-                io_value = int.from_bytes(data[offset:offset+io_length], byteorder='big')
-                offset += io_length
-                record['io_data'].append({'io_id': io_id, 'io_value': io_value})
-
-            records.append(record)
+        trace['decoded'] = time.time()
+        RECORDS.inc(len(records))
+        newest_record = tracing.newest_record_epoch(records)
+        if newest_record is not None:
+            DEVICE_LAG_SECONDS.observe(max(0.0, trace['received'] - newest_record))
+        fresh_records = recent_records.unseen(imei, records)
+        if len(fresh_records) < len(records):
+            DUPLICATE_RECORDS.inc(len(records) - len(fresh_records))
+            logging.info("Dropped %d resent records for IMEI %s", len(records) - len(fresh_records), imei,
+                         extra={'imei': imei, 'records': len(records) - len(fresh_records)})
+        if not fresh_records:
+            return number_of_data  # Still ACKed, so the device stops resending them
+        records = fresh_records
+        if io_filters is not None:
+            forwarded, io_updates = io_filters.filter(imei, records)
+        else:
+            forwarded, io_updates = records, None
 
         # Send data to API
-        payload = {'imei': imei, 'records': records}
-        logging.info(f"payload: {payload}")
+        payload = {'imei': imei, 'records': forwarded}
+        logging.debug("payload: %s", payload)
         try:
-            response = requests.post(SYNC_DATA_URL, json=payload, timeout=10)
+            with profiler.span('forward'), FORWARD_SECONDS.time():
+                response = forward_payload(payload, trace)
             response.raise_for_status()
-            logging.info(f"Sent data to API for IMEI {imei}: {response.json()}")
+            FORWARDS_OK.inc()
+            # Remembered only once the API took them: after any failure a resend is forwarded again
+            recent_records.remember(imei, records)
+            if io_updates:
+                io_filters.commit(imei, io_updates)
+            logging.info("Sent %d records to API for IMEI %s: %s", len(records), imei, response.status_code,
+                         extra={'imei': imei, 'records': len(records)})
         except requests.RequestException as e:
-            logging.error(f"Failed to send data to API for IMEI {imei}: {e}")
-
-        number_of_data_end = data[-5]
-        offset += 2
-        logging.info(f"number_of_data_end {number_of_data_end}")
-        if number_of_data != number_of_data_end:
-            logging.error(f"Number of data mismatch: Start={number_of_data}, End={number_of_data_end}, packet: {data.hex()}")
-            return 0
+            FORWARDS_FAILED.inc()
+            logging.error("Failed to send data to API for IMEI %s: %s", imei, e, extra={'imei': imei, 'records': len(records)})
 
         return number_of_data
     except Exception as e:
-        logging.error(f"Error parsing AVL packet for IMEI {imei}: {e}, packet: {data.hex()}")
+        log_setup.log_packet(logging.ERROR, "Error parsing AVL packet for IMEI %s: %s", data, imei, e, extra={'imei': imei})
         return 0
 
 
+def handle_connection(conn, addr, reaper, capture_writer, tls_context=None):
+    """Serve one device connection: IMEI handshake, queued commands, one AVL frame and its ACK."""
+    accepted = time.perf_counter()
+    CONNECTIONS.inc()
+    ACTIVE_CONNECTIONS.inc()
+    logging.info("Connected by %s", addr, extra={'addr': addr})
+    if tls_context:
+        conn = tls.wrap(tls_context, conn)
+    if capture_writer:
+        conn = capture_writer.wrap(conn, addr)  # Inside TLS, so captures hold the plain Teltonika bytes
+    session = reaper.open(conn, addr)
+    try:
+        if tls_context:
+            tls.handshake(conn)  # Under the session's handshake deadline
+        # Handle IMEI packet
+        data = conn.recv(2)
+        if not data:
+            HANDSHAKE_FAILED.inc()
+            logging.warning("No IMEI data received from %s", addr, extra={'addr': addr})
+            conn.close()
+            return
+        imei_length = struct.unpack('>H', data)[0]
+        if imei_length < 1 or imei_length > 17:
+            HANDSHAKE_FAILED.inc()
+            log_setup.log_packet(logging.ERROR, "Invalid IMEI length: %d", data, imei_length, extra={'addr': addr})
+            conn.close()
+            return
+        imei_data = conn.recv(imei_length)
+        if len(imei_data) != imei_length:
+            HANDSHAKE_FAILED.inc()
+            log_setup.log_packet(logging.ERROR, "Incomplete IMEI data: expected %d, got %d", imei_data, imei_length,
+                                 len(imei_data), extra={'addr': addr})
+            conn.close()
+            return
+        imei = session.imei = imei_data.decode('ascii', errors='ignore').strip('\0')
+        logging.info("IMEI received: %s", imei, extra={'imei': imei, 'addr': addr})
+        conn.sendall(b'\x01')
+        HANDSHAKE_SECONDS.observe(time.perf_counter() - accepted)
+        HANDSHAKE_OK.inc()
+        logging.debug("Sent IMEI acknowledgment to %s", addr)
+
+        # Handle AVL data
+        #send_command_with_response(conn, "getver\r\n", imei)
+        # Command round trips have their own timeouts; idle is only the backstop
+        reaper.enter(session, 'idle')
+        send_queued_commands(conn, imei)
+        if not throttle_ingest(imei):
+            return
+        reaper.enter(session, 'frame')
+        data = conn.recv(4096)
+        reaper.enter(session, 'idle')
+        received_at = time.time()
+        if data:
+            num_records = parse_avl_packet(data, imei, conn, received_at)
+            if num_records > 0:
+                conn.sendall(struct.pack('>I', num_records))
+                FRAMES_ACKED.inc()
+                logging.info("Sent acknowledgment for %d records to %s", num_records, addr,
+                             extra={'imei': imei, 'records': num_records})
+            else:
+                FRAMES_REJECTED.inc()
+                logging.warning("No records parsed or unsupported codec for IMEI %s", imei, extra={'imei': imei})
+        else:
+            logging.warning("No AVL data received from %s", addr, extra={'addr': addr})
+    except Exception as e:
+        log_setup.log_packet(logging.ERROR, "Error handling client %s: %s", data if 'data' in locals() else b'', addr, e,
+                             extra={'addr': addr})
+    finally:
+        reaper.close(session)
+        ACTIVE_CONNECTIONS.dec()
+        conn.close()
+
+
 def main():
-    logging.info(f"TCP server v{version} ")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    log_setup.configure_from_env(LOG_FILE)
+    logging.info("TCP server v%s ", version)
+    logging.info(io_schema.describe(io_schemas))
+    logging.info(io_filters.describe() if io_filters else "IO filter disabled; every IO element is forwarded")
+    profiler.install_signal_handlers('tcp_server_v8')
+    if METRICS_PORT:
         try:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((HOST, PORT))
-            s.listen()
-            logging.info(f"TCP server v{version} started on {HOST}:{PORT}")
-            #s.settimeout(540)  # Run for 540 seconds max
+            metrics.start_http_server(METRICS_PORT)
+            logging.info("Metrics available on http://127.0.0.1:%d/metrics", METRICS_PORT)
+        except OSError as e:
+            logging.error("Failed to start metrics endpoint on port %d: %s", METRICS_PORT, e)
+    capture_writer = capture.CaptureWriter.from_env('tcp_server_v8')
+    if capture_writer:
+        logging.info("Capturing device traffic to %s", capture_writer.path)
+    # Handshake/frame/idle deadlines (FMB_*_TIMEOUT, see sessions) so a silent device cannot block the handler
+    reaper = sessions.SessionReaper().start()
+    tls_context = tls.server_context()  # None unless FMB_TLS_CERT is set
+    # SIGTERM drains and exits, SIGHUP drains and re-execs on the same listening socket (see handoff)
+    lifecycle = handoff.Lifecycle(reaper).install()
+    s = handoff.listening_socket(HOST, PORT)
+    try:
+        s.settimeout(handoff.ACCEPT_POLL)  # Accepted sockets stay blocking; this only bounds the wait for a signal
+        logging.info("TCP server v%s started on %s:%d%s", version, HOST, PORT, ' (TLS)' if tls_context else '')
+        while not lifecycle.requested:
             try:
-                
                 conn, addr = s.accept()
-                logging.info(f"Connected by {addr}")
-                try:
-                    # Handle IMEI packet
-                    data = conn.recv(2)
-                    if not data:
-                        logging.warning(f"No IMEI data received from {addr}")
-                        conn.close()
-                        return
-                    imei_length = struct.unpack('>H', data)[0]
-                    if imei_length < 1 or imei_length > 17:
-                        logging.error(f"Invalid IMEI length: {imei_length}, packet: {data.hex()}")
-                        conn.close()
-                        return
-                    imei_data = conn.recv(imei_length)
-                    if len(imei_data) != imei_length:
-                        logging.error(f"Incomplete IMEI data: expected {imei_length}, got {len(imei_data)}, packet: {imei_data.hex()}")
-                        conn.close()
-                        return
-                    imei = imei_data.decode('ascii', errors='ignore').strip('\0')
-                    logging.info(f"IMEI received: {imei}")
-                    conn.sendall(b'\x01')
-                    logging.debug(f"Sent IMEI acknowledgment to {addr}")
-
-                    # Handle AVL data
-                    #send_command_with_response(conn, "getver\r\n", imei)
-                    send_queued_commands(conn, imei)
-                    data = conn.recv(4096)
-                    if data:
-                        num_records = parse_avl_packet(data, imei, conn)
-                        if num_records > 0:
-                            conn.sendall(struct.pack('>I', num_records))
-                            logging.info(f"Sent acknowledgment for {num_records} records to {addr}")
-                        else:
-                            logging.warning(f"No records parsed or unsupported codec for IMEI {imei}")
-                    else:
-                        logging.warning(f"No AVL data received from {addr}")
-                except Exception as e:
-                    logging.error(f"Error handling client {addr}: {e}, packet: {data.hex() if 'data' in locals() else ''}")
-                finally:
-                    conn.close()
+            except socket.timeout:
+                continue
             except Exception as e:
-                logging.error(f"Error accepting connection: {e}")
-        except Exception as e:
-            logging.error(f"TCP server error: {e}")
-            raise
+                logging.error("Error accepting connection: %s", e)
+                time.sleep(handoff.ACCEPT_POLL)  # e.g. out of descriptors; don't spin
+                continue
+            handle_connection(conn, addr, reaper, capture_writer, tls_context)
+        logging.info("TCP server v%s stopping (%s) after draining", version, lifecycle.requested)
+    except Exception as e:
+        logging.error("TCP server error: %s", e)
+        s.close()
+        raise
+    finally:
+        reaper.stop()
+        if capture_writer:
+            capture_writer.close()
+    if lifecycle.requested == 'restart':
+        handoff.reexec(s)
+    s.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,36 @@
+"""encode(decode(x)) == x for every AVL frame in the capture corpus.
+
+    python -m pytest -q test_fmb_codec.py
+"""
+import glob
+import os
+
+import pytest
+
+from fmb_codec import AVL_CODECS, decode_avl_packet, encode_avl_packet
+
+IMEI = '356307042441013'
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+
+def corpus_frames():
+    """(id, frame) for every AVL frame in corpus/*.hex; command frames are left to the Codec 12 parser."""
+    frames = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*.hex'))):
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                frame = bytes.fromhex(line.strip()) if line.strip() else b''
+                if len(frame) > 8 and frame[8] in AVL_CODECS:
+                    frames.append(pytest.param(frame, id=f'{os.path.basename(path)}:{number}'))
+    return frames
+
+
+def test_corpus_has_avl_frames():
+    assert corpus_frames()
+
+
+@pytest.mark.parametrize('frame', corpus_frames())
+def test_corpus_frame_reencodes_to_the_same_bytes(frame):
+    number_of_data, records = decode_avl_packet(frame, IMEI, keep_layout=True)
+    assert number_of_data == len(records) > 0
+    assert encode_avl_packet(records, frame[8]) == frame
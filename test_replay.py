@@ -0,0 +1,121 @@
+"""Round trip of capture.py and replay.py: capture a session, replay it against a stub sink.
+
+    python -m pytest -q test_replay.py
+"""
+import argparse
+import asyncio
+import os
+import socket
+import struct
+
+import pytest
+
+import capture
+import replay
+from fmb_codec import decode_avl_packet
+
+IMEI = '356307042441013'
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'codec8e.hex')
+
+
+def corpus_frames():
+    with open(CORPUS) as f:
+        return [bytes.fromhex(line) for line in f.read().split()]
+
+
+def recv_exactly(conn, length):
+    data = b''
+    while len(data) < length:
+        chunk = conn.recv(length - len(data))
+        assert chunk, 'peer closed early'
+        data += chunk
+    return data
+
+
+def write_capture(path, frames):
+    """Capture one device session the way tcp_server_v8 does: the server's socket is wrapped."""
+    writer = capture.CaptureWriter(path)
+    device, server = socket.socketpair()
+    conn = writer.wrap(server, ('10.0.0.7', 40122))
+    try:
+        device.sendall(struct.pack('>H', len(IMEI)) + IMEI.encode())
+        recv_exactly(conn, 2 + len(IMEI))
+        conn.sendall(b'\x01')
+        recv_exactly(device, 1)
+        for frame in frames:
+            # Two writes per frame, so replay has to reassemble frames split across packets
+            device.sendall(frame[:20])
+            device.sendall(frame[20:])
+            recv_exactly(conn, len(frame))
+            conn.sendall(struct.pack('>I', decode_avl_packet(frame, IMEI)[0]))
+            recv_exactly(device, 4)
+    finally:
+        conn.close()
+        device.close()
+        writer.close()
+
+
+async def sink_session(reader, writer, sessions):
+    """Stub ingest server: accept the IMEI, decode every frame and ACK its record count."""
+    imei_length = struct.unpack('>H', await reader.readexactly(2))[0]
+    imei = (await reader.readexactly(imei_length)).decode()
+    records = sessions.setdefault(imei, [])
+    writer.write(b'\x01')
+    try:
+        while True:
+            header = await reader.readexactly(8)
+            frame = header + await reader.readexactly(struct.unpack('>I', header[4:])[0] + 4)
+            number_of_data, decoded = decode_avl_packet(frame, imei)
+            records.extend(decoded)
+            writer.write(struct.pack('>I', number_of_data))
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
+
+
+async def replay_into_sink(path):
+    sessions = {}
+    server = await asyncio.start_server(lambda r, w: sink_session(r, w, sessions), '127.0.0.1', 0)
+    args = argparse.Namespace(captures=[path], host='127.0.0.1', port=server.sockets[0].getsockname()[1],
+                              speed=0.0, loops=1, concurrency=10, timeout=5.0)
+    try:
+        results, errors, _ = await replay.run_send(args)
+    finally:
+        server.close()
+        await server.wait_closed()
+    return results, errors, sessions
+
+
+@pytest.mark.parametrize('suffix', ['.fmbcap', '.fmbcap.gz'])
+def test_capture_replay_round_trip(tmp_path, suffix):
+    frames = corpus_frames()
+    expected = [record for frame in frames for record in decode_avl_packet(frame, IMEI)[1]]
+    path = str(tmp_path / f'session{suffix}')
+    write_capture(path, frames)
+
+    (_, session, entry), = replay.load_all([path])
+    events = entry['events']
+    assert entry['addr'] == '10.0.0.7:40122'
+    imei, captured_frames, trailing = capture.split_frames(replay.inbound_stream(events))
+    assert (imei, captured_frames, trailing) == (IMEI, frames, b'')
+    records, errors, counts = replay.decode_frames(captured_frames, imei)
+    assert (records, errors) == (len(expected), 0)
+    assert counts == replay.captured_acks(events)
+
+    results, errors, sessions = asyncio.run(replay_into_sink(path))
+    assert errors == {}
+    assert results[f'{os.path.basename(path)}#{session}']['response_mismatches'] == 0
+    assert sessions == {IMEI: expected}
+
+
+def test_truncated_capture_keeps_complete_events(tmp_path):
+    path = str(tmp_path / 'killed.fmbcap')
+    write_capture(path, corpus_frames()[:2])
+    with open(path, 'rb+') as f:
+        f.truncate(os.path.getsize(path) - 3)  # The writer died inside the close event
+    events = list(capture.read_capture(path))
+    assert [kind for _, _, kind, _ in events][-1] == capture.EVENT_OUT
+    stream = replay.inbound_stream([(timestamp, kind, payload) for timestamp, _, kind, payload in events])
+    assert capture.split_frames(stream)[1] == corpus_frames()[:2]
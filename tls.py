@@ -0,0 +1,71 @@
+"""Optional TLS on the device port, so units can connect without the ngrok relay.
+
+Off unless FMB_TLS_CERT is set; the ingest server then wraps every accepted
+connection before the IMEI handshake:
+
+    FMB_HOST=0.0.0.0 FMB_TLS_CERT=server.pem FMB_TLS_KEY=server.key python tcp_server_v8.py
+
+FMB_TLS_CIPHERS (OpenSSL cipher string, TLS 1.2 suites) and
+FMB_TLS_MIN_VERSION (1.2 or 1.3) restrict what is negotiated. Resumption
+is on by default: the context keeps OpenSSL's server-side session cache
+and issues FMB_TLS_TICKETS session tickets per handshake (0 disables
+tickets), so a unit reconnecting every few minutes skips the certificate
+exchange and the server's signature. bench_tls.py measures the difference.
+"""
+import logging
+import os
+import socket
+import ssl
+
+import metrics
+
+CERT_FILE = os.environ.get('FMB_TLS_CERT') or None
+KEY_FILE = os.environ.get('FMB_TLS_KEY') or None
+CIPHERS = os.environ.get('FMB_TLS_CIPHERS') or None
+MIN_VERSION = os.environ.get('FMB_TLS_MIN_VERSION', '1.2')
+TICKETS = int(os.environ.get('FMB_TLS_TICKETS', 2))  # TLS 1.3 tickets per handshake; 0 disables resumption by ticket
+VERSIONS = {'1.2': ssl.TLSVersion.TLSv1_2, '1.3': ssl.TLSVersion.TLSv1_3}
+
+HANDSHAKES = metrics.Counter('fmb_tls_handshakes_total', 'TLS handshakes on the device port by result',
+                             ('result',))
+HANDSHAKES_FULL, HANDSHAKES_RESUMED, HANDSHAKES_FAILED = (HANDSHAKES.labels('full'), HANDSHAKES.labels('resumed'),
+                                                           HANDSHAKES.labels('failed'))
+
+
+def server_context(cert_file=CERT_FILE, key_file=KEY_FILE, ciphers=CIPHERS, min_version=MIN_VERSION, tickets=TICKETS):
+    """SSLContext for the device port, or None when no certificate is configured."""
+    if not cert_file:
+        return None
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    context.minimum_version = VERSIONS[min_version]
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if tickets:
+        context.num_tickets = tickets
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    logging.info("TLS enabled on the device port (min TLS %s, %d session tickets)", min_version, tickets)
+    return context
+
+
+def wrap(context, conn):
+    """Wrap an accepted socket without handshaking; call handshake() once deadlines cover it."""
+    # The handshake and session tickets are several small writes; with Nagle on, the last of them
+    # waits for the unit's delayed ACK (~40 ms per connection on Linux)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+
+
+def handshake(conn):
+    """Complete the server side of the TLS handshake, counting full vs resumed sessions; raises on failure."""
+    try:
+        conn.do_handshake()
+    except (ssl.SSLError, OSError):
+        HANDSHAKES_FAILED.inc()
+        raise
+    if conn.session_reused:
+        HANDSHAKES_RESUMED.inc()
+    else:
+        HANDSHAKES_FULL.inc()
@@ -0,0 +1,82 @@
+"""Per-batch trace context carried from frame receipt to storage.
+
+tcp_server_v8 stamps each AVL batch when the frame is received, decoded and
+sent, and forwards those stamps as X-Trace-* headers next to the payload
+(headers, so every wire_format encoding carries them unchanged). The API
+adds its own receive/store stamps and derives the stage latencies:
+
+    device     newest record timestamp -> frame received (device buffer + network)
+    decode     received -> decoded
+    transport  sent -> API received (HTTP forward; includes clock skew between hosts)
+    store      API received -> committed
+    freshness  newest record timestamp -> committed (end to end)
+
+All stamps are Unix epoch seconds; record timestamps are the UTC
+'%Y-%m-%d %H:%M:%S' strings produced by fmb_codec.
+"""
+import calendar
+import time
+import uuid
+
+HEADER_ID = 'X-Trace-Id'
+HEADER_STAMPS = {
+    'received': 'X-Trace-Received',
+    'decoded': 'X-Trace-Decoded',
+    'sent': 'X-Trace-Sent',
+}
+RECORD_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Seconds; device buffering can hold records for hours when a unit is out of coverage
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0,
+               3600.0, 21600.0, 86400.0)
+
+
+def new_trace(received_at=None):
+    return {'id': uuid.uuid4().hex, 'received': received_at if received_at is not None else time.time()}
+
+
+def to_headers(trace):
+    headers = {HEADER_ID: trace['id']}
+    for stage, header in HEADER_STAMPS.items():
+        if stage in trace:
+            headers[header] = f"{trace[stage]:.6f}"
+    return headers
+
+
+def from_headers(headers):
+    """Trace dict from request headers, or None when the sender did not trace the batch."""
+    trace_id = headers.get(HEADER_ID)
+    if not trace_id:
+        return None
+    trace = {'id': trace_id[:64]}
+    for stage, header in HEADER_STAMPS.items():
+        try:
+            trace[stage] = float(headers[header])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return trace
+
+
+def record_epoch(timestamp):
+    """Epoch seconds for a record timestamp string, or None if it does not parse."""
+    try:
+        return calendar.timegm(time.strptime(timestamp, RECORD_TIMESTAMP_FORMAT))
+    except (TypeError, ValueError):
+        return None
+
+
+def newest_record_epoch(records):
+    """Epoch of the newest record in a batch (the format sorts lexicographically)."""
+    timestamps = [record.get('timestamp') for record in records if record.get('timestamp')]
+    return record_epoch(max(timestamps)) if timestamps else None
+
+
+def stage_latencies(trace, newest_record=None):
+    """{stage: seconds} for every stage whose two stamps are both known."""
+    pairs = {
+        'device': (newest_record, trace.get('received')),
+        'decode': (trace.get('received'), trace.get('decoded')),
+        'transport': (trace.get('sent'), trace.get('api_received')),
+        'store': (trace.get('api_received'), trace.get('stored')),
+        'freshness': (newest_record, trace.get('stored')),
+    }
+    return {stage: end - start for stage, (start, end) in pairs.items() if start is not None and end is not None}
@@ -0,0 +1,147 @@
+"""Connectionless AVL ingest (Codec 8, 8E and 16) over UDP.
+
+Units configured for UDP skip the TCP handshake and keepalives: every
+datagram carries the IMEI in its own header and gets one ACK frame back
+(packet id, AVL packet id, accepted record count), so the server keeps no
+per-device socket state. Datagrams go through tcp_server_v8's decode and
+forward pipeline (parse_avl_packet) on a thread pool, since the forward is
+a blocking HTTP POST, and are ACKed once it returns, exactly as over TCP.
+A unit that gets no ACK, or an accepted count short of what it sent,
+resends the packet.
+
+Queued Codec 12 commands are not sent over UDP; they wait in the API until
+the unit next connects over TCP.
+
+    FMB_UDP_PORT=50122 python udp_server.py
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import log_setup
+import handoff
+import io_schema
+import metrics
+import profiler
+import ratelimit
+import tcp_server_v8
+from fmb_codec import FrameError, build_udp_ack, decode_udp_packet
+
+version = "1.0"
+HOST = os.environ.get('FMB_UDP_HOST', '0.0.0.0')
+PORT = int(os.environ.get('FMB_UDP_PORT', tcp_server_v8.PORT))  # UDP and TCP ports are separate namespaces
+LOG_FILE = 'udp_server.log'
+WORKERS = int(os.environ.get('FMB_UDP_WORKERS', 16))  # Concurrent decode + forward calls
+# Datagrams being decoded/forwarded at once; beyond this new ones are dropped unACKed and the unit resends later
+MAX_PENDING = int(os.environ.get('FMB_UDP_MAX_PENDING', 1000))
+METRICS_PORT = int(os.environ.get('FMB_UDP_METRICS_PORT', 9109))  # 0 disables it
+
+DATAGRAMS = metrics.Counter('fmb_udp_datagrams_total', 'UDP datagrams received by result', ('result',))
+PENDING = metrics.Gauge('fmb_udp_pending', 'UDP datagrams being decoded or forwarded')
+DATAGRAMS_ACKED, DATAGRAMS_REJECTED = DATAGRAMS.labels('acked'), DATAGRAMS.labels('rejected')
+DATAGRAMS_MALFORMED, DATAGRAMS_DROPPED = DATAGRAMS.labels('malformed'), DATAGRAMS.labels('dropped')
+DATAGRAMS_THROTTLED = DATAGRAMS.labels('throttled')
+
+# AVL datagrams per IMEI (FMB_INGEST_RATE/BURST); over the limit they are dropped unACKed, so the unit backs off
+ingest_limits = ratelimit.ingest_limiter()
+
+
+class UdpIngestProtocol(asyncio.DatagramProtocol):
+    def __init__(self, executor):
+        self.executor = executor
+        self.transport = None
+        self.pending = 0
+        self.draining = False  # Set on SIGTERM: new datagrams go unACKed, in-flight ones finish
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        logging.warning("UDP socket error: %s", exc)
+
+    def datagram_received(self, data, addr):
+        received_at = time.time()
+        if self.draining:
+            return
+        try:
+            packet_id, avl_packet_id, imei, frame = decode_udp_packet(data)
+        except FrameError as e:
+            DATAGRAMS_MALFORMED.inc()
+            log_setup.log_packet(logging.WARNING, "Malformed UDP datagram from %s: %s", data, addr, e, extra={'addr': addr})
+            return
+        if ingest_limits.acquire(imei):
+            DATAGRAMS_THROTTLED.inc()
+            logging.warning("Throttling UDP packet %d from IMEI %s: over its ingest rate", packet_id, imei,
+                            extra={'imei': imei, 'addr': addr})
+            return
+        if self.pending >= MAX_PENDING:
+            DATAGRAMS_DROPPED.inc()
+            logging.warning("Dropping UDP packet %d from IMEI %s: %d datagrams pending", packet_id, imei, self.pending,
+                            extra={'imei': imei, 'addr': addr})
+            return
+        self.pending += 1
+        PENDING.inc()
+        asyncio.get_running_loop().create_task(
+            self.handle(packet_id, avl_packet_id, imei, frame, addr, received_at))
+
+    async def handle(self, packet_id, avl_packet_id, imei, frame, addr, received_at):
+        try:
+            num_records = await asyncio.get_running_loop().run_in_executor(
+                self.executor, tcp_server_v8.parse_avl_packet, frame, imei, None, received_at)
+        finally:
+            self.pending -= 1
+            PENDING.dec()
+        # A zero count is ACKed too: it tells the unit straight away to resend
+        self.transport.sendto(build_udp_ack(packet_id, avl_packet_id, num_records), addr)
+        if num_records > 0:
+            DATAGRAMS_ACKED.inc()
+            logging.info("Sent UDP acknowledgment for %d records to %s", num_records, addr,
+                         extra={'imei': imei, 'records': num_records, 'addr': addr})
+        else:
+            DATAGRAMS_REJECTED.inc()
+            logging.warning("No records parsed or unsupported codec for IMEI %s over UDP", imei,
+                            extra={'imei': imei, 'addr': addr})
+
+
+async def serve():
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(WORKERS, thread_name_prefix='udp-ingest')
+    transport, protocol = await loop.create_datagram_endpoint(lambda: UdpIngestProtocol(executor), local_addr=(HOST, PORT))
+    logging.info("UDP server v%s started on %s:%d", version, HOST, PORT)
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    try:
+        await stopping.wait()  # Or until cancelled
+        # Let in-flight datagrams finish forwarding and get their ACKs before the socket closes
+        protocol.draining = True
+        deadline = loop.time() + handoff.DRAIN_TIMEOUT
+        while protocol.pending and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        logging.info("UDP server v%s stopping, %d datagrams still pending", version, protocol.pending)
+    finally:
+        transport.close()
+        executor.shutdown(wait=True)
+
+
+def main():
+    log_setup.configure_from_env(LOG_FILE)
+    logging.info("UDP server v%s ", version)
+    logging.info(io_schema.describe(tcp_server_v8.io_schemas))
+    profiler.install_signal_handlers('udp_server')
+    if METRICS_PORT:
+        try:
+            metrics.start_http_server(METRICS_PORT)
+            logging.info("Metrics available on http://127.0.0.1:%d/metrics", METRICS_PORT)
+        except OSError as e:
+            logging.error("Failed to start metrics endpoint on port %d: %s", METRICS_PORT, e)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        logging.info("UDP server stopped")
+
+
+if __name__ == "__main__":
+    main()
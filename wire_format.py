@@ -0,0 +1,195 @@
+"""Wire formats shared by the ingest forwarder and the Flask API.
+
+Record batches (``{'imei': ..., 'records': [...]}``) can travel as plain JSON,
+as columnar JSON (one list per field instead of repeating key names in every
+record) or as columnar MessagePack, and any of them can be gzip or brotli
+compressed. brotli and msgpack are optional; when they are not installed the
+corresponding options are simply not offered. Bodies from the network are
+inflated with a size cap (decompress's max_size), which for brotli needs
+brotli >= 1.2.
+"""
+import gzip
+import json
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'columnar': 'application/vnd.fmb.columnar+json',
+    'msgpack': 'application/x-msgpack',
+}
+GPS_FIELDS = ('timestamp', 'latitude', 'longitude', 'altitude', 'speed', 'angle', 'satellites', 'priority')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+def check_forward_options(wire_format, encoding):
+    """Raise ValueError for a format or content-encoding this install cannot produce."""
+    if wire_format not in CONTENT_TYPES:
+        raise ValueError(f"Unknown wire format {wire_format!r}, expected one of {', '.join(CONTENT_TYPES)}")
+    if wire_format == 'msgpack' and not msgpack:
+        raise ValueError("Wire format 'msgpack' needs the msgpack package")
+    if encoding and encoding not in available_encodings():
+        raise ValueError(f"Unsupported content-encoding {encoding!r}, available: {', '.join(available_encodings())}")
+
+
+def choose_encoding(accept_encoding):
+    """Pick the best content-encoding from an Accept-Encoding header, or None."""
+    if not accept_encoding:
+        return None
+    offered = set()
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        try:
+            if params.startswith('q=') and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        offered.add(name.strip().lower())
+    for encoding in available_encodings():
+        if encoding in offered or '*' in offered:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if not encoding:
+        return body
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if encoding == 'br' and brotli:
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError(f"Unsupported content-encoding: {encoding}")
+
+
+class BodyTooLarge(ValueError):
+    """A body, or what it decompresses to, is over the size allowed."""
+
+
+def decompress(body, encoding, max_size=None):
+    """Undo compress(); with max_size, raise BodyTooLarge once the output would exceed it.
+
+    The output is inflated in a stream that stops at max_size, so a small
+    compression bomb cannot expand into memory first.
+    """
+    if max_size is None:
+        return _decompress(body, encoding)
+    if not encoding or encoding == 'identity':
+        data = body
+    elif encoding == 'gzip':
+        data = b''
+        while body:  # One zlib stream per gzip member
+            inflater = zlib.decompressobj(wbits=31)
+            data += inflater.decompress(body, max_size + 1 - len(data))
+            if len(data) > max_size:
+                break
+            if not inflater.eof:
+                raise ValueError("Truncated gzip body")
+            body = inflater.unused_data
+    elif encoding == 'br' and brotli:
+        decompressor = brotli.Decompressor()
+        if not hasattr(decompressor, 'can_accept_more_data'):
+            raise ValueError("Bounded brotli decompression needs brotli >= 1.2")
+        data = decompressor.process(body, output_buffer_limit=max_size + 1)
+        if len(data) <= max_size and not decompressor.is_finished():
+            raise ValueError("Truncated brotli body")
+    else:
+        raise ValueError(f"Unsupported content-encoding: {encoding}")
+    if len(data) > max_size:
+        raise BodyTooLarge(f"Body is over {max_size} bytes")
+    return data
+
+
+def _decompress(body, encoding):
+    if not encoding or encoding == 'identity':
+        return body
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'br' and brotli:
+        return brotli.decompress(body)
+    raise ValueError(f"Unsupported content-encoding: {encoding}")
+
+
+def to_columnar(payload):
+    """Turn a row-oriented record batch into one list per field.
+
+    IO elements are flattened into parallel lists, with ``io.record`` holding
+    the index of the record each element belongs to. Typed values from an IO
+    schema travel in ``io.value`` (null for elements without one); names do
+    not, as the receiver can look them up in io_schema. Records trimmed by
+    io_filter carry their ``io_digest`` in ``gps.io_digest``.
+    """
+    records = payload['records']
+    columnar = {key: value for key, value in payload.items() if key != 'records'}
+    columnar['count'] = len(records)
+    columnar['gps'] = {field: [record[field] for record in records] for field in GPS_FIELDS}
+    if any('io_digest' in record for record in records):
+        columnar['gps']['io_digest'] = [record.get('io_digest') for record in records]
+    io_record, io_ids, io_values, typed_values = [], [], [], []
+    for index, record in enumerate(records):
+        for io in record.get('io_data', ()):
+            io_record.append(index)
+            io_ids.append(io['io_id'])
+            io_values.append(io['io_value'])
+            typed_values.append(io.get('value'))
+    columnar['io'] = {'record': io_record, 'io_id': io_ids, 'io_value': io_values}
+    if any(value is not None for value in typed_values):
+        columnar['io']['value'] = typed_values
+    return columnar
+
+
+def from_columnar(columnar):
+    gps = columnar['gps']
+    records = [{'io_data': []} for _ in range(columnar['count'])]
+    for field in GPS_FIELDS:
+        for record, value in zip(records, gps[field]):
+            record[field] = value
+    for record, digest in zip(records, gps.get('io_digest', ())):
+        if digest is not None:
+            record['io_digest'] = digest
+    io = columnar['io']
+    typed_values = io.get('value') or [None] * len(io['io_id'])
+    for index, io_id, io_value, value in zip(io['record'], io['io_id'], io['io_value'], typed_values):
+        element = {'io_id': io_id, 'io_value': io_value}
+        if value is not None:
+            element['value'] = value
+        records[index]['io_data'].append(element)
+    payload = {key: value for key, value in columnar.items() if key not in ('count', 'gps', 'io')}
+    payload['records'] = records
+    return payload
+
+
+def encode_batch(payload, wire_format='json'):
+    """Serialize a record batch; returns (body, content_type)."""
+    if wire_format == 'msgpack' and msgpack:
+        return msgpack.packb(to_columnar(payload), use_bin_type=True), CONTENT_TYPES['msgpack']
+    if wire_format == 'columnar':
+        return json.dumps(to_columnar(payload), separators=(',', ':')).encode(), CONTENT_TYPES['columnar']
+    return json.dumps(payload, separators=(',', ':')).encode(), CONTENT_TYPES['json']
+
+
+def decode_batch(body, content_type):
+    """Parse a body produced by encode_batch back into a row-oriented batch."""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type == CONTENT_TYPES['msgpack']:
+        if not msgpack:
+            raise ValueError("msgpack payload received but msgpack is not installed")
+        return from_columnar(msgpack.unpackb(body, raw=False))
+    data = json.loads(body)
+    if content_type == CONTENT_TYPES['columnar']:
+        return from_columnar(data)
+    return data